@@ -0,0 +1,103 @@
+'''
+CPU time and size of JSON responses.
+
+Builds the responses of a medical history, of a page of base64 images and of a medicines
+page, then measures the CPU time per response and the bytes on the wire of the stdlib JSON
+provider (the previous behaviour) and of GenesisJSONProvider, uncompressed and with the
+encodings compress_response negotiates. The images endpoints skip compression, their row
+shows what it would cost. No database or Redis is needed.
+
+Usage (from the App folder):
+    python benchmarks/bench_json.py --records 50 --image-size 8000 --repeat 20
+'''
+from datetime import datetime
+
+import argparse
+import base64
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+
+
+def payloads(records: int, image_size: int) -> dict:
+    '''Responses shaped like generate_response(...) of the medical history, images and medicines endpoints'''
+    today = datetime.utcnow().date()
+    medical_history = [{
+        'id': index, 'association_id': 1, 'observation': 'Observation ' * 10,
+        'diagnostic': 'Diagnostic', 'symptoms': 'Symptoms ' * 5, 'private_notes': None,
+        'follow_up_required': index % 2 == 0, 'patient_feedback': None, 'status': True,
+        'date_of_visit': today.isoformat(), 'next_appointment_date': today,
+        'creation_date': today.isoformat(), 'last_update': today.isoformat(),
+        'user_images': [{'id': index, 'name': f'image_{index}.jpg', 'status': True}],
+    } for index in range(records)]
+    images = [{
+        'id': index, 'name': f'image_{index}.jpg', 'size': 'small', 'ml_diagnostic': [],
+        # Random bytes compress like JPEG data
+        'image': base64.b64encode(os.urandom(image_size)).decode('utf-8'),
+    } for index in range(records)]
+    medicines = [{
+        'id': index, 'name': f'Medicine {index}', 'price': 12.5, 'is_discontinued': False,
+        'manufacturer_name': 'Manufacturer', 'type': 'allopathy',
+        'pack_size_label': 'strip of 10 tablets', 'short_composition1': 'Paracetamol (500mg)',
+        'short_composition2': '', 'status': True, 'creation_date': today.isoformat(),
+        'last_update': today.isoformat(),
+    } for index in range(100)]
+
+    def response(data):
+        return {'success': True, 'message': 'Retrieved successfully', 'data': data, 'status': 200}
+    return {'medical history': response(medical_history),
+            'user images (skip_compression)': response({'images': images, 'next_cursor': None}),
+            'medicines page': response(medicines)}
+
+
+def cpu_time(function, repeat: int) -> float:
+    '''Best CPU seconds of function over repeat runs'''
+    best = None
+    for _ in range(repeat):
+        start = time.process_time()
+        function()
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=50)
+    parser.add_argument('--image-size', type=int, default=8000,
+                        help='bytes of each image before base64')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    from flask import Flask
+    from flask.json.provider import DefaultJSONProvider
+    from genesis_api.tools import responses
+    from genesis_api.tools.responses import GenesisJSONProvider, compress_response
+
+    app = Flask('benchmark')
+    providers = [('stdlib', DefaultJSONProvider(app)),
+                 ('orjson' if responses.orjson else 'genesis (no orjson)', GenesisJSONProvider(app))]
+    encodings = [('identity', ''), ('gzip', 'gzip')]
+    if responses.brotli:
+        encodings.append(('br', 'br'))
+
+    for name, payload in payloads(args.records, args.image_size).items():
+        print(f'{name}, best of {args.repeat}')
+        for provider_name, provider in providers:
+            app.json = provider
+            for encoding_name, accept_encoding in encodings:
+                with app.test_request_context(headers={'Accept-Encoding': accept_encoding}):
+                    def respond():
+                        return compress_response(app.json.response(payload))
+                    seconds = cpu_time(respond, args.repeat)
+                    size = respond().content_length
+                print(f'{provider_name:>20} {encoding_name:>8}: {seconds * 1000:8.2f} ms CPU '
+                      f'{size:10d} bytes')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+'''
+Sign-in throughput of the password hashing pool.
+
+Verifies the same bcrypt hash from many threads, as concurrent sign-ins would, once on the
+request threads (the previous behaviour) and once through genesis_api.tools.passwords,
+and prints sign-ins per second and per core.
+
+Usage (from the App folder):
+    python benchmarks/bench_passwords.py --requests 200 --threads 16 --rounds 12
+'''
+from concurrent.futures import ThreadPoolExecutor
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+
+
+def run(verify, password_hash: str, requests: int, threads: int) -> float:
+    '''Run requests verifications from threads threads, return the sign-ins per second'''
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        results = list(executor.map(
+            lambda _: verify(password_hash, 'benchmark-password'), range(requests)))
+    elapsed = time.perf_counter() - start
+    assert all(results)
+    return requests / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--rounds', type=int, default=12)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    os.environ['BCRYPT_LOG_ROUNDS'] = str(args.rounds)
+    os.environ['PASSWORD_HASH_WORKERS'] = str(args.workers)
+    os.environ['PASSWORD_HASH_QUEUE_DEPTH'] = str(args.requests)
+    from genesis_api.tools import passwords
+
+    password_hash = passwords.hash_password('benchmark-password')
+    cores = os.cpu_count() or 1
+
+    print(f'bcrypt rounds={args.rounds} requests={args.requests} '
+          f'threads={args.threads} workers={args.workers} cores={cores}')
+    for name, verify, used_cores in [('request thread', passwords._verify, cores),
+                                     ('process pool', passwords.verify_password,
+                                      min(cores, args.workers))]:
+        throughput = run(verify, password_hash, args.requests, args.threads)
+        print(f'{name:>15}: {throughput:8.1f} sign-ins/s '
+              f'{throughput / used_cores:8.1f} per core')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+'''
+Serialization throughput of BaseModel.to_dict.
+
+Compares the previous implementation (column iteration with per-value type checks), the
+compiled per-model serializer of to_dict, a projection with to_dict(fields), and to_dicts on
+raw row tuples, for Medicines rows built in memory (no database needed).
+
+Usage (from the App folder):
+    python benchmarks/bench_to_dict.py --rows 10000 --repeat 5
+'''
+from datetime import datetime
+from enum import Enum
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+
+
+def legacy_to_dict(self) -> dict:
+    '''BaseModel.to_dict before the compiled serializer'''
+    def convert_value(value):
+        if isinstance(value, Enum):
+            return value.value
+        if isinstance(value, datetime):
+            return value.strftime('%Y-%m-%d')
+        return value
+
+    return {
+        column.name: convert_value(getattr(self, column.name))
+        for column in self.__table__.columns
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    from genesis_api.models import Medicines
+
+    now = datetime.utcnow()
+    medicines = [Medicines(id=index, name=f'Medicine {index}', price=12.5, is_discontinued=False,
+                           manufacturer_name='Manufacturer', type='allopathy',
+                           pack_size_label='strip of 10 tablets', short_composition1='Paracetamol (500mg)',
+                           short_composition2='', status=True, creation_date=now, last_update=now)
+                 for index in range(args.rows)]
+    columns = [name for name, _ in Medicines._serializer()]
+    rows = [tuple(getattr(medicine, name) for name in columns)
+            for medicine in medicines]
+    fields = ['id', 'name', 'price', 'manufacturer_name']
+
+    assert [legacy_to_dict(medicine) for medicine in medicines] == \
+        [medicine.to_dict() for medicine in medicines] == Medicines.to_dicts(rows)
+
+    cases = [
+        ('legacy to_dict', lambda: [legacy_to_dict(medicine) for medicine in medicines]),
+        ('to_dict', lambda: [medicine.to_dict() for medicine in medicines]),
+        ('to_dict(fields)', lambda: [medicine.to_dict(fields) for medicine in medicines]),
+        ('to_dicts(rows)', lambda: Medicines.to_dicts(rows)),
+    ]
+
+    print(f'{args.rows} rows, best of {args.repeat}')
+    baseline = None
+    for name, case in cases:
+        best = min(timeit.repeat(case, number=1, repeat=args.repeat))
+        baseline = baseline or best
+        print(f'{name:>16}: {best * 1000:8.2f} ms {args.rows / best:12.0f} rows/s '
+              f'{baseline / best:6.2f}x')
+
+
+if __name__ == '__main__':
+    main()
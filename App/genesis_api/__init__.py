@@ -1,4 +1,4 @@
-from flask import Flask
+from flask import Flask, abort
 from flask_sqlalchemy import SQLAlchemy
 from flask_socketio import SocketIO
 from flask_caching import Cache
@@ -6,12 +6,15 @@ from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_session import Session
 from genesis_api.config import Config
+from genesis_api.tools.routing import RoutingSession, init_replicas
+from genesis_api.tools.responses import GenesisJSONProvider, compress_response
 from flask_cors import CORS
 import logging
+import posixpath
 import redis
 
 # Initialize SQLAlchemy and Redis clients
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 
 limiter = Limiter(
     storage_uri="redis://redis_rate_limiting:6379",
@@ -19,11 +22,7 @@ limiter = Limiter(
 )
 
 # Initialize cache config
-cache = Cache(config={
-    "DEBUG": True,
-    "CACHE_TYPE": "SimpleCache",
-    "CACHE_DEFAULT_TIMEOUT": 300
-})
+cache = Cache(config=Config.CACHE_CONFIG)
 
 
 # Initialize SocketIO
@@ -41,9 +40,12 @@ handler.setFormatter(formatter)
 def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(Config)
+    app.json = GenesisJSONProvider(app)
+    app.after_request(compress_response)
 
     # Initialize ORM
     db.init_app(app)
+    init_replicas(app, db)
     limiter.init_app(app)
 
     # Initialize Redis for user sessions
@@ -75,4 +77,22 @@ def create_app(config_class=Config):
     app.register_blueprint(medical_history)
     app.register_blueprint(medicines_endpoint)
 
+    _hide_static_uploads(app)
+
     return app
+
+
+def _hide_static_uploads(app) -> None:
+    '''
+    Images uploaded before the content-addressed store live in static/uploads. They are
+    medical data, so they are only served by the authenticated image endpoints.
+    '''
+    send_static_file = app.view_functions['static']
+
+    def static(filename):
+        # Normalized like send_static_file does, so uploads cannot be reached through ../
+        if posixpath.normpath(filename).split('/')[0] == 'uploads':
+            abort(404)
+        return send_static_file(filename=filename)
+
+    app.view_functions['static'] = static
@@ -23,10 +23,35 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.getenv(
         "SQLALCHEMY_DATABASE_URI", f"mysql://{MYSQL_USER}:{MYSQL_PASSWORD}@{MYSQL_HOST}:{MYSQL_PORT}/{MYSQL_DATABASE}")
     SQLALCHEMY_ECHO = False
-    SQLALCHEMY_TRACK_MODIFICATIONS = True
+    SQLALCHEMY_TRACK_MODIFICATIONS = os.getenv(
+        "SQLALCHEMY_TRACK_MODIFICATIONS", "false").lower() == "true"
+    # Read replicas (comma separated URIs) serving the read_only endpoints, as binds replica_<n>
+    SQLALCHEMY_REPLICA_URIS = [uri for uri in os.getenv(
+        "SQLALCHEMY_REPLICA_URIS", "").split(",") if uri]
+    SQLALCHEMY_BINDS = {f"replica_{index}": uri for index,
+                        uri in enumerate(SQLALCHEMY_REPLICA_URIS)}
+    # Seconds a user's reads stay on the primary after they wrote
+    REPLICA_STICKY_SECONDS = int(os.getenv("REPLICA_STICKY_SECONDS", 5))
+    # Seconds a replica is skipped after a connection error
+    REPLICA_RETRY_SECONDS = int(os.getenv("REPLICA_RETRY_SECONDS", 30))
+    # Connection pool, per worker process: size it so workers * (pool size + max overflow)
+    # stays under MySQL max_connections
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        "pool_size": int(os.getenv("SQLALCHEMY_POOL_SIZE", 10)),
+        "max_overflow": int(os.getenv("SQLALCHEMY_MAX_OVERFLOW", 10)),
+        # Seconds before a connection is replaced, below MySQL wait_timeout
+        "pool_recycle": int(os.getenv("SQLALCHEMY_POOL_RECYCLE", 1800)),
+        # Seconds to wait for a free connection before failing the request
+        "pool_timeout": int(os.getenv("SQLALCHEMY_POOL_TIMEOUT", 30)),
+        # Test connections on checkout, so ones dropped by MySQL are replaced transparently
+        "pool_pre_ping": os.getenv("SQLALCHEMY_POOL_PRE_PING", "true").lower() == "true",
+    }
 
     # JWT Secret Key
     SECRET_KEY = os.getenv("SECRET_KEY")
+    JWT_LIFETIME_DAYS = int(os.getenv("JWT_LIFETIME_DAYS", 50))
+    # Redis pub/sub channel announcing revoked tokens and changed users to every worker
+    REVOCATION_CHANNEL = os.getenv("REVOCATION_CHANNEL", "revoked_tokens")
 
     # Mail Credentials
     MAIL_SERVER = os.environ.get("MAIL_SERVER")
@@ -45,17 +70,145 @@ class Config:
     UPLOAD_FOLDER = os.environ.get(
         "UPLOAD_FOLDER", 'App/genesis_api/static/uploads')
 
+    # Files derived from uploads, kept out of static/ so only the authenticated endpoints serve them
+    MEDIA_FOLDER = os.environ.get("MEDIA_FOLDER", 'App/media')
+
+    # Content-addressed store of the uploaded images, served by /get_image/<id>/raw only
+    IMAGE_STORE_FOLDER = os.environ.get(
+        "IMAGE_STORE_FOLDER", os.path.join(MEDIA_FOLDER, 'images'))
+
+    # Uploads are written here before being moved to their content-addressed path
+    UPLOAD_TMP_FOLDER = os.environ.get(
+        "UPLOAD_TMP_FOLDER", os.path.join(MEDIA_FOLDER, 'tmp'))
+    UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", 64 * 1024))
+
+    # Resumable chunked uploads
+    CHUNKED_UPLOAD_TTL = int(os.environ.get("CHUNKED_UPLOAD_TTL", 24 * 60 * 60))
+    CHUNKED_UPLOAD_MAX_SIZE = int(os.environ.get(
+        "CHUNKED_UPLOAD_MAX_SIZE", 50 * 1024 * 1024))
+    CHUNKED_UPLOAD_CHUNK_SIZE = int(os.environ.get(
+        "CHUNKED_UPLOAD_CHUNK_SIZE", 1024 * 1024))
+    # Uploads a user can have in progress at once
+    CHUNKED_UPLOAD_MAX_OPEN = int(os.environ.get("CHUNKED_UPLOAD_MAX_OPEN", 5))
+    # Temporary files untouched for UPLOAD_TMP_MAX_AGE seconds and without upload state are
+    # deleted, at most every UPLOAD_TMP_SWEEP_INTERVAL seconds
+    UPLOAD_TMP_MAX_AGE = int(os.environ.get("UPLOAD_TMP_MAX_AGE", 60 * 60))
+    UPLOAD_TMP_SWEEP_INTERVAL = int(os.environ.get(
+        "UPLOAD_TMP_SWEEP_INTERVAL", 10 * 60))
+    # Seconds a request may take to finalize an upload before another one can claim it
+    CHUNKED_UPLOAD_FINALIZE_TIMEOUT = int(os.environ.get(
+        "CHUNKED_UPLOAD_FINALIZE_TIMEOUT", 60))
+
+    # Background post-processing of uploads (thumbnails, metadata, EXIF stripping)
+    UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", 2))
+    UPLOAD_JOB_TTL = int(os.environ.get("UPLOAD_JOB_TTL", 24 * 60 * 60))
+
+    # Serving of raw image files
+    USE_X_SENDFILE = os.environ.get(
+        "USE_X_SENDFILE", "false").lower() == "true"
+    IMAGE_MAX_AGE = int(os.environ.get("IMAGE_MAX_AGE", 3600))
+
+    # Thumbnails (derivatives of uploaded images)
+    THUMBNAIL_FOLDER = os.environ.get(
+        "THUMBNAIL_FOLDER", os.path.join(MEDIA_FOLDER, 'thumbnails'))
+    THUMBNAIL_PRESETS = {
+        "small": 128,
+        "medium": 512,
+    }
+    THUMBNAIL_DEFAULT_PRESET = os.environ.get(
+        "THUMBNAIL_DEFAULT_PRESET", "small")
+    THUMBNAIL_FORMAT = os.environ.get("THUMBNAIL_FORMAT", "JPEG").upper()
+    THUMBNAIL_CACHE_MAX_BYTES = int(os.environ.get(
+        "THUMBNAIL_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+
+    # JSON responses are encoded with orjson when it is installed
+    JSON_USE_ORJSON = os.environ.get(
+        "JSON_USE_ORJSON", "true").lower() == "true"
+    # Compression of responses (brotli when installed, or gzip) negotiated from Accept-Encoding
+    COMPRESSION_MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", 1024))
+    COMPRESSION_GZIP_LEVEL = int(os.environ.get("COMPRESSION_GZIP_LEVEL", 6))
+    COMPRESSION_BROTLI_QUALITY = int(
+        os.environ.get("COMPRESSION_BROTLI_QUALITY", 4))
+    COMPRESSION_MIMETYPES = os.environ.get(
+        "COMPRESSION_MIMETYPES", "application/json,text/html,text/plain,text/csv").split(",")
+
+    # Pagination of the medicines, with the total count cached for MEDICINES_COUNT_TTL seconds
+    MEDICINES_PAGE_SIZE = int(os.environ.get("MEDICINES_PAGE_SIZE", 50))
+    MEDICINES_MAX_PAGE_SIZE = int(
+        os.environ.get("MEDICINES_MAX_PAGE_SIZE", 100))
+    MEDICINES_COUNT_TTL = int(os.environ.get("MEDICINES_COUNT_TTL", 300))
+    # Cache of the medicines pages and searches, invalidated when the catalog is reloaded
+    MEDICINES_CACHE_TTL = int(os.environ.get(
+        "MEDICINES_CACHE_TTL", 24 * 60 * 60))
+    # Pages filled by flask medicines warm-cache
+    MEDICINES_CACHE_WARM_PAGES = int(
+        os.environ.get("MEDICINES_CACHE_WARM_PAGES", 5))
+    MEDICINES_LOAD_CHUNK_SIZE = int(
+        os.environ.get("MEDICINES_LOAD_CHUNK_SIZE", 1000))
+    # Cache stampede protection: longest wait for the request computing a missing entry, and
+    # how early hot entries get refreshed (XFetch beta, 0 disables early refreshes)
+    CACHE_LOCK_TIMEOUT = float(os.environ.get("CACHE_LOCK_TIMEOUT", 10))
+    CACHE_EARLY_REFRESH_BETA = float(
+        os.environ.get("CACHE_EARLY_REFRESH_BETA", 1.0))
+    # Cached medical histories, invalidated by every write to them
+    MEDICAL_HISTORY_CACHE_TTL = int(os.environ.get(
+        "MEDICAL_HISTORY_CACHE_TTL", 60 * 60))
+    # Incremental sync of the medical history: changes per call, and seconds of changes sent
+    # again on the next sync in case rows were committed late with an earlier last_update
+    MEDICAL_HISTORY_SYNC_PAGE_SIZE = int(
+        os.environ.get("MEDICAL_HISTORY_SYNC_PAGE_SIZE", 100))
+    MEDICAL_HISTORY_SYNC_MAX_PAGE_SIZE = int(
+        os.environ.get("MEDICAL_HISTORY_SYNC_MAX_PAGE_SIZE", 500))
+    MEDICAL_HISTORY_SYNC_OVERLAP = int(
+        os.environ.get("MEDICAL_HISTORY_SYNC_OVERLAP", 5))
+    # Medical history records read per query when exporting a patient's history
+    EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", 100))
+    # Shortest word in the medicines FULLTEXT index (MySQL innodb_ft_min_token_size)
+    MEDICINES_SEARCH_MIN_TOKEN = int(
+        os.environ.get("MEDICINES_SEARCH_MIN_TOKEN", 3))
+
+    # Pagination of the user images
+    IMAGES_PAGE_SIZE = int(os.environ.get("IMAGES_PAGE_SIZE", 20))
+    IMAGES_MAX_PAGE_SIZE = int(os.environ.get("IMAGES_MAX_PAGE_SIZE", 100))
+
     REDIS_CLIENT = redis.StrictRedis(
         host='redis_sessions', port=6379, decode_responses=True, db=0)
     REDIS_JWT_CLIENT = redis.StrictRedis(
         host='redis_sessions', port=6379, db=1, decode_responses=True)
 
+    # Password hashing, done in a pool of processes
+    BCRYPT_LOG_ROUNDS = int(os.environ.get("BCRYPT_LOG_ROUNDS", 12))
+    PASSWORD_HASH_WORKERS = int(os.environ.get(
+        "PASSWORD_HASH_WORKERS", os.cpu_count() or 1))
+    PASSWORD_HASH_QUEUE_DEPTH = int(os.environ.get(
+        "PASSWORD_HASH_QUEUE_DEPTH", 4 * PASSWORD_HASH_WORKERS))
+
+    # Cache of the users authenticated by token_required
+    AUTH_CACHE_TTL = int(os.environ.get("AUTH_CACHE_TTL", 30))
+    AUTH_CACHE_SIZE = int(os.environ.get("AUTH_CACHE_SIZE", 4096))
+    AUTH_CACHE_REDIS = os.environ.get(
+        "AUTH_CACHE_REDIS", "true").lower() == "true"
+    AUTH_CACHE_REDIS_TTL = int(os.environ.get("AUTH_CACHE_REDIS_TTL", 300))
+
+    # Flask-Caching: bounded LRU per worker in front of a Redis shared by all of them
     CACHE_CONFIG = {
         "DEBUG": True,          # some Flask specific configs
-        "CACHE_TYPE": "SimpleCache",  # Flask-Caching related configs
-        "CACHE_DEFAULT_TIMEOUT": 300
+        "CACHE_TYPE": os.environ.get("CACHE_TYPE", "genesis_api.tools.cache.TwoTierCache"),
+        "CACHE_DEFAULT_TIMEOUT": 300,
+        "CACHE_KEY_PREFIX": "flask_cache:",
+        "CACHE_REDIS_HOST": os.environ.get("CACHE_REDIS_HOST", "redis_sessions"),
+        "CACHE_REDIS_PORT": int(os.environ.get("CACHE_REDIS_PORT", 6379)),
+        "CACHE_REDIS_DB": int(os.environ.get("CACHE_REDIS_DB", 2)),
+        "CACHE_LOCAL_MAXSIZE": int(os.environ.get("CACHE_LOCAL_MAXSIZE", 1024)),
+        "CACHE_LOCAL_TTL": int(os.environ.get("CACHE_LOCAL_TTL", 5)),
     }
 
-    # check if the folder exists
+    # check if the folders exist
     if not os.path.exists(UPLOAD_FOLDER):
         os.makedirs(UPLOAD_FOLDER)
+    if not os.path.exists(IMAGE_STORE_FOLDER):
+        os.makedirs(IMAGE_STORE_FOLDER)
+    if not os.path.exists(UPLOAD_TMP_FOLDER):
+        os.makedirs(UPLOAD_TMP_FOLDER)
+    if not os.path.exists(THUMBNAIL_FOLDER):
+        os.makedirs(THUMBNAIL_FOLDER)
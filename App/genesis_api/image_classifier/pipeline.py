@@ -0,0 +1,286 @@
+# Standard library imports
+import os
+import json
+import uuid
+import hashlib
+import logging
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Optional
+
+# Third-party library imports
+from flask import current_app
+from PIL import Image as PILImage, ImageOps
+from redis.exceptions import RedisError
+
+# Local imports
+from genesis_api import db
+from genesis_api.config import Config
+from genesis_api.models import Image, UserImage, User
+from genesis_api.image_classifier.utils import (
+    content_file_path,
+    delete_image_files,
+    get_thumbnail,
+    image_file_path,
+)
+
+# Post-processing runs here so the upload request only has to write the file and the rows
+executor = ThreadPoolExecutor(
+    Config.UPLOAD_WORKERS, thread_name_prefix='upload_pipeline')
+
+
+def submit_upload_job(user_image: UserImage) -> str:
+    """
+    Queue the post-processing of an uploaded image.
+
+    :return: The ID of the job, to poll its status with get_upload_job.
+    """
+    job_id = uuid.uuid4().hex
+    job = {
+        'id': job_id,
+        'status': 'queued',
+        'user_id': user_image.user_id,
+        'user_image_id': user_image.id,
+        'image_id': user_image.image_id,
+        'creation_date': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+    }
+    _save_job(job_id, job)
+
+    app = current_app._get_current_object()
+    # The job is handed over as is, the thread does not depend on reading it back from Redis
+    executor.submit(_run_upload_job, app, dict(job))
+    return job_id
+
+
+def get_upload_job(user: User, job_id: str) -> Optional[dict]:
+    """ Status of an upload job, None if it does not exist or belongs to another user """
+    job = _load_job(job_id)
+    if not job or job['user_id'] != user.id:
+        return None
+    return job
+
+
+def _job_key(job_id: str) -> str:
+    return f'upload_job:{job_id}'
+
+
+def _save_job(job_id: str, job: dict) -> None:
+    # The status lives in Redis so any worker can answer the status endpoint
+    try:
+        Config.REDIS_CLIENT.set(_job_key(job_id), json.dumps(
+            job), ex=Config.UPLOAD_JOB_TTL)
+    except RedisError as e:
+        logging.error("Could not save upload job %s: %s", job_id, e)
+
+
+def _load_job(job_id: str) -> Optional[dict]:
+    job = Config.REDIS_CLIENT.get(_job_key(job_id))
+    return json.loads(job) if job else None
+
+
+def _run_upload_job(app, job: dict) -> None:
+    job_id = job['id']
+    with app.app_context():
+        # Nothing may escape: exceptions raised in the executor thread are never seen,
+        # and the job would stay queued
+        try:
+            job['status'] = 'running'
+            _save_job(job_id, job)
+
+            user_image = UserImage.query.get(job['user_image_id'])
+            # Stripped first: the files of other jobs on the same Image only change while they strip
+            strip_image_metadata(user_image.image)
+            # The file may now belong to another Image
+            db.session.refresh(user_image)
+            image = user_image.image
+            job['image_id'] = image.id
+            job['metadata'] = extract_image_metadata(image)
+            job['thumbnails'] = {preset: os.path.basename(get_thumbnail(image, preset))
+                                 for preset in Config.THUMBNAIL_PRESETS}
+            job['status'] = 'done'
+        except Exception as e:
+            db.session.rollback()
+            logging.exception(
+                "An error occurred while processing upload job %s: %s", job_id, e)
+            job['status'] = 'failed'
+            job['error'] = str(e)
+        finally:
+            db.session.remove()
+
+        job['last_update'] = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        _save_job(job_id, job)
+
+
+def extract_image_metadata(image: Image) -> dict:
+    """ Format, dimensions and EXIF presence of an image file """
+    with PILImage.open(image_file_path(image)) as img:
+        width, height = ImageOps.exif_transpose(img).size
+        return {
+            'format': img.format,
+            'mode': img.mode,
+            'width': width,
+            'height': height,
+            'has_exif': bool(img.getexif()),
+            'size_bytes': os.path.getsize(image_file_path(image)),
+        }
+
+
+# JPEG segments holding metadata: APP1 (EXIF, XMP), APP13 (IPTC) and comments
+_JPEG_METADATA_MARKERS = {0xE1, 0xED, 0xFE}
+# PNG chunks holding metadata: EXIF, text and modification time
+_PNG_METADATA_CHUNKS = {b'eXIf', b'tEXt', b'zTXt', b'iTXt', b'tIME'}
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+_EXIF_ORIENTATION = 0x0112
+
+
+def strip_image_metadata(image: Image) -> Image:
+    """
+    Remove the metadata (GPS position, device, ...) of a JPEG or PNG file without re-encoding it:
+    the metadata segments are dropped and the pixel data is copied byte for byte. Only the
+    EXIF orientation is kept, so the image is still displayed the right way up.
+    Other formats are left untouched, their thumbnails are written without metadata anyway.
+
+    The result is stored under its own content hash; if that content is already stored,
+    the UserImage records are moved to the existing Image and this one is released.
+
+    :return: The Image the file now belongs to.
+    """
+    # Locked and reloaded, so jobs of the same file run one after the other and each sees
+    # the path and status left by the previous one
+    image = Image.query.filter_by(id=image.id).with_for_update().populate_existing().one()
+    if not image.status:
+        # Merged into another Image by a concurrent job
+        db.session.rollback()
+        return image
+
+    image_path = image_file_path(image)
+    with PILImage.open(image_path) as img:
+        image_format = img.format
+        exif = img.getexif()
+        # PNG text and time chunks are not all reported by Pillow, every PNG goes through the filter
+        if image_format not in ('JPEG', 'PNG') or (
+                image_format == 'JPEG' and not exif and not img.info.keys() & {'comment', 'xmp', 'photoshop'}):
+            db.session.rollback()
+            return image
+        orientation = exif.get(_EXIF_ORIENTATION, 1)
+
+    with open(image_path, 'rb') as image_file:
+        data = image_file.read()
+    if image_format == 'JPEG':
+        stripped = _strip_jpeg_metadata(data, orientation)
+    else:
+        stripped = _strip_png_metadata(data, orientation)
+    if stripped == data:
+        db.session.rollback()
+        return image
+
+    digest = hashlib.sha256(stripped).hexdigest()
+    existing_image = Image.query.filter_by(content_hash=digest).first()
+    if existing_image and existing_image.id != image.id:
+        # Same content already stored: share its file. The references are counted from the
+        # stored row, which the lock keeps uploads of the old content from changing meanwhile
+        ref_count = db.session.query(Image.ref_count).filter(Image.id == image.id).scalar()
+        UserImage.query.filter_by(image_id=image.id).update(
+            {UserImage.image_id: existing_image.id})
+        Image.query.filter_by(id=existing_image.id).update(
+            {Image.ref_count: Image.ref_count + ref_count, Image.status: True})
+        image.ref_count = 0
+        image.status = False
+        db.session.commit()
+        delete_image_files(image)
+        return existing_image
+
+    extension = os.path.splitext(image_path)[1].lstrip('.')
+    new_path = content_file_path(digest, extension)
+    temporary_path = os.path.join(
+        Config.UPLOAD_TMP_FOLDER, f'{uuid.uuid4().hex}.part')
+    try:
+        with open(temporary_path, 'wb') as stripped_file:
+            stripped_file.write(stripped)
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        os.replace(temporary_path, new_path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+    # Thumbnails were made from the same pixels, only the original file changes
+    image.path = new_path
+    image.content_hash = digest
+    try:
+        db.session.commit()
+    except Exception:
+        # The row still points to the previous file
+        os.remove(new_path)
+        raise
+    if os.path.abspath(new_path) != image_path:
+        os.remove(image_path)
+    return image
+
+
+def _orientation_exif(orientation: int) -> bytes:
+    """ TIFF data of an EXIF block holding only the orientation, without the Exif header """
+    exif = PILImage.Exif()
+    exif[_EXIF_ORIENTATION] = orientation
+    return exif.tobytes()[len(b'Exif\x00\x00'):]
+
+
+def _strip_jpeg_metadata(data: bytes, orientation: int) -> bytes:
+    """ JPEG file without its metadata segments, the compressed image data is copied as is """
+    if data[:2] != b'\xff\xd8':
+        raise ValueError('Not a JPEG file')
+
+    segments = []
+    position = 2
+    while position < len(data):
+        if data[position] != 0xFF:
+            raise ValueError('Corrupted JPEG file')
+        marker = data[position + 1]
+        if marker == 0xFF:
+            # Fill byte
+            position += 1
+            continue
+        if marker == 0xDA:
+            # Start of scan: the rest is image data
+            segments.append(data[position:])
+            break
+        if 0xD0 <= marker <= 0xD7 or marker == 0x01:
+            # Markers without a length
+            segments.append(data[position:position + 2])
+            position += 2
+            continue
+        end = position + 2 + int.from_bytes(data[position + 2:position + 4], 'big')
+        if marker not in _JPEG_METADATA_MARKERS:
+            segments.append(data[position:end])
+        position = end
+
+    if orientation != 1:
+        payload = b'Exif\x00\x00' + _orientation_exif(orientation)
+        exif_segment = b'\xff\xe1' + (len(payload) + 2).to_bytes(2, 'big') + payload
+        # After the JFIF header if there is one, which must come first
+        index = 1 if segments and segments[0][:2] == b'\xff\xe0' else 0
+        segments.insert(index, exif_segment)
+    return b'\xff\xd8' + b''.join(segments)
+
+
+def _strip_png_metadata(data: bytes, orientation: int) -> bytes:
+    """ PNG file without its metadata chunks, the image data chunks are copied as is """
+    if data[:8] != _PNG_SIGNATURE:
+        raise ValueError('Not a PNG file')
+
+    chunks = []
+    position = 8
+    while position < len(data):
+        length = int.from_bytes(data[position:position + 4], 'big')
+        chunk_type = data[position + 4:position + 8]
+        end = position + 12 + length
+        if chunk_type not in _PNG_METADATA_CHUNKS:
+            chunks.append(data[position:end])
+        if chunk_type == b'IHDR' and orientation != 1:
+            exif = _orientation_exif(orientation)
+            chunks.append(len(exif).to_bytes(4, 'big') + b'eXIf' + exif +
+                          zlib.crc32(b'eXIf' + exif).to_bytes(4, 'big'))
+        position = end
+        if chunk_type == b'IEND':
+            break
+    return _PNG_SIGNATURE + b''.join(chunks)
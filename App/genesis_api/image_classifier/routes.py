@@ -1,12 +1,17 @@
-from flask import Blueprint
+from flask import Blueprint, send_file, make_response
 from sqlalchemy.orm import sessionmaker
 from genesis_api.tools.handlers import *
 from genesis_api.image_classifier.utils import *
-from genesis_api.tools.utils import generate_response
+from genesis_api.image_classifier.pipeline import submit_upload_job, get_upload_job
+from genesis_api.tools.utils import parse_request, generate_response, get_page_size, etag_conditional
 from genesis_api.security import *
+from genesis_api.tools.routing import read_only
+from genesis_api.tools.responses import skip_compression
 from genesis_api import limiter, cache
+import os
 import re
 import json
+import click
 
 
 image_classifier = Blueprint('image_classifier', __name__)
@@ -31,6 +36,7 @@ def upload_image_endpoint(current_user: User) -> dict[str:str]:
         # print all the elements of the form
 
         # assuming the ImmutableMultiDict is stored in a variable called data
+        diagnostic_dict = []
         diagnostic = request.form.get('diagnostic')
         if diagnostic:
             try:
@@ -49,19 +55,122 @@ def upload_image_endpoint(current_user: User) -> dict[str:str]:
         if not current_user:
             return generate_response(False, 'User not found', None, 404), 404
 
-        # Save the image and create a UserImage record
-        user_image = save_image(current_user, file)
-        for prediction in diagnostic_dict:
-            create_mldiagnostic(prediction.get('sickness'),
-                                prediction.get('precision'), user_image.id)
+        # Save the image and create the UserImage and MlDiagnostic records in one transaction
+        user_image = save_image(current_user, file, diagnostic_dict)
 
-        return generate_response(True, 'Image successfully uploaded', user_image.to_dict(), 201), 201
+        # Thumbnails, metadata extraction and EXIF stripping happen in the background
+        user_image_data = user_image.to_dict()
+        user_image_data['job_id'] = submit_upload_job(user_image)
+
+        return generate_response(True, 'Image successfully uploaded', user_image_data, 201), 201
     else:
         return generate_response(False, 'File type not allowed', None, 400), 400
 
 
+@image_classifier.route('/upload_image/init', methods=['POST'])
+@token_required
+@limiter.limit("15 per minute")
+def init_chunked_upload_endpoint(current_user: User) -> dict[str:str]:
+    '''Start a resumable upload of an image sent in chunks'''
+    fields = {"filename": str, "size": int}
+    required_fields = ["filename", "size"]
+
+    try:
+        args = parse_request(fields, 'json', required_fields)
+        upload = create_chunked_upload(current_user, **args)
+        return generate_response(True, 'Upload started', upload, 201), 201
+    except TooManyUploadsError as e:
+        return generate_response(False, 'Too many uploads in progress', None, 429, str(e)), 429
+    except InvalidRequestParameters as e:
+        return generate_response(False, 'Invalid request parameters', None, 400, str(e)), 400
+    except Exception as e:
+        return generate_response(False, 'Could not start upload', None, 500, str(e)), 500
+
+
+@image_classifier.route('/upload_image/<upload_id>', methods=['GET'])
+@token_required
+def get_chunked_upload_endpoint(current_user: User, upload_id: str) -> dict[str:str]:
+    '''Offset where a resumable upload must continue'''
+    try:
+        upload = get_chunked_upload(current_user, upload_id)
+        return generate_response(True, 'Upload retrieved', upload, 200), 200
+    except ElementNotFoundError as e:
+        return generate_response(False, 'Upload not found', None, 404, str(e)), 404
+    except Exception as e:
+        return generate_response(False, 'Could not retrieve upload', None, 500, str(e)), 500
+
+
+@image_classifier.route('/upload_image/<upload_id>', methods=['PUT'])
+@token_required
+def put_upload_chunk_endpoint(current_user: User, upload_id: str) -> dict[str:str]:
+    '''Append the raw request body to a resumable upload, at ?offset='''
+    try:
+        offset = request.args.get('offset', type=int)
+        if offset is None:
+            raise InvalidRequestParameters('offset is required')
+        if request.content_length and request.content_length > Config.CHUNKED_UPLOAD_CHUNK_SIZE:
+            raise InvalidRequestParameters(
+                f'Chunks must not be larger than {Config.CHUNKED_UPLOAD_CHUNK_SIZE} bytes')
+
+        upload = append_upload_chunk(
+            current_user, upload_id, offset, request.stream)
+        return generate_response(True, 'Chunk received', upload, 200), 200
+    except UploadOffsetMismatchError as e:
+        return generate_response(False, 'Wrong offset', {'offset': e.offset}, 409, str(e)), 409
+    except InvalidRequestParameters as e:
+        return generate_response(False, 'Invalid request parameters', None, 400, str(e)), 400
+    except ElementNotFoundError as e:
+        return generate_response(False, 'Upload not found', None, 404, str(e)), 404
+    except Exception as e:
+        return generate_response(False, 'Could not save chunk', None, 500, str(e)), 500
+
+
+@image_classifier.route('/upload_image/<upload_id>/finalize', methods=['POST'])
+@token_required
+def finalize_chunked_upload_endpoint(current_user: User, upload_id: str) -> dict[str:str]:
+    '''Create the image of a complete resumable upload'''
+    try:
+        # The diagnostic list is optional, so the body may be empty
+        body = request.get_json(silent=True) or {}
+        diagnostic = body.get('diagnostic') or []
+        if not isinstance(diagnostic, list):
+            raise InvalidRequestParameters('diagnostic must be a list')
+
+        user_image = finalize_chunked_upload(
+            current_user, upload_id, diagnostic)
+
+        user_image_data = user_image.to_dict()
+        user_image_data['job_id'] = submit_upload_job(user_image)
+        return generate_response(True, 'Image successfully uploaded', user_image_data, 201), 201
+    except UploadOffsetMismatchError as e:
+        return generate_response(False, 'Upload incomplete', {'offset': e.offset}, 409, str(e)), 409
+    except UploadFinalizingError as e:
+        return generate_response(False, 'Upload being finalized', None, 409, str(e)), 409
+    except InvalidRequestParameters as e:
+        return generate_response(False, 'Invalid request parameters', None, 400, str(e)), 400
+    except ElementNotFoundError as e:
+        return generate_response(False, 'Upload not found', None, 404, str(e)), 404
+    except Exception as e:
+        return generate_response(False, 'Could not finalize upload', None, 500, str(e)), 500
+
+
+@image_classifier.route('/upload_jobs/<job_id>', methods=['GET'])
+@token_required
+def get_upload_job_endpoint(current_user: User, job_id: str) -> dict[str:str]:
+    '''Status of the background processing of an upload'''
+    try:
+        job = get_upload_job(current_user, job_id)
+        if not job:
+            return generate_response(False, 'Upload job not found', None, 404), 404
+        return generate_response(True, 'Upload job retrieved', job, 200), 200
+    except Exception as e:
+        return generate_response(False, 'Could not retrieve upload job', None, 500, str(e)), 500
+
+
 @image_classifier.route('/get_user_images', methods=['GET'])
+@skip_compression
 @token_required
+@read_only
 def get_user_images_endpoint(current_user: User) -> dict[str:str]:
     try:
         # Retrieve the user
@@ -69,33 +178,128 @@ def get_user_images_endpoint(current_user: User) -> dict[str:str]:
             return generate_response(False, 'User not found', None, 404), 404
 
         # Return the image data
-        return generate_response(True, 'Image data successfully retrieved', {'images': get_user_images_data(current_user)}, 200)
+        size = request.args.get('size', Config.THUMBNAIL_DEFAULT_PRESET)
+        limit = get_page_size(Config.IMAGES_PAGE_SIZE,
+                              Config.IMAGES_MAX_PAGE_SIZE)
+        images, next_cursor = get_user_images_data(
+            current_user, size, request.args.get('cursor'), limit)
+        return generate_response(True, 'Image data successfully retrieved', {'images': images, 'next_cursor': next_cursor}, 200)
+    except InvalidRequestParameters as e:
+        return generate_response(False, 'Invalid request parameters', None, 400, str(e)), 400
     except Exception as e:
         return generate_response(False, str(e), None, 500), 500
 
 
 @image_classifier.route('/get_image/<image_id>', methods=['GET'])
+@skip_compression
 @token_required
 @limiter.limit("15 per minute")
+@etag_conditional(lambda current_user, image_id: user_image_etag(current_user, image_id, 'base64'))
 def get_user_image_by_id_endpoint(current_user: User, image_id: int) -> dict[str:str]:
+    # Compatibility mode: the image is inlined as base64 in the JSON body.
+    # New clients should use /get_image/<image_id>/raw and /get_image/<image_id>/metadata
     # Retrieve the user
     if not current_user:
         return generate_response(False, 'User not found', None, 404), 404
-    return generate_response(True, 'Image successfully retrieved', get_user_image(current_user, image_id), 200)
+    image_data = get_user_image(current_user, image_id)
+    if not image_data:
+        return generate_response(False, 'Image not found', None, 404), 404
+    return generate_response(True, 'Image successfully retrieved', image_data, 200)
+
+
+@image_classifier.route('/get_image/<int:image_id>/raw', methods=['GET'])
+@token_required
+@limiter.limit("120 per minute")
+def get_user_image_raw_endpoint(current_user: User, image_id: int):
+    '''Stream the image bytes straight from the upload folder'''
+    image = get_user_image_record(current_user, image_id)
+    if not image:
+        return generate_response(False, 'Image not found', None, 404), 404
+
+    # Optional ?size=<preset> to get a thumbnail instead of the original
+    size = request.args.get('size', 'original')
+    if size == 'original':
+        etag = image_etag(image)
+    elif size in Config.THUMBNAIL_PRESETS:
+        etag = image_etag(
+            image, f'{size}-{Config.THUMBNAIL_FORMAT.lower()}')
+    else:
+        return generate_response(False, 'Invalid request parameters', None, 400, f'Unknown image size: {size}'), 400
+
+    if etag is not None and request.if_none_match.contains_weak(etag):
+        # The client already has this file: do not touch the disk at all
+        response = make_response('', 304)
+        response.set_etag(etag)
+        response.cache_control.max_age = Config.IMAGE_MAX_AGE
+    else:
+        image_path = image_file_path(image)
+        if not os.path.isfile(image_path):
+            return generate_response(False, 'Image file not found', None, 404), 404
+        if size != 'original':
+            image_path = get_thumbnail(image, size)
+
+        # send_file hands the open file to the WSGI server's file_wrapper, which
+        # uses sendfile(2) when available (or X-Sendfile when USE_X_SENDFILE is set)
+        response = send_file(image_path, conditional=True, etag=etag or True,
+                             max_age=Config.IMAGE_MAX_AGE)
+
+    # Medical images must never be stored by shared caches
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+
+@image_classifier.route('/get_image/<int:image_id>/metadata', methods=['GET'])
+@token_required
+@etag_conditional(lambda current_user, image_id: user_image_etag(current_user, image_id, 'metadata'))
+def get_user_image_metadata_endpoint(current_user: User, image_id: int) -> dict[str:str]:
+    '''Image record and ML diagnostics, without the image bytes'''
+    try:
+        image_info = get_image_metadata(current_user, image_id)
+        if not image_info:
+            return generate_response(False, 'Image not found', None, 404), 404
+        return generate_response(True, 'Image data successfully retrieved', image_info, 200), 200
+    except Exception as e:
+        return generate_response(False, 'Could not retrieve image data', None, 500, str(e)), 500
+
+
+@image_classifier.route('/delete_image/<int:image_id>', methods=['DELETE'])
+@token_required
+def delete_user_image_endpoint(current_user: User, image_id: int) -> dict[str:str]:
+    try:
+        delete_user_image(current_user, image_id)
+        return generate_response(True, 'Image successfully deleted', None, 200), 200
+    except ElementNotFoundError as e:
+        return generate_response(False, 'Image not found', None, 404, str(e)), 404
+    except InvalidRequestParameters as e:
+        return generate_response(False, 'Invalid request parameters', None, 400, str(e)), 400
+    except Exception as e:
+        return generate_response(False, 'Could not delete image', None, 500, str(e)), 500
 
 
 @image_classifier.route('/get_user_images_data', methods=['GET'])
+@skip_compression
 @token_required
+@read_only
 @limiter.limit("15 per minute")
 def get_user_image_endpoint(current_user: User) -> dict[str:str]:
     # Retrieve the user
     if not current_user:
         return generate_response(False, 'User not found', None, 404), 404
-    return generate_response(True, 'Image successfully retrieved', {'images': get_user_images_data(current_user)}, 200)
+    try:
+        size = request.args.get('size', Config.THUMBNAIL_DEFAULT_PRESET)
+        limit = get_page_size(Config.IMAGES_PAGE_SIZE,
+                              Config.IMAGES_MAX_PAGE_SIZE)
+        images, next_cursor = get_user_images_data(
+            current_user, size, request.args.get('cursor'), limit)
+        return generate_response(True, 'Image successfully retrieved', {'images': images, 'next_cursor': next_cursor}, 200)
+    except InvalidRequestParameters as e:
+        return generate_response(False, 'Invalid request parameters', None, 400, str(e)), 400
 
 
 @image_classifier.route('/get_doctor_patient_files/<patient_id>', methods=['GET'])
 @token_required
+@read_only
 def get_doctor_patient_files_endpoint(current_user: User, patient_id) -> dict[str:str]:
     try:
         files = get_doctor_patient_files(current_user.id, patient_id)
@@ -104,3 +308,10 @@ def get_doctor_patient_files_endpoint(current_user: User, patient_id) -> dict[st
         return generate_response(False, 'Could not get files', None, 500, str(e)), 500
     finally:
         session.close()
+
+
+@image_classifier.cli.command('sweep-uploads')
+def sweep_upload_files_command():
+    '''Delete the temporary files of abandoned uploads now: flask image_classifier sweep-uploads'''
+    removed = sweep_upload_files(force=True)
+    click.echo(f'{removed} temporary upload files deleted')
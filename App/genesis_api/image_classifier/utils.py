@@ -1,12 +1,23 @@
 # Standard library imports
 import os
+import json
+import uuid
+import fcntl
+import hashlib
 import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
 from typing import Optional
 
 # Third-party library imports
 import base64
 from flask import send_from_directory
-from sqlalchemy.exc import SQLAlchemyError
+from redis.exceptions import RedisError
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
+from sqlalchemy import select, insert, or_, text
+from sqlalchemy.orm import joinedload, selectinload, contains_eager
 from werkzeug.utils import secure_filename
 
 # Local imports
@@ -17,36 +28,387 @@ from genesis_api.tools.utils import *
 from genesis_api.tools.handlers import *
 
 
-def save_image(user, image_file):
-    # Define the image directory
+def save_image(user, image_file, predictions: Optional[list[dict]] = None):
+    """
+    Save an uploaded file in the content-addressed store and create its UserImage record,
+    along with the ML diagnostics in predictions, in a single transaction.
+    """
+    filename = upload_filename(image_file.filename)
+    temporary_path, digest = write_temporary_file(image_file.stream)
+    return store_image(user, temporary_path, digest, filename, predictions)
+
+
+def write_temporary_file(stream) -> tuple[str, str]:
+    """
+    Copy a stream to a new file in Config.UPLOAD_TMP_FOLDER, hashing it on the way.
+
+    :return: The path of the temporary file and the SHA-256 hex digest of its content.
+    """
+    digest = hashlib.sha256()
+    temporary_path = os.path.join(
+        Config.UPLOAD_TMP_FOLDER, f'{uuid.uuid4().hex}.part')
+
     try:
-        image_directory = Config.UPLOAD_FOLDER
+        with open(temporary_path, 'wb') as temporary_file:
+            while True:
+                chunk = stream.read(Config.UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                temporary_file.write(chunk)
+    except Exception:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
 
-        # Save the image to the directory
-        filename = secure_filename(image_file.filename)
-        image_path = os.path.join(image_directory, filename)
-        image_file.save(image_path)
+    return temporary_path, digest.hexdigest()
 
-        # Create a new Image record
-        new_image = Image(path=image_path, name=filename)
 
-        # Add the new image to the database
-        db.session.add(new_image)
-        db.session.commit()
+# Running SHA-256 of the chunked uploads received by this process: upload_id -> (offset, hash)
+_chunked_upload_digests = OrderedDict()
+_chunked_upload_lock = threading.Lock()
+
+
+def _chunked_upload_key(upload_id: str) -> str:
+    return f'chunked_upload:{upload_id}'
+
+
+def _chunked_upload_user_key(user_id: int) -> str:
+    # Sorted set of the user's open uploads, scored by the time their state expires
+    return f'chunked_upload:user:{user_id}'
+
+
+def _chunked_upload_finalize_key(upload_id: str) -> str:
+    return f'chunked_upload:{upload_id}:finalize'
+
+
+def _chunked_upload_path(upload_id: str) -> str:
+    return os.path.join(Config.UPLOAD_TMP_FOLDER, f'{upload_id}.part')
+
+
+def create_chunked_upload(user: User, filename: str, size: int) -> dict:
+    """
+    Start a resumable upload. The file is then sent in chunks with append_upload_chunk
+    and turned into an image with finalize_chunked_upload.
+
+    :param filename: Name of the image file, used for its extension.
+    :param size: Total size of the file in bytes.
+    :raise TooManyUploadsError: If the user already has CHUNKED_UPLOAD_MAX_OPEN uploads in progress.
+    """
+    if not allowed_file(filename):
+        raise InvalidRequestParameters('File type not allowed')
+    if size <= 0 or size > Config.CHUNKED_UPLOAD_MAX_SIZE:
+        raise InvalidRequestParameters(
+            f'size must be between 1 and {Config.CHUNKED_UPLOAD_MAX_SIZE} bytes')
+
+    try:
+        sweep_upload_files()
+    except (RedisError, OSError) as e:
+        logging.error(f'Could not sweep the temporary uploads: {e}')
+
+    upload_id = uuid.uuid4().hex
+    # Counted after being added, so concurrent requests cannot all pass the check
+    user_key, now = _chunked_upload_user_key(user.id), time.time()
+    with Config.REDIS_CLIENT.pipeline() as pipeline:
+        pipeline.zremrangebyscore(user_key, '-inf', now)
+        pipeline.zadd(user_key, {upload_id: now + Config.CHUNKED_UPLOAD_TTL})
+        pipeline.expire(user_key, Config.CHUNKED_UPLOAD_TTL)
+        pipeline.zcard(user_key)
+        open_uploads = pipeline.execute()[-1]
+    if open_uploads > Config.CHUNKED_UPLOAD_MAX_OPEN:
+        Config.REDIS_CLIENT.zrem(user_key, upload_id)
+        raise TooManyUploadsError(
+            f'No more than {Config.CHUNKED_UPLOAD_MAX_OPEN} uploads can be in progress at once')
+
+    upload = {
+        'id': upload_id,
+        'user_id': user.id,
+        'filename': upload_filename(filename),
+        'size': size,
+    }
+    open(_chunked_upload_path(upload_id), 'wb').close()
+    Config.REDIS_CLIENT.set(_chunked_upload_key(upload_id), json.dumps(upload),
+                            ex=Config.CHUNKED_UPLOAD_TTL)
+
+    with _chunked_upload_lock:
+        _chunked_upload_digests[upload_id] = (0, hashlib.sha256())
+
+    upload['offset'] = 0
+    upload['chunk_size'] = Config.CHUNKED_UPLOAD_CHUNK_SIZE
+    return upload
+
+
+def get_chunked_upload(user: User, upload_id: str) -> dict:
+    """ State of a resumable upload, with the offset where the next chunk must start """
+    upload = Config.REDIS_CLIENT.get(_chunked_upload_key(upload_id))
+    upload = json.loads(upload) if upload else None
+    if not upload or upload['user_id'] != user.id or not os.path.exists(_chunked_upload_path(upload_id)):
+        raise ElementNotFoundError('Upload not found')
+
+    upload['offset'] = os.path.getsize(_chunked_upload_path(upload_id))
+    upload['chunk_size'] = Config.CHUNKED_UPLOAD_CHUNK_SIZE
+    return upload
+
+
+def append_upload_chunk(user: User, upload_id: str, offset: int, stream) -> dict:
+    """
+    Append a chunk to a resumable upload, writing it straight to the temporary file.
+
+    :param offset: Where the chunk starts in the file, it must be the current size of the upload.
+    :param stream: The request body.
+    :raise UploadOffsetMismatchError: If offset is not where the upload currently ends.
+    """
+    upload = get_chunked_upload(user, upload_id)
+
+    with open(_chunked_upload_path(upload_id), 'ab') as upload_file:
+        # Serialize the writers of the same upload, whatever the worker
+        fcntl.flock(upload_file, fcntl.LOCK_EX)
+        current_offset = os.fstat(upload_file.fileno()).st_size
+        if offset != current_offset:
+            raise UploadOffsetMismatchError(
+                f'Chunk starts at {offset} but the upload is at {current_offset}', current_offset)
+
+        with _chunked_upload_lock:
+            hash_offset, digest = _chunked_upload_digests.pop(
+                upload_id, (None, None))
+        if hash_offset != current_offset:
+            # The previous chunks went to another process, hash the file when finalizing
+            digest = None
+
+        written = 0
+        while True:
+            chunk = stream.read(Config.UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            written += len(chunk)
+            if current_offset + written > upload['size']:
+                upload_file.truncate(current_offset)
+                raise InvalidRequestParameters(
+                    f'The upload is larger than the announced {upload["size"]} bytes')
+            upload_file.write(chunk)
+            if digest is not None:
+                digest.update(chunk)
+
+        if digest is not None:
+            with _chunked_upload_lock:
+                _chunked_upload_digests[upload_id] = (
+                    current_offset + written, digest)
+                # Forget abandoned uploads
+                while len(_chunked_upload_digests) > 1024:
+                    _chunked_upload_digests.popitem(last=False)
+
+    upload['offset'] = current_offset + written
+    return upload
+
+
+def finalize_chunked_upload(user: User, upload_id: str, predictions: Optional[list[dict]] = None) -> UserImage:
+    """
+    Turn a complete resumable upload into an image, like save_image does for a regular upload.
+    A single request at a time can finalize an upload. If storing the image fails, the upload
+    is kept so the request can be retried.
+
+    :raise UploadFinalizingError: If another request is finalizing the upload.
+    """
+    # Claimed before anything is read, so concurrent requests cannot both create the image
+    lock_key, token = _chunked_upload_finalize_key(upload_id), uuid.uuid4().hex
+    if not Config.REDIS_CLIENT.set(lock_key, token, nx=True, ex=Config.CHUNKED_UPLOAD_FINALIZE_TIMEOUT):
+        raise UploadFinalizingError('The upload is already being finalized')
+
+    try:
+        # Raises ElementNotFoundError if a request finalized it while this one waited for the lock
+        upload = get_chunked_upload(user, upload_id)
+        if upload['offset'] != upload['size']:
+            raise UploadOffsetMismatchError(
+                f'The upload is incomplete: {upload["offset"]} of {upload["size"]} bytes', upload['offset'])
+
+        temporary_path = _chunked_upload_path(upload_id)
+        with _chunked_upload_lock:
+            hash_offset, digest = _chunked_upload_digests.pop(
+                upload_id, (None, None))
+        if hash_offset == upload['size']:
+            digest = digest.hexdigest()
+        else:
+            with open(temporary_path, 'rb') as upload_file:
+                digest = hashlib.file_digest(upload_file, 'sha256').hexdigest()
+
+        user_image = store_image(user, temporary_path, digest, upload['filename'], predictions,
+                                 keep_on_error=True)
+        with Config.REDIS_CLIENT.pipeline() as pipeline:
+            pipeline.delete(_chunked_upload_key(upload_id))
+            pipeline.zrem(_chunked_upload_user_key(user.id), upload_id)
+            pipeline.execute()
+        return user_image
+    finally:
+        release_redis_lock(lock_key, token)
+
+
+def sweep_upload_files(force: bool = False) -> int:
+    """
+    Delete the temporary files left in UPLOAD_TMP_FOLDER: chunked uploads whose state expired,
+    and files of failed requests. Files written to in the last UPLOAD_TMP_MAX_AGE seconds are kept.
+    Runs at most once every UPLOAD_TMP_SWEEP_INTERVAL seconds across the workers, unless forced.
+
+    :return: The number of files deleted.
+    """
+    if not force and not Config.REDIS_CLIENT.set('chunked_upload:sweep', 1, nx=True,
+                                                 ex=Config.UPLOAD_TMP_SWEEP_INTERVAL):
+        return 0
+
+    cutoff = time.time() - Config.UPLOAD_TMP_MAX_AGE
+    removed = 0
+    with os.scandir(Config.UPLOAD_TMP_FOLDER) as iterator:
+        for entry in iterator:
+            if not entry.is_file() or not entry.name.endswith('.part'):
+                continue
+            try:
+                if entry.stat().st_mtime > cutoff:
+                    continue
+            except FileNotFoundError:
+                continue
+            # A chunked upload can be resumed until its state expires
+            if Config.REDIS_CLIENT.exists(_chunked_upload_key(entry.name[:-len('.part')])):
+                continue
+            try:
+                os.remove(entry.path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
+
+
+def content_file_path(digest: str, extension: str) -> str:
+    """ Path of a file in the content-addressed store: IMAGE_STORE_FOLDER/ab/cd/<digest>.<extension> """
+    return os.path.join(Config.IMAGE_STORE_FOLDER, digest[:2], digest[2:4], f'{digest}.{extension}')
+
+
+def store_image(user, temporary_path: str, digest: str, filename: str,
+                predictions: Optional[list[dict]] = None, keep_on_error: bool = False) -> UserImage:
+    """
+    Move a temporary file to the content-addressed store and create the UserImage record
+    and its ML diagnostics in a single transaction.
+    Identical files are stored once: their Image record is shared and its ref_count increased.
+
+    :param predictions: List of {'sickness': str, 'precision': float} from the classifier.
+    :param keep_on_error: Leave the temporary file in place if the records cannot be created,
+        so the caller can try again.
+    """
+    committed = False
+    try:
+        image = Image.query.filter_by(content_hash=digest).first()
+        if image is None:
+            extension = filename.rsplit('.', 1)[1].lower()
+            image = Image(path=content_file_path(digest, extension), name=filename,
+                          content_hash=digest, ref_count=1)
+            db.session.add(image)
+            try:
+                db.session.flush()
+            except IntegrityError:
+                # The same file was stored concurrently by another request
+                db.session.rollback()
+                image = Image.query.filter_by(content_hash=digest).one()
+                _increase_ref_count(image)
+        else:
+            _increase_ref_count(image)
 
         # Create a new UserImage record
-        user_image = UserImage(user_id=user.id, image_id=new_image.id)
+        user_image = UserImage(user_id=user.id, image_id=image.id)
 
         # Add the new UserImage to the database
         db.session.add(user_image)
+        db.session.flush()
+
+        create_mldiagnostics(predictions or [], user_image.id)
         db.session.commit()
+        committed = True
+
+        # The file only moves to the store once the records exist, so a failed commit
+        # leaves nothing behind. It may already be there, or deleted when the last
+        # reference was released
+        image_path = image_file_path(image)
+        if not os.path.exists(image_path):
+            os.makedirs(os.path.dirname(image_path), exist_ok=True)
+            os.replace(temporary_path, image_path)
     except SQLAlchemyError as e:
+        db.session.rollback()
         logging.exception("An error occurred while saving an image: %s", e)
         raise InternalServerError(e)
+    finally:
+        if (committed or not keep_on_error) and os.path.exists(temporary_path):
+            os.remove(temporary_path)
 
     return user_image
 
 
+def _increase_ref_count(image: Image) -> None:
+    # Increment in SQL so concurrent uploads of the same file do not lose updates
+    Image.query.filter_by(id=image.id).update(
+        {Image.ref_count: Image.ref_count + 1, Image.status: True})
+
+
+def delete_user_image(user: User, image_id: int) -> None:
+    """
+    Delete one of the user's own images, releasing its reference to the shared Image record.
+    The file and its thumbnails are deleted once no other UserImage uses it.
+    Images attached to a medical history are part of the record and cannot be deleted.
+    """
+    user_image = UserImage.query.\
+        options(joinedload(UserImage.image)).\
+        filter_by(user_id=user.id, image_id=image_id, status=True).\
+        first()
+    if not user_image:
+        raise ElementNotFoundError('Image not found')
+    if user_image.medical_histories:
+        raise InvalidRequestParameters(
+            'The image is part of a medical history and cannot be deleted')
+
+    image = user_image.image
+    try:
+        user_image.status = False
+        release_image(image)
+        db.session.commit()
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        logging.exception("An error occurred while deleting an image: %s", e)
+        raise InternalServerError(e)
+
+    # Files are only deleted once the commit succeeded, and if no upload reused them since
+    db.session.refresh(image)
+    if image.ref_count <= 0:
+        delete_image_files(image)
+
+
+def release_image(image: Image) -> None:
+    """
+    Drop one reference to an Image, deactivating it once nothing uses it.
+    The caller deactivates the UserImage, commits, and then deletes the files if ref_count is 0.
+    """
+    Image.query.filter_by(id=image.id).update(
+        {Image.ref_count: Image.ref_count - 1})
+    db.session.refresh(image)
+
+    if image.ref_count <= 0:
+        image.status = False
+
+
+def delete_image_files(image: Image) -> None:
+    """ Delete the file of an Image and its cached thumbnails """
+    for path in [image_file_path(image)] + [thumbnail_file_path(image, preset) for preset in Config.THUMBNAIL_PRESETS]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def upload_filename(filename: str) -> str:
+    """
+    Safe name for an uploaded file accepted by allowed_file. secure_filename drops non-ASCII
+    characters, so e.g. '日本.jpg' becomes 'jpg': such names get a generic one with the extension.
+    """
+    extension = filename.rsplit('.', 1)[1].lower()
+    secure_name = secure_filename(filename)
+    if not secure_name.lower().endswith(f'.{extension}'):
+        secure_name = f'image.{extension}'
+    return secure_name
+
+
 def allowed_file(filename: str) -> bool:
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -55,7 +417,7 @@ def allowed_file(filename: str) -> bool:
 def get_image(user: User, image_id: int):
     # Retrieve the UserImage record
     user_image = UserImage.query.filter_by(
-        user_id=user.id, image_id=image_id).first()
+        user_id=user.id, image_id=image_id, status=True).first()
 
     if not user_image:
         return None, 'Image not found'
@@ -67,89 +429,264 @@ def get_image(user: User, image_id: int):
         return None, 'Image not found'
 
     # Encode the image to base64
-    with open(os.path.join(Config.UPLOAD_FOLDER, image.name), "rb") as img_file:
+    with open(image_file_path(image), "rb") as img_file:
         encoded_string = base64.b64encode(img_file.read()).decode('utf-8')
 
     return encoded_string, None
 
 
-def get_image_data(id: int) -> dict[str:str]:
-    # Retrieve the Image record
+def accessible_user_images(user: User):
+    """ UserImage query restricted to the user's own images and the ones of their patients """
+    patient_ids = select(DoctorPatientAssociation.patient_id).\
+        where(DoctorPatientAssociation.doctor_id == user.id)
 
-    try:
+    return UserImage.query.filter(
+        UserImage.status == True,
+        or_(UserImage.user_id == user.id, UserImage.user_id.in_(patient_ids))
+    )
 
-        return Image.get_data(id)
-    except Exception as e:
-        logging.error(e)
+
+def get_user_image_record(user: User, image_id: int) -> Optional[Image]:
+    """ Get the Image record with image_id if the user can access it """
+    user_image = accessible_user_images(user).\
+        options(joinedload(UserImage.image)).\
+        filter(UserImage.image_id == image_id).\
+        first()
+
+    if not user_image or not user_image.image or not user_image.image.status:
+        return None
+
+    return user_image.image
+
+
+def image_file_path(image: Image) -> str:
+    """ Absolute path of the file backing an Image record """
+    if image.content_hash is None:
+        # Stored before content addressing, directly in the upload folder
+        return os.path.abspath(os.path.join(Config.UPLOAD_FOLDER, image.name))
+    return os.path.abspath(image.path)
+
+
+def image_etag(image: Image, variant: str = 'original') -> Optional[str]:
+    """
+    Strong ETag of a representation of an image, derived from its content hash.
+    Images stored before content addressing have no content hash and get None.
+    """
+    if image.content_hash is None:
         return None
+    if variant == 'original':
+        return image.content_hash
+    return f'{image.content_hash}-{variant}'
+
+
+def user_image_etag(user: User, image_id: int, variant: str = 'original') -> Optional[str]:
+    """ ETag of a representation of an image that the user can access, None if there is none """
+    image = get_user_image_record(user, image_id)
+    return image_etag(image, variant) if image else None
+
 
+# Approximate size of the thumbnail folder, refreshed whenever it is scanned
+_thumbnail_cache_bytes = None
 
-def get_user_images_data(current_user: id) -> list[dict[str, str]]:
-    # Get all UserImage records for this user
-    user_images = UserImage.query.filter_by(user_id=current_user.id).all()
 
-    # Extract the image IDs
-    image_data = []
-    for user_image in user_images:
-        image_info = Image.get_data(user_image.image_id).to_dict()
-        image_path = os.path.join(Config.UPLOAD_FOLDER, image_info['name'])
+def thumbnail_file_path(image: Image, preset: str) -> str:
+    """ Path of the cached derivative of an image for a size preset """
+    extension = 'webp' if Config.THUMBNAIL_FORMAT == 'WEBP' else 'jpg'
+    return os.path.abspath(os.path.join(Config.THUMBNAIL_FOLDER, f'{image.id}_{preset}.{extension}'))
 
-        # Encode the resized image to base64
+
+def get_thumbnail(image: Image, preset: str) -> str:
+    """
+    Get the path of the thumbnail of an image for a size preset.
+    The thumbnail is generated and cached on disk on the first request.
+    """
+    global _thumbnail_cache_bytes
+
+    if preset not in Config.THUMBNAIL_PRESETS:
+        raise InvalidRequestParameters(f'Unknown image size: {preset}')
+
+    thumbnail_path = thumbnail_file_path(image, preset)
+    if os.path.isfile(thumbnail_path):
+        try:
+            # The modification time is used as the LRU clock for eviction
+            os.utime(thumbnail_path)
+            return thumbnail_path
+        except FileNotFoundError:
+            # Evicted by another worker in the meantime
+            pass
+
+    # Write to a temporary file first so readers never see a partial thumbnail
+    size = Config.THUMBNAIL_PRESETS[preset]
+    temporary_path = f'{thumbnail_path}.{uuid.uuid4().hex}.tmp'
+    try:
+        resize_image(image_file_path(image), (size, size),
+                     temporary_path, Config.THUMBNAIL_FORMAT)
+        os.replace(temporary_path, thumbnail_path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+    if _thumbnail_cache_bytes is not None:
+        _thumbnail_cache_bytes += os.path.getsize(thumbnail_path)
+    if _thumbnail_cache_bytes is None or _thumbnail_cache_bytes > Config.THUMBNAIL_CACHE_MAX_BYTES:
+        evict_thumbnails()
+
+    return thumbnail_path
+
+
+def evict_thumbnails(max_bytes: Optional[int] = None) -> None:
+    """
+    Delete the least recently used thumbnails until the folder is below 90% of max_bytes.
+    """
+    global _thumbnail_cache_bytes
+
+    max_bytes = Config.THUMBNAIL_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+
+    entries = []
+    total = 0
+    with os.scandir(Config.THUMBNAIL_FOLDER) as iterator:
+        for entry in iterator:
+            if not entry.is_file() or entry.name.endswith('.tmp'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+
+    if total > max_bytes:
+        # Evict a bit more than needed so we do not rescan on every new thumbnail
+        target = int(max_bytes * 0.9)
+        entries.sort()
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    _thumbnail_cache_bytes = total
+
+
+def user_image_info(user_image: UserImage, size: Optional[str] = None) -> dict[str, str]:
+    """
+    Image record of a UserImage with its ML diagnostics.
+    The user image must be loaded with its image and ml_diagnostics, see get_user_images_data.
+
+    :param size: None to leave the image bytes out, 'original' or a preset from Config.THUMBNAIL_PRESETS
+        to include them base64 encoded.
+    """
+    image = user_image.image
+    image_info = image.to_dict()
+
+    if size is not None:
+        if size == 'original':
+            image_path = image_file_path(image)
+        else:
+            image_path = get_thumbnail(image, size)
+        image_info['size'] = size
+
+        # Encode the image to base64
         with open(image_path, "rb") as img_file:
-            encoded_string = base64.b64encode(
+            image_info['image'] = base64.b64encode(
                 img_file.read()).decode('utf-8')
-        image_info['image'] = encoded_string
 
-        image_info['ml_diagnostic'] = [MlDiagnostic.get_data(
-            ml_id.id).to_dict() for ml_id in user_image.ml_diagnostics]
+    image_info['ml_diagnostic'] = [ml_diagnostic.to_dict()
+                                   for ml_diagnostic in user_image.ml_diagnostics if ml_diagnostic.status]
+    return image_info
 
-        image_data.append(image_info)
 
-    return image_data
+def get_image_metadata(user: User, image_id: int) -> Optional[dict[str, str]]:
+    """ Image record and its ML diagnostics, without the image bytes """
+    user_image = accessible_user_images(user).\
+        options(joinedload(UserImage.image), selectinload(UserImage.ml_diagnostics)).\
+        filter(UserImage.image_id == image_id).\
+        first()
 
+    if not user_image or not user_image.image or not user_image.image.status:
+        return None
 
-def get_user_image(user: User, image_id: Optional[int] = None) -> list[dict[str, str]]:
-    # Get all UserImage records for this user
-    user_images = UserImage.query.filter_by(user_id=user.id).all()
+    return user_image_info(user_image)
 
-    # Extract the image IDs
-    image_data = []
-    if not image_id:
-        for user_image in user_images:
-            image_info = Image.get_data(user_image.image_id).to_dict()
-            image_path = os.path.join(Config.UPLOAD_FOLDER, image_info['name'])
 
-            # Encode the resized image to base64
-            with open(image_path, "rb") as img_file:
-                encoded_string = base64.b64encode(
-                    img_file.read()).decode('utf-8')
-            image_info['image'] = encoded_string
+def get_image_data(id: int) -> dict[str:str]:
+    # Retrieve the Image record
 
-            image_info['ml_diagnostic'] = [MlDiagnostic.get_data(
-                ml_id.id).to_dict() for ml_id in user_image.ml_diagnostics]
+    try:
 
-            image_data.append(image_info['image'], "here")
+        return Image.get_data(id)
+    except Exception as e:
+        logging.error(e)
+        return None
 
-    else:
-        image_info = Image.get_data(image_id).to_dict()
-        image_path = os.path.join(Config.UPLOAD_FOLDER, image_info['name'])
 
-        # Resize the image to a maximum size (e.g., 300x300 pixels)
+def get_user_images_data(current_user: id, size: str = 'original', cursor: Optional[str] = None,
+                         limit: Optional[int] = None) -> tuple[list[dict[str, str]], Optional[str]]:
+    """
+    Get a page of the images of a user with their ML diagnostics, ordered by UserImage id.
+    Images and diagnostics are loaded with two queries whatever the number of images.
+
+    :param size: A preset from Config.THUMBNAIL_PRESETS, or 'original' for the full-resolution file.
+    :param cursor: The next_cursor returned with the previous page, None for the first page.
+    :param limit: Maximum number of images in the page, Config.IMAGES_PAGE_SIZE by default.
+    :return: The images of the page and the cursor of the next one (None on the last page).
+    """
+    if size != 'original' and size not in Config.THUMBNAIL_PRESETS:
+        raise InvalidRequestParameters(f'Unknown image size: {size}')
+
+    limit = limit or Config.IMAGES_PAGE_SIZE
+    after_id = 0
+    if cursor:
+        after_id = decode_cursor(cursor).get('id')
+        if not isinstance(after_id, int):
+            raise InvalidRequestParameters('Invalid cursor')
+
+    # Get the UserImage records of the page along with their Image and MlDiagnostic records.
+    # One extra row is fetched to know if there is a next page.
+    user_images = UserImage.query.\
+        join(UserImage.image).\
+        options(contains_eager(UserImage.image), selectinload(UserImage.ml_diagnostics)).\
+        filter(UserImage.user_id == current_user.id,
+               UserImage.id > after_id,
+               UserImage.status == True,
+               Image.status == True).\
+        order_by(UserImage.id).\
+        limit(limit + 1).\
+        all()
 
-        # Encode the resized image to base64
-        with open(image_path, "rb") as img_file:
-            encoded_string = base64.b64encode(img_file.read()).decode('utf-8')
-        image_info['image'] = encoded_string
+    next_cursor = None
+    if len(user_images) > limit:
+        user_images = user_images[:limit]
+        next_cursor = encode_cursor({'id': user_images[-1].id})
+
+    return [user_image_info(user_image, size) for user_image in user_images], next_cursor
+
+
+def get_user_image(user: User, image_id: Optional[int] = None) -> list[dict[str, str]]:
+    """
+    Get one image that the user can access with its ML diagnostics, or the first page of
+    the user's images if no image_id is given.
+    """
+    if not image_id:
+        images, _ = get_user_images_data(user)
+        return images
+
+    return _get_accessible_image(user, image_id)
 
-        user_image = db.session.query(UserImage).filter(
-            UserImage.image_id == image_id).first()
 
-        image_info['ml_diagnostic'] = [
-            MlDiagnostic.get_data(ml_id.id).to_dict() for ml_id in user_image.ml_diagnostics]
+def _get_accessible_image(user: User, image_id: int) -> Optional[dict[str, str]]:
+    user_image = accessible_user_images(user).\
+        options(joinedload(UserImage.image), selectinload(UserImage.ml_diagnostics)).\
+        filter(UserImage.image_id == image_id).\
+        first()
 
-        image_data = image_info
+    if not user_image or not user_image.image or not user_image.image.status:
+        return None
 
-    return image_data
+    return user_image_info(user_image, 'original')
 
 
 def get_doctor_patient_files(doctor_id: int, patient_id: int) -> list[str]:
@@ -172,19 +709,41 @@ def get_doctor_patient_files(doctor_id: int, patient_id: int) -> list[str]:
     return [image.to_dict() for image in images]
 
 
-def create_mldiagnostic(sickness, precision, user_image_id) -> MlDiagnostic:
-    # Define de ML directory
-    try:
-        ml_model = MlDiagnostic(
-            sickness=sickness, precision=precision, description="description")
-        db.session.add(ml_model)
-        db.session.commit()
-
-        # Create a new MlDiagnosticImage record
-        image = UserImage.get_data(user_image_id)
-        image.ml_diagnostics.append(ml_model)
-
-    except SQLAlchemyError as e:
-        logging.exception("An error occurred while saving an image: %s", e)
-        raise InternalServerError(e)
-    return ml_model
+def create_mldiagnostics(predictions: list[dict], user_image_id: int) -> list[int]:
+    """
+    Insert the ML diagnostics of a user image and their association rows in the current
+    transaction, with a constant number of statements. The caller is responsible for committing.
+
+    :param predictions: List of {'sickness': str, 'precision': float} from the classifier.
+    :return: The IDs of the new MlDiagnostic records.
+    """
+    if not predictions:
+        return []
+
+    now = datetime.utcnow()
+    rows = [{
+        'sickness': prediction.get('sickness'),
+        'precision': prediction.get('precision'),
+        'description': 'description',
+        'status': True,
+        'creation_date': now,
+        'last_update': now,
+    } for prediction in predictions]
+
+    connection = db.session.connection()
+    table = MlDiagnostic.__table__
+    if connection.dialect.insert_returning:
+        ml_diagnostic_ids = list(connection.execute(
+            insert(table).returning(table.c.id, sort_by_parameter_order=True), rows).scalars())
+    else:
+        # MySQL has no RETURNING. A multi-row INSERT with its rows known in advance reserves
+        # its IDs in one step, whatever innodb_autoinc_lock_mode is, and reports the first one
+        result = connection.execute(insert(table).values(rows))
+        step = connection.execute(text('SELECT @@auto_increment_increment')).scalar()
+        ml_diagnostic_ids = [result.lastrowid + index * step for index in range(len(rows))]
+
+    connection.execute(insert(user_image_ml_diagnostic_association), [
+        {'user_image': user_image_id, 'ml_diagnostic': ml_diagnostic_id}
+        for ml_diagnostic_id in ml_diagnostic_ids
+    ])
+    return ml_diagnostic_ids
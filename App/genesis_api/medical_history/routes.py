@@ -1,10 +1,12 @@
-from flask import Blueprint
+from flask import Blueprint, Response, request, stream_with_context
 from sqlalchemy.orm import sessionmaker
 from genesis_api.medical_history.utils import *
 from genesis_api.tools.handlers import *
-from genesis_api.tools.utils import parse_request, generate_response
+from genesis_api.tools.utils import parse_request, generate_response, etag_conditional, coalesced_cached, get_fields, \
+    get_page_size
 from genesis_api.image_classifier.utils import *
 from genesis_api.security import *
+from genesis_api.tools.routing import read_only, primary
 from genesis_api import db, limiter, cache
 
 medical_history = Blueprint(
@@ -35,37 +37,100 @@ def post_medical_history_endpoint(current_user: User) -> dict[str:str]:
 
 @medical_history.route('get_medical_history/<int:patient_id>', methods=['GET'])
 @token_required
+@read_only
 @limiter.limit("30 per minute")  # Apply rate limiting
-@cache.cached(timeout=300, key_prefix='medical_history')
+@etag_conditional(medical_history_etag)
+@coalesced_cached(timeout=Config.MEDICAL_HISTORY_CACHE_TTL, make_cache_key=medical_history_cache_key,
+                  response_filter=is_successful_response)
+# Cache misses are built from the primary, a lagging replica would cache stale data under the new version
+@primary
 def get_medical_history_endpoint(current_user: User, patient_id: int) -> dict[str:str]:
     try:
         # Assuming there's a function to retrieve medical history in utils
         medical_history = get_medical_history_by_patient(
-            current_user, patient_id)
+            current_user, patient_id, get_fields(MEDICAL_HISTORY_FIELDS))
         if medical_history:
             return generate_response(True, 'Medical History retrieved successfully', medical_history, 200), 200
         else:
             return generate_response(False, 'Medical History not found', None, 404), 404
+    except InvalidRequestParameters as e:
+        return generate_response(False, 'Invalid request parameters', None, 400, str(e)), 400
     except Exception as e:
         return generate_response(False, 'Could not retrieve Medical History', None, 500, str(e)), 500
 
 
 @medical_history.route('get_my_medical_history', methods=['GET'])
 @token_required
+@read_only
 @limiter.limit("30 per minute")  # Apply rate limiting
-@cache.cached(timeout=300, key_prefix='medical_history')
+@etag_conditional(medical_history_etag)
+@coalesced_cached(timeout=Config.MEDICAL_HISTORY_CACHE_TTL, make_cache_key=medical_history_cache_key,
+                  response_filter=is_successful_response)
+@primary
 def get_my_medical_history_endpoint(current_user: User) -> dict[str:str]:
     try:
         # Assuming there's a function to retrieve medical history in utils
-        medical_history = get_my_medical_history(current_user)
+        medical_history = get_my_medical_history(
+            current_user, get_fields(MEDICAL_HISTORY_FIELDS))
         if medical_history:
             return generate_response(True, 'Medical History retrieved successfully', medical_history, 200), 200
         else:
             return generate_response(False, 'Medical History not found', None, 404), 404
+    except InvalidRequestParameters as e:
+        return generate_response(False, 'Invalid request parameters', None, 400, str(e)), 400
     except Exception as e:
         return generate_response(False, 'Could not retrieve Medical History', None, 500, str(e)), 500
 
 
+@medical_history.route('export/<int:patient_id>', methods=['GET'])
+@token_required
+@limiter.limit("5 per minute")  # Apply rate limiting
+def export_medical_history_endpoint(current_user: User, patient_id: int):
+    '''
+    Stream the complete medical history of a patient as NDJSON, one record per line.
+    ?images=true streams a zip with the NDJSON and the image files instead.
+    '''
+    with_images = request.args.get('images', 'false').lower() == 'true'
+    try:
+        export = export_medical_history(current_user, patient_id, with_images)
+    except ElementNotFoundError as e:
+        return generate_response(False, 'Medical History not found', None, 404, str(e)), 404
+    except Exception as e:
+        return generate_response(False, 'Could not export Medical History', None, 500, str(e)), 500
+
+    if with_images:
+        mimetype, filename = 'application/zip', f'medical_history_{patient_id}.zip'
+    else:
+        mimetype, filename = 'application/x-ndjson', f'medical_history_{patient_id}.ndjson'
+    response = Response(stream_with_context(export), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    response.headers['Cache-Control'] = 'private, no-store'
+    return response
+
+
+@medical_history.route('sync/<int:patient_id>', methods=['GET'])
+@token_required
+@read_only
+@limiter.limit("30 per minute")  # Apply rate limiting
+def sync_medical_history_endpoint(current_user: User, patient_id: int) -> dict[str:str]:
+    '''
+    Changes to the medical history of a patient since ?token= (the token of the previous sync,
+    none for a full sync): updated records and prescriptions, and the ids of deleted ones.
+    '''
+    try:
+        limit = get_page_size(Config.MEDICAL_HISTORY_SYNC_PAGE_SIZE,
+                              Config.MEDICAL_HISTORY_SYNC_MAX_PAGE_SIZE)
+        changes = sync_medical_history(
+            current_user, patient_id, request.args.get('token'), limit)
+        return generate_response(True, 'Medical History changes retrieved successfully', changes, 200), 200
+    except InvalidRequestParameters as e:
+        return generate_response(False, 'Invalid request parameters', None, 400, str(e)), 400
+    except ElementNotFoundError as e:
+        return generate_response(False, 'Medical History not found', None, 404, str(e)), 404
+    except Exception as e:
+        return generate_response(False, 'Could not retrieve Medical History changes', None, 500, str(e)), 500
+
+
 @medical_history.route('/send_patient_feedback', methods=['PATCH'])
 @token_required
 @limiter.limit("5 per minute")  # Apply rate limiting
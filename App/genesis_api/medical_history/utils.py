@@ -1,18 +1,31 @@
 from genesis_api.models import (
     User,
     DoctorPatientAssociation,
+    Image,
     UserImage,
     MedicalHistory,
     Prescription,
-    MedicalHistory
+    MedicalHistory,
+    medical_history_prescription_association,
+    medical_history_user_image_association
 )
 from genesis_api.tools.handlers import *
 from genesis_api.tools.utils import *
 
-from sqlalchemy.orm import Session, joinedload, contains_eager
+from flask import request, current_app
+from sqlalchemy import func, select, or_, and_
+from sqlalchemy.orm import Session, joinedload, selectinload, contains_eager, load_only
 from sqlalchemy.exc import SQLAlchemyError
+from redis.exceptions import RedisError
+
+from genesis_api.config import Config
+from genesis_api.image_classifier.utils import user_image_info, image_file_path
+
+from datetime import datetime, timedelta
 
+import hashlib
 import logging
+import os
 
 
 def create_medical_history_report(user_id: int, **kwargs: dict[str, type]) -> dict[str, str]:
@@ -71,6 +84,7 @@ def create_medical_history_report(user_id: int, **kwargs: dict[str, type]) -> di
 
         db.session.add(medical_history)
         db.session.commit()
+        invalidate_medical_history(patient_id)
     except Exception as e:
         logging.exception(
             "An error occurred while creating a medical history report: %s", e)
@@ -125,40 +139,79 @@ def create_prescription(**kwargs: dict[str, type]) -> dict[str, str]:
         raise  # Re-raise the exception so the error can be handled further up the call stack
 
 
-def get_medical_history_by_patient(current_user: User, patient_id: int) -> dict:
+# Fields that can be requested with ?fields=, the columns of the records and their nested lists
+MEDICAL_HISTORY_NESTED_FIELDS = {'user_images', 'prescriptions'}
+MEDICAL_HISTORY_FIELDS = {column.name for column in MedicalHistory.__table__.columns} | \
+    MEDICAL_HISTORY_NESTED_FIELDS
+
+
+def get_medical_history_by_patient(current_user: User, patient_id: int, fields: list = None) -> dict:
     """
     Retrieve a patient's medical history from the database.
 
     :param current_user: The current user (doctor) making the request.
     :param patient_id: The ID of the patient whose medical history is being retrieved.
+    :param fields: The only fields to return (see MEDICAL_HISTORY_FIELDS), all of them if None.
+    :return: A list of dictionaries containing the medical history data, or None if no record was found.
+    """
+    return _get_medical_history([
+        DoctorPatientAssociation.doctor_id == current_user.id,
+        DoctorPatientAssociation.patient_id == patient_id
+    ], fields)
+
+
+def get_my_medical_history(current_user: User, fields: list = None) -> dict:
+    """
+    Retrieve a patient's medical history from the database.
+
+    :param current_user: The current user (patient) making the request.
+    :param fields: The only fields to return (see MEDICAL_HISTORY_FIELDS), all of them if None.
     :return: A list of dictionaries containing the medical history data, or None if no record was found.
     """
+    return _get_medical_history([
+        DoctorPatientAssociation.patient_id == current_user.id,
+    ], fields)
+
+
+def _get_medical_history(filters: list, fields: list = None) -> list[dict]:
     try:
+        columns = None
+        nested = MEDICAL_HISTORY_NESTED_FIELDS
+        options = [
+            contains_eager(MedicalHistory.association).joinedload(
+                DoctorPatientAssociation.patient)
+        ]
+        if fields:
+            columns = [field for field in fields
+                       if field not in MEDICAL_HISTORY_NESTED_FIELDS]
+            nested = MEDICAL_HISTORY_NESTED_FIELDS.intersection(fields)
+            # Only the requested columns are selected, the association is needed by the join
+            options.append(load_only(*MedicalHistory.column_attributes(columns),
+                                     MedicalHistory.association_id))
+
+        # Eager load only the nested lists that are returned
+        if 'user_images' in nested:
+            options.append(joinedload(MedicalHistory.user_images))
+        if 'prescriptions' in nested:
+            options.append(joinedload(MedicalHistory.prescriptions))
+
         # Combine queries to retrieve medical history records directly through the association
         medical_history_records = db.session.query(MedicalHistory)\
             .join(DoctorPatientAssociation, DoctorPatientAssociation.id == MedicalHistory.association_id)\
-            .filter(
-                DoctorPatientAssociation.doctor_id == current_user.id,
-                DoctorPatientAssociation.patient_id == patient_id
-        )\
-            .options(
-                contains_eager(MedicalHistory.association).joinedload(
-                    DoctorPatientAssociation.patient),
-                # Eager load user images
-                joinedload(MedicalHistory.user_images),
-                # Eager load prescriptions
-                joinedload(MedicalHistory.prescriptions),
-        )\
+            .filter(*filters)\
+            .options(*options)\
             .all()
 
         if medical_history_records:
             medical_history_data = []
             for record in medical_history_records:
-                record_dict = record.to_dict()
-                if record.user_images:  # Only add if there are user images
+                record_dict = record.to_dict(columns)
+                # Only add if there are user images
+                if 'user_images' in nested and record.user_images:
                     record_dict['user_images'] = [image.to_dict()
                                                   for image in record.user_images]
-                if record.prescriptions:  # Only add if there are prescriptions
+                # Only add if there are prescriptions
+                if 'prescriptions' in nested and record.prescriptions:
                     record_dict['prescriptions'] = [
                         prescription.to_dict() for prescription in record.prescriptions]
                 medical_history_data.append(record_dict)
@@ -173,51 +226,291 @@ def get_medical_history_by_patient(current_user: User, patient_id: int) -> dict:
         return None
 
 
-def get_my_medical_history(current_user: User) -> dict:
+def export_medical_history(current_user: User, patient_id: int, with_images: bool = False):
     """
-    Retrieve a patient's medical history from the database.
+    Export the complete medical history of a patient: records with their prescriptions, images
+    and ML diagnostics, one JSON object per line (NDJSON).
 
-    :param current_user: The current user (doctor) making the request.
-    :param patient_id: The ID of the patient whose medical history is being retrieved.
-    :return: A list of dictionaries containing the medical history data, or None if no record was found.
+    Records are read in keyset batches of Config.EXPORT_BATCH_SIZE, serialized and released
+    before the next batch, so memory stays constant whatever the length of the history.
+
+    :param current_user: The doctor of the patient, or the patient themselves.
+    :param patient_id: The ID of the patient whose medical history is exported.
+    :param with_images: Export a zip with the NDJSON as medical_history.ndjson and the image
+        files under images/, referenced by the 'file' of each image.
+    :return: A generator of the bytes of the export.
     """
-    try:
-        # Combine queries to retrieve medical history records directly through the association
-        medical_history_records = db.session.query(MedicalHistory)\
+    filters = _patient_history_filters(current_user, patient_id)
+    if not with_images:
+        return _export_medical_history_lines(filters, False, {})
+    return stream_zip(_export_medical_history_entries(filters))
+
+
+def _patient_history_filters(current_user: User, patient_id: int) -> list:
+    """Filters of the medical history of a patient seen by their doctor, or by the patient themselves"""
+    if current_user.id == patient_id:
+        return [DoctorPatientAssociation.patient_id == patient_id]
+
+    association = db.session.query(DoctorPatientAssociation).filter_by(
+        doctor_id=current_user.id, patient_id=patient_id).first()
+    if not association:
+        raise ElementNotFoundError('Doctor-Patient association not found')
+    return [DoctorPatientAssociation.doctor_id == current_user.id,
+            DoctorPatientAssociation.patient_id == patient_id]
+
+
+def _export_medical_history_entries(filters: list):
+    exported = {}
+    yield 'medical_history.ndjson', _export_medical_history_lines(filters, True, exported), True
+    # Only the images of the records exported above, records added since then are left out
+    yield from _export_image_files(filters, exported.get('last_id', 0))
+
+
+def _export_medical_history_lines(filters: list, with_images: bool, exported: dict):
+    after_id = 0
+    while True:
+        records = db.session.query(MedicalHistory)\
             .join(DoctorPatientAssociation, DoctorPatientAssociation.id == MedicalHistory.association_id)\
-            .filter(
-                DoctorPatientAssociation.patient_id == current_user.id,
-        )\
+            .filter(*filters, MedicalHistory.id > after_id)\
             .options(
-                contains_eager(MedicalHistory.association).joinedload(
-                    DoctorPatientAssociation.patient),
-                # Eager load user images
-                joinedload(MedicalHistory.user_images),
-                # Eager load prescriptions
-                joinedload(MedicalHistory.prescriptions),
+                selectinload(MedicalHistory.prescriptions),
+                selectinload(MedicalHistory.user_images).options(
+                    joinedload(UserImage.image), selectinload(UserImage.ml_diagnostics)),
         )\
+            .order_by(MedicalHistory.id)\
+            .limit(Config.EXPORT_BATCH_SIZE)\
             .all()
+        if not records:
+            return
+
+        lines = []
+        for record in records:
+            record_dict = record.to_dict()
+            record_dict['prescriptions'] = [prescription.to_dict()
+                                            for prescription in record.prescriptions]
+            record_dict['user_images'] = []
+            for user_image in record.user_images:
+                image_info = user_image_info(user_image)
+                if with_images and user_image.image.status:
+                    image_info['file'] = _export_image_name(user_image.image)
+                record_dict['user_images'].append(image_info)
+            lines.append(current_app.json.dumps(record_dict) + '\n')
+
+        after_id = exported['last_id'] = records[-1].id
+        # Give the connection back to the pool and drop the batch while the client downloads it
+        db.session.close()
+        yield ''.join(lines).encode('utf-8')
+
+
+def _export_image_files(filters: list, last_id: int):
+    """Zip entries of the image files of the medical history records up to last_id"""
+    after_id = 0
+    while True:
+        images = db.session.query(Image)\
+            .join(UserImage, UserImage.image_id == Image.id)\
+            .join(medical_history_user_image_association,
+                  medical_history_user_image_association.c.user_image_id == UserImage.id)\
+            .join(MedicalHistory, MedicalHistory.id == medical_history_user_image_association.c.medical_history_id)\
+            .join(DoctorPatientAssociation, DoctorPatientAssociation.id == MedicalHistory.association_id)\
+            .filter(*filters, MedicalHistory.id <= last_id, Image.id > after_id, Image.status == True)\
+            .distinct()\
+            .order_by(Image.id)\
+            .limit(Config.EXPORT_BATCH_SIZE)\
+            .all()
+        if not images:
+            return
 
-        if medical_history_records:
-            medical_history_data = []
-            for record in medical_history_records:
-                record_dict = record.to_dict()
-                if record.user_images:  # Only add if there are user images
-                    record_dict['user_images'] = [image.to_dict()
-                                                  for image in record.user_images]
-                if record.prescriptions:  # Only add if there are prescriptions
-                    record_dict['prescriptions'] = [
-                        prescription.to_dict() for prescription in record.prescriptions]
-                medical_history_data.append(record_dict)
+        files = [(_export_image_name(image), image_file_path(image))
+                 for image in images]
+        after_id = images[-1].id
+        db.session.close()
+        for name, path in files:
+            if not os.path.isfile(path):
+                logging.error(f'Missing image file {path}, left out of the export')
+                continue
+            yield name, file_chunks(path), False
 
-            return medical_history_data
-        else:
-            return None
 
-    except Exception as e:
-        logging.exception(
-            "An error occurred while retrieving medical history: %s", e)
+def _export_image_name(image: Image) -> str:
+    return f'images/{image.id}{os.path.splitext(image.name)[1].lower()}'
+
+
+def sync_medical_history(current_user: User, patient_id: int, token: str = None, limit: int = None) -> dict:
+    """
+    Changes to the medical history of a patient since a sync token: the records and prescriptions
+    created or updated since then, and the ids of the ones deleted (status False) as tombstones.
+
+    Rows are read in (last_update, id) order, up to limit of each kind per call. The returned
+    token is passed to the next call, right away while has_more is True or on the next sync.
+    The token of the last page starts Config.MEDICAL_HISTORY_SYNC_OVERLAP seconds before the
+    latest change, so rows committed late with an earlier last_update are not missed: clients
+    apply the rows by id, and may receive a recent row again.
+
+    :param current_user: The doctor of the patient, or the patient themselves.
+    :param patient_id: The ID of the patient whose medical history is synced.
+    :param token: The token returned by the previous sync, None for a full sync.
+    :param limit: Maximum number of records, and of prescriptions, returned.
+    :return: The changes and the next token.
+    """
+    filters = _patient_history_filters(current_user, patient_id)
+    limit = limit or Config.MEDICAL_HISTORY_SYNC_PAGE_SIZE
+    watermarks = decode_cursor(token) if token else {}
+
+    records, deleted_records, records_mark, more_records = _sync_changes(
+        MedicalHistory, db.session.query(MedicalHistory)
+        .join(DoctorPatientAssociation, DoctorPatientAssociation.id == MedicalHistory.association_id)
+        .options(selectinload(MedicalHistory.user_images),
+                 selectinload(MedicalHistory.prescriptions).load_only(Prescription.id))
+        .filter(*filters),
+        watermarks.get('medical_history'), limit)
+
+    prescriptions, deleted_prescriptions, prescriptions_mark, more_prescriptions = _sync_changes(
+        Prescription, db.session.query(Prescription)
+        .join(medical_history_prescription_association,
+              medical_history_prescription_association.c.prescription_id == Prescription.id)
+        .join(MedicalHistory, MedicalHistory.id == medical_history_prescription_association.c.medical_history_id)
+        .join(DoctorPatientAssociation, DoctorPatientAssociation.id == MedicalHistory.association_id)
+        .filter(*filters)
+        .distinct(),
+        watermarks.get('prescriptions'), limit)
+
+    medical_history_data = []
+    for record in records:
+        record_dict = record.to_dict()
+        record_dict['user_images'] = [image.to_dict()
+                                      for image in record.user_images]
+        record_dict['prescription_ids'] = [
+            prescription.id for prescription in record.prescriptions]
+        medical_history_data.append(record_dict)
+
+    return {
+        'medical_history': medical_history_data,
+        'deleted_medical_history': deleted_records,
+        'prescriptions': [prescription.to_dict() for prescription in prescriptions],
+        'deleted_prescriptions': deleted_prescriptions,
+        'has_more': more_records or more_prescriptions,
+        'token': encode_cursor({'medical_history': records_mark, 'prescriptions': prescriptions_mark}),
+    }
+
+
+def _sync_changes(model, query, watermark, limit: int) -> tuple[list, list, list, bool]:
+    """
+    Rows of a query changed after a watermark ([last_update, id] or None), as
+    (changed rows, ids of deleted rows, next watermark, whether more rows changed).
+    """
+    if watermark is not None:
+        # Tokens come from clients, anything but a [last_update, id] pair is rejected
+        if not isinstance(watermark, list) or len(watermark) != 2:
+            raise InvalidRequestParameters('Invalid sync token')
+        try:
+            last_update, row_id = datetime.fromisoformat(
+                watermark[0]), int(watermark[1])
+        except (TypeError, ValueError):
+            raise InvalidRequestParameters('Invalid sync token')
+        query = query.filter(or_(model.last_update > last_update,
+                                 and_(model.last_update == last_update, model.id > row_id)))
+
+    # One extra row is fetched to know if there are more changes
+    rows = query.order_by(model.last_update, model.id).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if not rows:
+        return [], [], watermark, False
+
+    last = rows[-1]
+    if has_more:
+        next_watermark = [last.last_update.isoformat(), last.id]
+    else:
+        # Caught up: the next sync starts again a little before the latest change
+        overlap = last.last_update - \
+            timedelta(seconds=Config.MEDICAL_HISTORY_SYNC_OVERLAP)
+        next_watermark = [overlap.isoformat(), 0]
+
+    changed = [row for row in rows if row.status]
+    deleted = [row.id for row in rows if not row.status]
+    return changed, deleted, next_watermark, has_more
+
+
+def medical_history_etag(current_user: User, patient_id: int = None) -> str:
+    """
+    Compute the ETag of a medical history from the number of records and their latest update,
+    with a single aggregate query instead of loading the records.
+
+    :param current_user: The doctor making the request, or the patient if patient_id is None.
+    :param patient_id: The ID of the patient whose medical history is requested by the doctor.
+    :return: A strong ETag for the medical history seen by current_user.
+    """
+    query = select(
+        func.count(func.distinct(MedicalHistory.id)),
+        func.max(MedicalHistory.last_update),
+        func.max(Prescription.last_update)
+    )\
+        .join(DoctorPatientAssociation, DoctorPatientAssociation.id == MedicalHistory.association_id)\
+        .outerjoin(medical_history_prescription_association,
+                   medical_history_prescription_association.c.medical_history_id == MedicalHistory.id)\
+        .outerjoin(Prescription, Prescription.id == medical_history_prescription_association.c.prescription_id)
+
+    if patient_id is None:
+        query = query.where(
+            DoctorPatientAssociation.patient_id == current_user.id)
+    else:
+        query = query.where(
+            DoctorPatientAssociation.doctor_id == current_user.id,
+            DoctorPatientAssociation.patient_id == patient_id
+        )
+
+    count, last_history_update, last_prescription_update = db.session.execute(
+        query).one()
+    version = f'{current_user.id}:{patient_id}:{count}:{last_history_update}:{last_prescription_update}:' \
+        f'{_requested_fields()}'
+    return hashlib.sha1(version.encode('utf-8')).hexdigest()
+
+
+def medical_history_cache_key(current_user: User, patient_id: int = None) -> str:
+    """
+    Cache key of the medical history seen by a user, for cache.cached(make_cache_key=...).
+
+    Keys include the version of the patient's medical history, which every write increments
+    through invalidate_medical_history, so cached entries never outlive a change.
+
+    :param current_user: The doctor making the request, or the patient if patient_id is None.
+    :param patient_id: The ID of the patient whose medical history is requested by the doctor.
+    :return: The cache key of the (user, patient) pair at the current version, or None to skip the
+        cache when the version cannot be read.
+    """
+    patient = current_user.id if patient_id is None else patient_id
+    try:
+        version = Config.REDIS_CLIENT.get(_medical_history_version_key(patient)) or 0
+    except RedisError as e:
+        # Without the version the cached entry could predate a change
+        logging.error(f'Could not read the medical history version of patient {patient}: {e}')
         return None
+    return f'medical_history:{current_user.id}:{"me" if patient_id is None else patient_id}:v{version}' \
+        f':{_requested_fields()}'
+
+
+def invalidate_medical_history(patient_id: int) -> None:
+    """Invalidate the cached medical history of a patient, for the patient and all their doctors"""
+    try:
+        Config.REDIS_CLIENT.incr(_medical_history_version_key(patient_id))
+    except RedisError as e:
+        logging.error(
+            f'Could not invalidate the medical history of patient {patient_id}: {e}')
+
+
+def _requested_fields() -> str:
+    """Normalized ?fields= of the request, so projections get their own ETag and cache entry"""
+    fields = request.args.get('fields', '')
+    return ','.join(sorted({field.strip() for field in fields.split(',') if field.strip()}))
+
+
+def _medical_history_version_key(patient_id: int) -> str:
+    return f'medical_history:version:{patient_id}'
+
+
+def is_successful_response(response) -> bool:
+    """Only cache successful responses, for cache.cached(response_filter=...)"""
+    return isinstance(response, tuple) and response[1] == 200
 
 
 def send_patient_feedback(patient_id: int, feedback: str, medical_history_id: int) -> None:
@@ -244,6 +537,7 @@ def send_patient_feedback(patient_id: int, feedback: str, medical_history_id: in
         # in the existent medical history report, add the feedback
         medical_history.patient_feedback = feedback
         db.session.commit()
+        invalidate_medical_history(patient_id)
 
         # print updated medical history report
 
@@ -283,6 +577,7 @@ def update_appointment(current_user: User, appointmentDate: str, medical_history
         # Update the appointment date
         medical_history.next_appointment_date = appointmentDate
         db.session.commit()
+        invalidate_medical_history(current_user.id)
 
     except SQLAlchemyError as e:
         logging.exception("An error occurred while updating the appointment: %s", e)
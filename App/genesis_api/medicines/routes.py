@@ -2,11 +2,14 @@ from flask import request
 from flask import Blueprint
 from genesis_api.medicines.utils import *
 from genesis_api.tools.handlers import *
-from genesis_api.tools.utils import parse_request, generate_response
+from genesis_api.tools.utils import parse_request, generate_response, get_page_size, get_fields
 from genesis_api.image_classifier.utils import *
 from genesis_api.security import *
+from genesis_api.tools.routing import read_only
 from genesis_api import db, limiter, cache
 
+import click
+
 medicines_endpoint = Blueprint('medicines', __name__, url_prefix='/medicines')
 
 
@@ -14,17 +17,67 @@ medicines_endpoint = Blueprint('medicines', __name__, url_prefix='/medicines')
 @medicines_endpoint.route('/get_all/<int:page>', defaults={'per_page': 100}, methods=['GET'])
 @medicines_endpoint.route('/get_all/<int:page>/<int:per_page>', methods=['GET'])
 @token_required
+@read_only
 @limiter.limit("30 per minute")  # Apply rate limiting
 def get_medicines_endpoint(current_user, page=1, per_page=100) -> dict[str:str]:
     try:
         # Retrieve the search term from query parameters
         search_term = request.args.get('search', type=str)
 
+        fields = get_fields(MEDICINE_FIELDS)
+
         # Call the modified get_all_medicines function with pagination and search term
-        medicines = get_all_medicines(page, per_page, search_term)
+        medicines = get_all_medicines(page, per_page, search_term, fields)
         if medicines:
             return generate_response(True, 'Medical History retrieved successfully', medicines, 200), 200
         else:
             return generate_response(False, 'Medical History not found', None, 404), 404
+    except InvalidRequestParameters as e:
+        return generate_response(False, 'Invalid request parameters', None, 400, str(e)), 400
     except Exception as e:
         return generate_response(False, 'Could not retrieve Medical History', None, 500, str(e)), 500
+
+
+@medicines_endpoint.route('/list', methods=['GET'])
+@token_required
+@read_only
+@limiter.limit("60 per minute")  # Apply rate limiting
+def list_medicines_endpoint(current_user) -> dict[str:str]:
+    '''
+    Page of medicines for infinite scrolling
+    ?search: optional search term
+    ?cursor: next_cursor of the previous page
+    ?limit: page size, capped at Config.MEDICINES_MAX_PAGE_SIZE
+    ?with_total=true: also return the number of matching medicines
+    ?fields: comma separated columns to return (id is always included)
+    '''
+    try:
+        limit = get_page_size(Config.MEDICINES_PAGE_SIZE,
+                              Config.MEDICINES_MAX_PAGE_SIZE)
+        with_total = request.args.get('with_total', 'false').lower() == 'true'
+        medicines, next_cursor, total = list_medicines(
+            request.args.get('search', type=str), request.args.get('cursor'), limit, with_total,
+            get_fields(MEDICINE_FIELDS))
+        return generate_response(True, 'Medicines retrieved successfully',
+                                 {'medicines': medicines, 'next_cursor': next_cursor, 'total': total}, 200), 200
+    except InvalidRequestParameters as e:
+        return generate_response(False, 'Invalid request parameters', None, 400, str(e)), 400
+    except Exception as e:
+        return generate_response(False, 'Could not retrieve medicines', None, 500, str(e)), 500
+
+
+@medicines_endpoint.cli.command('load-csv')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--chunk-size', type=int, default=None, help='Rows per executemany')
+def load_medicines_csv_command(path, chunk_size):
+    '''Refresh the medicines catalog from a CSV file: flask medicines load-csv <path>'''
+    loaded = load_medicines_csv(path, chunk_size)
+    click.echo(f'{loaded} medicines loaded, cache invalidated')
+
+
+@medicines_endpoint.cli.command('warm-cache')
+@click.option('--pages', type=int, default=None, help='Pages to fill, MEDICINES_CACHE_WARM_PAGES by default')
+def warm_medicines_cache_command(pages):
+    '''Fill the medicines cache with the first pages of the catalog: flask medicines warm-cache'''
+    warmed = warm_medicines_cache(pages)
+    click.echo(f'{warmed} medicines pages cached')
@@ -2,13 +2,26 @@ from genesis_api.models import Medicines
 from genesis_api.tools.handlers import *
 from genesis_api.tools.utils import *
 from genesis_api import db
-from sqlalchemy.orm import Session, joinedload, contains_eager
+from genesis_api.config import Config
+from sqlalchemy.orm import Session, joinedload, contains_eager, load_only
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy import and_, func, or_
+from sqlalchemy.dialects.mysql import insert as mysql_insert, match
+from redis.exceptions import RedisError
+from datetime import datetime
 
+import csv
+import hashlib
+import json
 import logging
+import re
 
 
-def get_all_medicines(page=1, per_page=100, search_term=None):
+# Fields that can be requested with ?fields=
+MEDICINE_FIELDS = {column.name for column in Medicines.__table__.columns}
+
+
+def get_all_medicines(page=1, per_page=100, search_term=None, fields=None):
     """
     Get all medicines from the database with pagination and optional search.
 
@@ -16,27 +29,313 @@ def get_all_medicines(page=1, per_page=100, search_term=None):
         page (int): The page number.
         per_page (int): The number of items per page.
         search_term (str, optional): The search term for filtering medicines. Default is None.
+        fields (list, optional): The only columns to select and return. Default is None (all of them).
 
     Returns:
         list: A list containing medicines for the specified page and search criteria.
     """
     try:
-        query = Medicines.query
-        if search_term:
-            # Adjust the field to match against if necessary
-            query = query.filter(
-                Medicines.short_composition2.like(f'%{search_term}%'))
-
-        paginated_query = query.paginate(
-            page=page, per_page=per_page, error_out=False)
-        medicines = paginated_query.items
+        search_term = normalize_search_term(search_term)
+        per_page = min(per_page, Config.MEDICINES_MAX_PAGE_SIZE)
+        medicines = cached_medicines(('page', search_term, page, per_page, fields),
+                                     lambda: _get_medicines_page(page, per_page, search_term, fields))
         if not medicines:
             raise ElementNotFoundError('Medicines not found')
 
-        return [medicine.to_dict() for medicine in medicines]
+        return medicines
     except SQLAlchemyError as e:
         logging.error(e)
         raise e
     except Exception as e:
         logging.error(e)
         raise e
+
+
+def _get_medicines_page(page: int, per_page: int, search_term: str, fields: list = None) -> list[dict]:
+    query = Medicines.query
+    if fields:
+        query = query.options(load_only(*Medicines.column_attributes(fields)))
+    if search_term:
+        query = search_medicines(query, search_term)
+
+    # No COUNT(*), the total is not returned
+    paginated_query = query.paginate(
+        page=page, per_page=per_page, error_out=False, count=False)
+    return [medicine.to_dict(fields) for medicine in paginated_query.items]
+
+
+def list_medicines(search_term=None, cursor=None, limit=None, with_total=False, fields=None):
+    """
+    Get a page of medicines with keyset pagination, so every page costs the same whatever its depth.
+
+    Medicines are ordered by id, or like search_medicines when searching. The cursor holds the
+    sort values of the last medicine of the previous page.
+
+    Args:
+        search_term (str, optional): The search term for filtering medicines. Default is None.
+        cursor (str, optional): The next_cursor returned with the previous page, None for the first page.
+        limit (int, optional): Maximum number of medicines in the page, Config.MEDICINES_PAGE_SIZE by default.
+        with_total (bool): Also count the matching medicines, cached for Config.MEDICINES_COUNT_TTL seconds.
+        fields (list, optional): The only columns to select and return, id included. Default is None (all of them).
+
+    Returns:
+        tuple: The medicines of the page, the cursor of the next one (None on the last page)
+        and the total (None unless with_total).
+    """
+    search_term = normalize_search_term(search_term)
+    limit = min(limit or Config.MEDICINES_PAGE_SIZE,
+                Config.MEDICINES_MAX_PAGE_SIZE)
+    medicines, next_cursor = cached_medicines(('list', search_term, cursor, limit, fields),
+                                              lambda: _list_medicines_page(search_term, cursor, limit, fields))
+
+    total = count_medicines(search_term) if with_total else None
+    return medicines, next_cursor, total
+
+
+def _list_medicines_page(search_term: str, cursor: str, limit: int, fields: list = None) -> tuple[list[dict], str]:
+    criterion, sort_key, descending = _medicines_ordering(search_term)
+
+    # Raw rows serialized by Medicines.to_dicts, the sort key being the last column
+    query = Medicines.select_columns(fields).add_columns(
+        sort_key.label('sort_key'))
+    if criterion is not None:
+        query = query.where(criterion)
+    if cursor:
+        query = query.where(_after_cursor(
+            sort_key, descending, decode_cursor(cursor)))
+
+    # One extra row is fetched to know if there is a next page
+    rows = db.session.execute(
+        query.order_by(sort_key.desc() if descending else sort_key, Medicines.id).
+        limit(limit + 1)
+    ).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(
+            {'key': rows[-1].sort_key, 'id': rows[-1].id})
+
+    return Medicines.to_dicts(rows, fields), next_cursor
+
+
+def count_medicines(search_term=None) -> int:
+    """
+    Count the medicines matching a search term, all of them if None.
+    The count is cached for Config.MEDICINES_COUNT_TTL seconds, as it scans every match.
+    """
+    def count():
+        criterion, _, _ = _medicines_ordering(search_term)
+        query = db.session.query(func.count(Medicines.id))
+        if criterion is not None:
+            query = query.filter(criterion)
+        return query.scalar()
+
+    return cached_medicines(('count', normalize_search_term(search_term)), count,
+                            Config.MEDICINES_COUNT_TTL)
+
+
+"""""""""""""""""""""""""""
+"  MEDICINES CATALOG CACHE "
+"""""""""""""""""""""""""""
+
+MEDICINES_VERSION_KEY = 'medicines:version'
+
+
+def normalize_search_term(search_term: str) -> str:
+    """Lowercase words of a search term, so equivalent searches share their cache entries"""
+    return ' '.join(re.findall(r'\w+', (search_term or '').lower()))
+
+
+def cached_medicines(key: tuple, compute, ttl: int = None):
+    """
+    Read-through cache of the medicines catalog, shared by the workers through Redis.
+
+    Keys include the catalog version, which reload_medicines increments: a reload invalidates
+    every entry at once, and the old ones expire on their own.
+
+    Args:
+        key (tuple): The JSON serializable arguments identifying the result.
+        compute (callable): Function computing the result on a miss.
+        ttl (int, optional): Seconds to keep the result, Config.MEDICINES_CACHE_TTL by default.
+
+    Returns:
+        The cached or computed result, as JSON would decode it.
+    """
+    try:
+        version = Config.REDIS_CLIENT.get(MEDICINES_VERSION_KEY) or 0
+        digest = hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+        cache_key = f'medicines:v{version}:{digest}'
+        cached = Config.REDIS_CLIENT.get(cache_key)
+    except RedisError as e:
+        logging.error(f'Medicines cache unavailable: {e}')
+        return compute()
+
+    if cached is not None:
+        return json.loads(cached)
+
+    # A single request computes a missing entry, the others wait for it
+    with single_flight(cache_key):
+        try:
+            cached = Config.REDIS_CLIENT.get(cache_key)
+            if cached is not None:
+                return json.loads(cached)
+        except RedisError as e:
+            logging.error(f'Medicines cache unavailable: {e}')
+
+        # Round trip through JSON so hits and misses return the same types (lists, not tuples)
+        result = json.loads(json.dumps(compute()))
+        try:
+            Config.REDIS_CLIENT.set(cache_key, json.dumps(result),
+                                    ex=ttl or Config.MEDICINES_CACHE_TTL)
+        except RedisError as e:
+            logging.error(f'Medicines cache unavailable: {e}')
+        return result
+
+
+def invalidate_medicines_cache() -> int:
+    """Invalidate every cached medicines result by moving to a new catalog version"""
+    return Config.REDIS_CLIENT.incr(MEDICINES_VERSION_KEY)
+
+
+def warm_medicines_cache(pages: int = None) -> int:
+    """
+    Fill the cache with the first pages of the catalog, e.g. after a deploy or a reload.
+
+    Args:
+        pages (int, optional): Pages to fill, Config.MEDICINES_CACHE_WARM_PAGES by default.
+
+    Returns:
+        int: The number of pages filled, fewer when the catalog is shorter.
+    """
+    cursor = None
+    warmed = 0
+    for _ in range(pages or Config.MEDICINES_CACHE_WARM_PAGES):
+        _, cursor, _ = list_medicines(cursor=cursor)
+        warmed += 1
+        if not cursor:
+            break
+    return warmed
+
+
+def load_medicines_csv(path: str, chunk_size: int = None) -> int:
+    """
+    Refresh the medicines catalog from a CSV file, then invalidate its cache.
+
+    Rows are inserted by chunks of chunk_size with executemany, in a single transaction.
+    When the file has an id column, existing medicines are updated in place.
+
+    Args:
+        path (str): The CSV file, with a header row naming the Medicines columns
+            (price may be named price(₹) as in the public A-Z medicines dataset).
+        chunk_size (int, optional): Rows per executemany, Config.MEDICINES_LOAD_CHUNK_SIZE by default.
+
+    Returns:
+        int: The number of rows loaded.
+    """
+    chunk_size = chunk_size or Config.MEDICINES_LOAD_CHUNK_SIZE
+    columns = {'id', 'name', 'price', 'is_discontinued', 'manufacturer_name', 'type',
+               'pack_size_label', 'short_composition1', 'short_composition2'}
+
+    statement = mysql_insert(Medicines.__table__)
+    statement = statement.on_duplicate_key_update({
+        column: statement.inserted[column] for column in columns - {'id'}
+    } | {'last_update': datetime.utcnow()})
+
+    loaded = 0
+    try:
+        with open(path, newline='', encoding='utf-8') as csv_file:
+            chunk = []
+            for row in csv.DictReader(csv_file):
+                chunk.append(_medicine_from_csv_row(row, columns))
+                if len(chunk) == chunk_size:
+                    db.session.execute(statement, chunk)
+                    loaded += len(chunk)
+                    chunk = []
+            if chunk:
+                db.session.execute(statement, chunk)
+                loaded += len(chunk)
+        db.session.commit()
+    except (SQLAlchemyError, ValueError, KeyError) as e:
+        db.session.rollback()
+        logging.error(e)
+        raise
+
+    invalidate_medicines_cache()
+    return loaded
+
+
+def _medicine_from_csv_row(row: dict, columns: set) -> dict:
+    values = {}
+    for header, value in row.items():
+        column = header.strip().lower()
+        if column.startswith('price'):
+            column = 'price'
+        if column in columns:
+            values[column] = value.strip() if value else ''
+
+    values['price'] = float(values['price'] or 0)
+    values['is_discontinued'] = values['is_discontinued'].lower() in (
+        'true', '1', 'yes')
+    if 'id' in values:
+        values['id'] = int(values['id'])
+    return values
+
+
+def search_medicines(query, search_term: str):
+    """
+    Filter a Medicines query by a search term, most relevant first.
+
+    Every word of the term must match the start of a word in the name, manufacturer or
+    compositions, using the FULLTEXT index. Terms with no word long enough for the index
+    fall back to a prefix search on the name, which uses its plain index.
+
+    Args:
+        query: The Medicines query to filter.
+        search_term (str): The text typed by the user.
+
+    Returns:
+        The filtered and ordered query.
+    """
+    criterion, sort_key, descending = _medicines_ordering(search_term)
+    if criterion is not None:
+        query = query.filter(criterion)
+    return query.order_by(sort_key.desc() if descending else sort_key, Medicines.id)
+
+
+def _medicines_ordering(search_term: str):
+    """
+    Get the filter of a search term (None without search) and the key medicines are sorted by,
+    before their id, with whether it is sorted in descending order.
+    """
+    words = re.findall(r'\w+', search_term or '')
+    if not words:
+        return None, Medicines.id, False
+
+    indexed_words = [
+        word for word in words if len(word) >= Config.MEDICINES_SEARCH_MIN_TOKEN]
+
+    if not indexed_words:
+        prefix = ' '.join(words).replace('\\', '\\\\').replace(
+            '%', '\\%').replace('_', '\\_')
+        return Medicines.name.like(f'{prefix}%'), Medicines.name, False
+
+    # Boolean mode: +word* requires a word starting with it
+    score = match(Medicines.name, Medicines.manufacturer_name,
+                  Medicines.short_composition1, Medicines.short_composition2,
+                  against=' '.join(f'+{word}*' for word in indexed_words)).in_boolean_mode()
+    # Rounded so the score stored in a cursor compares equal to the one computed again by MySQL
+    return score, func.round(score, 6), True
+
+
+def _after_cursor(sort_key, descending: bool, values: dict):
+    """Filter the medicines sorted after the ones of a cursor"""
+    key, medicine_id = values.get('key'), values.get('id')
+    if not isinstance(medicine_id, int) or key is None:
+        raise InvalidRequestParameters('Invalid cursor')
+
+    if sort_key is Medicines.id:
+        return Medicines.id > medicine_id
+
+    beyond = sort_key < key if descending else sort_key > key
+    return or_(beyond, and_(sort_key == key, Medicines.id > medicine_id))
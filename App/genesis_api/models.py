@@ -1,11 +1,30 @@
 from genesis_api import db
 from sqlalchemy import Index
 from sqlalchemy.orm import joinedload, class_mapper
-from flask_bcrypt import check_password_hash
+from genesis_api.tools.passwords import verify_password
 from datetime import datetime, timedelta
 from enum import Enum
 
 
+def _format_datetime(value):
+    # Convert datetime objects to string in 'YYYY-MM-DD' format (isoformat is much faster than strftime)
+    return value.date().isoformat() if isinstance(value, datetime) else value
+
+
+def _enum_value(value):
+    # Convert enums to their value (assuming it's serializable)
+    return value.value if isinstance(value, Enum) else value
+
+
+def _column_converter(column):
+    """Returns the function converting the values of a column for to_dict, None if they need none"""
+    if isinstance(column.type, db.DateTime):
+        return _format_datetime
+    if isinstance(column.type, db.Enum) and column.type.enum_class is not None:
+        return _enum_value
+    return None
+
+
 class BaseModel(db.Model):
     """
     An abstract base model class that defines some common attributes for all models in the application.
@@ -18,25 +37,70 @@ class BaseModel(db.Model):
     last_update = db.Column(db.DateTime, nullable=False,
                             default=datetime.utcnow, onupdate=datetime.utcnow)
 
-    def to_dict(self) -> dict:
+    def to_dict(self, fields=None) -> dict:
+        """
+        Returns a dictionary representation of the model, limited to fields if given.
+        """
+        # Loaded values are read from the instance state directly, skipping the attribute descriptors
+        state = self.__dict__
+        data = {}
+        for name, convert in self._serializer(fields):
+            value = state[name] if name in state else getattr(self, name)
+            data[name] = value if convert is None else convert(value)
+        return data
+
+    @classmethod
+    def to_dicts(cls, rows, fields=None) -> list[dict]:
+        """
+        Returns the dictionary representations of raw rows selected with select_columns(fields),
+        without building model instances. Extra trailing columns in the rows are ignored.
+        """
+        serializer = cls._serializer(fields)
+        names = [name for name, _ in serializer]
+        converters = [(index, name, convert) for index, (name, convert) in enumerate(serializer)
+                      if convert is not None]
+
+        dicts = []
+        for row in rows:
+            values = dict(zip(names, row))
+            for index, name, convert in converters:
+                values[name] = convert(row[index])
+            dicts.append(values)
+        return dicts
+
+    @classmethod
+    def select_columns(cls, fields=None):
+        """
+        Returns a select of the columns serialized by to_dict(fields), in the order to_dicts expects.
+        """
+        return db.select(*[cls.__table__.columns[name] for name, _ in cls._serializer(fields)])
+
+    @classmethod
+    def column_attributes(cls, fields=None) -> list:
+        """
+        Returns the attributes of the columns serialized by to_dict(fields), e.g. for load_only.
+        """
+        return [getattr(cls, name) for name, _ in cls._serializer(fields)]
+
+    @classmethod
+    def _serializer(cls, fields=None) -> list:
         """
-        Returns a dictionary representation of the model.
+        Returns the (column name, converter) pairs serializing the model, the converter being None
+        for values returned as they are. They are computed once per model and set of fields.
         """
-        def convert_value(value):
-            # Convert enums to their value (assuming it's serializable)
-            if isinstance(value, Enum):
-                # or str(value) if you want the enum's name instead
-                return value.value
-            # Convert datetime objects to string in 'YYYY-MM-DD' format
-            if isinstance(value, datetime):
-                return value.strftime('%Y-%m-%d')
-            # Add other conversions here if needed
-            return value
-
-        return {
-            column.name: convert_value(getattr(self, column.name))
-            for column in self.__table__.columns
-        }
+        serializers = cls.__dict__.get('_serializers')
+        if serializers is None:
+            serializers = {}
+            cls._serializers = serializers
+
+        key = None if fields is None else frozenset(fields)
+        serializer = serializers.get(key)
+        if serializer is None:
+            serializer = [(column.name, _column_converter(column))
+                          for column in cls.__table__.columns
+                          if key is None or column.name in key]
+            serializers[key] = serializer
+        return serializer
 
     def __repr__(self) -> str:
         """
@@ -149,7 +213,7 @@ class User(BaseModel):
         """
         Checks if the password matches the user's password.
         """
-        return check_password_hash(self.password_hash, password)
+        return verify_password(self.password_hash, password)
 
 
 class Profile(BaseModel):
@@ -190,8 +254,15 @@ class Image(BaseModel):
     """
 
     __tablename__ = 'IMAGE'
+    __table_args__ = (
+        Index('idx_content_hash', 'content_hash', unique=True),
+    )
     path = db.Column(db.String(255), nullable=False)
     name = db.Column(db.String(255), nullable=False)
+    # SHA-256 of the file, NULL for images stored before content addressing
+    content_hash = db.Column(db.String(64), nullable=True)
+    # Number of UserImage records sharing the file
+    ref_count = db.Column(db.Integer, nullable=False, default=1)
 
 
 class UserImage(BaseModel):
@@ -237,6 +308,10 @@ class MedicalHistory(BaseModel):
     A model class that represents a medical history in the application.
     """
     __tablename__ = 'MEDICAL_HISTORY'
+    __table_args__ = (
+        # Changes of a patient's records in (last_update, id) order, see medical_history.utils.sync_medical_history
+        Index('idx_medical_history_sync', 'association_id', 'last_update'),
+    )
 
     # Foreign key
     association_id = db.Column(db.Integer, db.ForeignKey(
@@ -306,6 +381,12 @@ class Prescription(BaseModel):
 
 class Medicines(BaseModel):
 
+    __table_args__ = (
+        # Ranked search with MATCH ... AGAINST, see medicines.utils.search_medicines
+        Index('idx_medicines_search', 'name', 'manufacturer_name',
+              'short_composition1', 'short_composition2', mysql_prefix='FULLTEXT'),
+        Index('idx_medicines_name', 'name'),
+    )
     name = db.Column(db.String(255), nullable=False)
     price = db.Column(db.Double, nullable=False)
     is_discontinued = db.Column(db.Boolean, nullable=False)
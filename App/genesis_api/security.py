@@ -1,18 +1,36 @@
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from functools import wraps
 from typing import Callable
-from flask import request, jsonify
+from flask import g, request, jsonify
+from sqlalchemy import Date, DateTime
+from sqlalchemy.orm import make_transient_to_detached
 
 
 from genesis_api.tools.utils import color
 from genesis_api import Config
 from genesis_api.models import User
 from genesis_api.tools.handlers import *
+from genesis_api.tools.cache import TTLCache
 
+from redis.exceptions import RedisError
+
+import heapq
+import json
 import logging
 import jwt
+import secrets
+import threading
+import time
 import traceback
 
+# Decoded token -> snapshot of the user's columns, so most requests skip Redis and MySQL.
+# Entries are dropped on sign out and user updates, and expire after AUTH_CACHE_TTL seconds
+# in any case so other workers see those changes too.
+_user_cache = TTLCache(Config.AUTH_CACHE_SIZE, Config.AUTH_CACHE_TTL)
+# Columns never copied into snapshots, which live in Redis: credentials are read from MySQL when needed
+_SNAPSHOT_EXCLUDED_COLUMNS = {'password_hash'}
+
+
 def token_required(func):
     '''Decorator to check if the user has a valid token'''
     @wraps(func)
@@ -27,15 +45,26 @@ def token_required(func):
             data = jwt.decode(token,
                               Config.SECRET_KEY,
                               algorithms=['HS256'])
-            
-            # Check if the token has expired if its inside the redis db its expired
-            if Config.REDIS_CLIENT.get(token):
+
+            snapshot = _user_cache.get(token)
+
+            # Check if the token has been revoked (signed out)
+            if is_token_revoked(token, data):
                 return jsonify({'message': 'Token has expired!'}), 401
-            
-            # Get the user associated with the decoded data (assumed to be a user ID)
-            current_user = User.query.filter_by(id=data['public_id']).first()
-            if not current_user:
-                return jsonify({'message': 'User not found!'}), 404
+
+            if snapshot is None:
+                # Get the user associated with the decoded data
+                snapshot = _load_token_user(data['public_id'])
+                if not snapshot:
+                    return jsonify({'message': 'User not found!'}), 404
+                # Revocations of tokens without a jti are not broadcast to the other workers,
+                # so their users are never cached and every request checks Redis
+                if 'jti' in data:
+                    _user_cache.set(token, snapshot)
+
+            current_user = _user_from_snapshot(snapshot)
+            # Used to keep the user's reads on the primary right after their writes
+            g.current_user_id = current_user.id
         except jwt.ExpiredSignatureError:
             return jsonify({'message': 'Token has expired!'}), 401
         except jwt.DecodeError:
@@ -47,21 +76,221 @@ def token_required(func):
     return decorator
 
 
+def invalidate_user_cache(user_id: int) -> None:
+    '''Forget the cached snapshots of a user, to be called whenever the user changes'''
+    _forget_user(user_id)
+    if Config.AUTH_CACHE_REDIS:
+        Config.REDIS_CLIENT.delete(_user_cache_key(user_id))
+    # Let the other workers drop their copies too
+    Config.REDIS_JWT_CLIENT.publish(
+        Config.REVOCATION_CHANNEL, json.dumps({'user_id': user_id}))
+
+
+def forget_token(token: str) -> None:
+    '''Forget the cached user of a token, to be called when it is revoked'''
+    _user_cache.delete(token)
+
+
+def _forget_user(user_id: int) -> None:
+    _user_cache.delete_where(
+        lambda token, snapshot: snapshot['id'] == user_id)
+
+
+def _user_cache_key(user_id: int) -> str:
+    return f'auth_user:{user_id}'
+
+
+def _load_token_user(user_id: int) -> dict:
+    '''Get the snapshot of a user from the Redis second tier when enabled, or from MySQL'''
+    if Config.AUTH_CACHE_REDIS:
+        cached_snapshot = Config.REDIS_CLIENT.get(_user_cache_key(user_id))
+        if cached_snapshot:
+            return _decode_user_snapshot(cached_snapshot)
+
+    user = User.query.filter_by(id=user_id).first()
+    if not user:
+        return None
+
+    snapshot = {column.name: getattr(user, column.name)
+                for column in User.__table__.columns if column.name not in _SNAPSHOT_EXCLUDED_COLUMNS}
+    if Config.AUTH_CACHE_REDIS:
+        Config.REDIS_CLIENT.set(_user_cache_key(user_id), _encode_user_snapshot(snapshot),
+                                ex=Config.AUTH_CACHE_REDIS_TTL)
+    return snapshot
+
+
+"""""""""""""""""""""
+" TOKEN REVOCATION  "
+"""""""""""""""""""""
+
+# Revoked token ids (jti) -> expiration timestamp of the token. Every worker keeps the full set,
+# filled from Redis at startup and kept up to date through pub/sub, so checking a token costs
+# no network round trip. Entries are dropped once the token would have expired anyway.
+_revoked_jtis = {}
+# Heap of (expiration timestamp, jti), to drop the expired entries as soon as possible
+_revoked_jtis_expirations = []
+_revoked_jtis_lock = threading.Lock()
+_revocation_listener = None
+_revocation_listener_ready = False
+_revocation_listener_retry_at = 0.0
+
+
+def revoke_token(token: str) -> None:
+    '''Revoke a token until it expires'''
+    data = jwt.decode(token, Config.SECRET_KEY, algorithms=['HS256'],
+                      options={'verify_exp': False})
+    jti = data.get('jti')
+
+    if jti is None:
+        # Tokens issued before jti have no expiration either, so the whole token is kept for good
+        Config.REDIS_CLIENT.set(token, 'expired')
+    else:
+        expires_at = int(data['exp'])
+        ttl = max(1, expires_at - int(time.time()))
+        Config.REDIS_JWT_CLIENT.set(
+            _revoked_jti_key(jti), expires_at, ex=ttl)
+        _remember_revoked_jti(jti, expires_at)
+        Config.REDIS_JWT_CLIENT.publish(Config.REVOCATION_CHANNEL, json.dumps(
+            {'jti': jti, 'exp': expires_at}))
+
+    forget_token(token)
+
+
+def is_token_revoked(token: str, data: dict) -> bool:
+    '''
+    Check if a decoded token was revoked.
+    Tokens with a jti are checked against the in-process set, or against Redis while the
+    pub/sub listener is not running. Older tokens need a Redis GET.
+    '''
+    jti = data.get('jti')
+    if jti is None:
+        return bool(Config.REDIS_CLIENT.get(token))
+
+    _start_revocation_listener()
+    if _revocation_listener_ready:
+        with _revoked_jtis_lock:
+            return jti in _revoked_jtis
+    return bool(Config.REDIS_JWT_CLIENT.exists(_revoked_jti_key(jti)))
+
+
+def _revoked_jti_key(jti: str) -> str:
+    return f'revoked:{jti}'
+
+
+def _remember_revoked_jti(jti: str, expires_at: int) -> None:
+    with _revoked_jtis_lock:
+        _add_revoked_jti(jti, expires_at)
+
+
+def _add_revoked_jti(jti: str, expires_at: int) -> None:
+    # Called with _revoked_jtis_lock held
+    _revoked_jtis[jti] = expires_at
+    heapq.heappush(_revoked_jtis_expirations, (expires_at, jti))
+
+    now = time.time()
+    while _revoked_jtis_expirations and _revoked_jtis_expirations[0][0] <= now:
+        expired_at, expired_jti = heapq.heappop(_revoked_jtis_expirations)
+        if _revoked_jtis.get(expired_jti) == expired_at:
+            del _revoked_jtis[expired_jti]
+
+
+def _handle_revocation_message(message: dict) -> None:
+    data = json.loads(message['data'])
+    if 'jti' in data:
+        _remember_revoked_jti(data['jti'], data['exp'])
+    if 'user_id' in data:
+        _forget_user(data['user_id'])
+
+
+def _handle_revocation_listener_error(error, pubsub, thread) -> None:
+    global _revocation_listener, _revocation_listener_ready
+    logging.error(f'{color(1, "Token revocation listener stopped")} ❌: {error}')
+    _revocation_listener_ready = False
+    _revocation_listener = None
+    thread.stop()
+    pubsub.close()
+
+
+def _start_revocation_listener() -> None:
+    '''Subscribe to revocations and load the current ones, once per process'''
+    global _revocation_listener, _revocation_listener_ready, _revocation_listener_retry_at
+
+    if _revocation_listener is not None or time.monotonic() < _revocation_listener_retry_at:
+        return
+
+    with _revoked_jtis_lock:
+        if _revocation_listener is not None:
+            return
+        _revocation_listener_retry_at = time.monotonic() + 30
+        try:
+            # Subscribe first so no revocation is missed while loading the existing ones
+            pubsub = Config.REDIS_JWT_CLIENT.pubsub(
+                ignore_subscribe_messages=True)
+            pubsub.subscribe(
+                **{Config.REVOCATION_CHANNEL: _handle_revocation_message})
+            _revocation_listener = pubsub.run_in_thread(
+                sleep_time=1, daemon=True, exception_handler=_handle_revocation_listener_error)
+
+            for key in Config.REDIS_JWT_CLIENT.scan_iter(match=_revoked_jti_key('*'), count=1000):
+                expires_at = Config.REDIS_JWT_CLIENT.get(key)
+                if expires_at is not None:
+                    _add_revoked_jti(key.split(':', 1)[1], int(expires_at))
+            _revocation_listener_ready = True
+        except RedisError as e:
+            logging.error(
+                f'{color(1, "Could not start the token revocation listener")} ❌: {e}')
+            if _revocation_listener is not None:
+                _revocation_listener.stop()
+            _revocation_listener = None
+            _revocation_listener_ready = False
+
+
+def _user_from_snapshot(snapshot: dict) -> User:
+    # A detached instance: it never enters the request's session, so queries
+    # made by the endpoint still load fresh User rows
+    # Excluded columns are set to None, a detached instance cannot load them
+    user = User(**snapshot, **dict.fromkeys(_SNAPSHOT_EXCLUDED_COLUMNS))
+    make_transient_to_detached(user)
+    return user
+
+
+def _encode_user_snapshot(snapshot: dict) -> str:
+    return json.dumps(snapshot, default=lambda value: value.isoformat())
+
+
+def _decode_user_snapshot(data: str) -> dict:
+    snapshot = json.loads(data)
+    # Snapshots cached before the columns were excluded
+    for name in _SNAPSHOT_EXCLUDED_COLUMNS:
+        snapshot.pop(name, None)
+    for column in User.__table__.columns:
+        value = snapshot.get(column.name)
+        if value is None:
+            continue
+        if isinstance(column.type, DateTime):
+            snapshot[column.name] = datetime.fromisoformat(value)
+        elif isinstance(column.type, Date):
+            snapshot[column.name] = date.fromisoformat(value)
+    return snapshot
 
 
 def encodeJwtToken(user: dict[str, str]) -> dict[str, str]:
     '''Encodes a user object into a JWT token'''
     try:
         if user:
+            expires_at = datetime.utcnow() + timedelta(days=Config.JWT_LIFETIME_DAYS)
             token = jwt.encode({
                 'public_id': user['id'],
+                # Short id used to revoke the token, and its expiration checked by jwt.decode
+                'jti': secrets.token_urlsafe(8),
+                'exp': expires_at,
                 'user': {
                     'id': user['id'],
                     'name': user['name'],
                     'username': user['username'],
                     'email': user['email'],
                     'profile_id': user['profile_id'],
-                    'exp': str(datetime.utcnow() + timedelta(days=50))
+                    'exp': str(expires_at)
                 }
             },
                 Config.SECRET_KEY,
@@ -0,0 +1,184 @@
+from collections import OrderedDict
+
+from flask_caching.backends.rediscache import RedisCache
+from redis.exceptions import RedisError
+
+import logging
+import threading
+import time
+
+
+class TTLCache:
+    '''
+    Thread-safe in-process cache bounded to maxsize entries, evicting the least recently used one.
+    Entries expire ttl seconds after being set.
+    '''
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        '''Get the value of key, or default if it is missing or expired'''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float = None) -> None:
+        '''Set the value of key for ttl seconds (the cache ttl by default)'''
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key) -> bool:
+        '''Remove key, return whether it was present'''
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def delete_where(self, predicate) -> int:
+        '''Remove the entries for which predicate(key, value) is true, return how many were removed'''
+        with self._lock:
+            keys = [key for key, (_, value) in self._entries.items()
+                    if predicate(key, value)]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, key) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class TwoTierCache(RedisCache):
+    '''
+    Flask-Caching backend with a bounded in-process LRU (TTLCache) in front of Redis.
+    Redis is shared by every worker, the local tier saves its round trip and unpickling for the
+    hottest entries. Values are pickled with the highest protocol in Redis.
+    Local entries live local_ttl seconds at most, and never past their Redis expiration.
+    Set CACHE_TYPE to genesis_api.tools.cache.TwoTierCache, with the RedisCache settings plus
+    CACHE_LOCAL_MAXSIZE and CACHE_LOCAL_TTL.
+    '''
+
+    def __init__(self, host='localhost', port=6379, password=None, db=0, default_timeout=300,
+                 key_prefix=None, local_maxsize=1024, local_ttl=5, **kwargs):
+        super().__init__(host=host, port=port, password=password, db=db,
+                         default_timeout=default_timeout, key_prefix=key_prefix, **kwargs)
+        self._local = TTLCache(local_maxsize, local_ttl)
+        self._stats_lock = threading.Lock()
+        self._stats = {'local_hits': 0, 'redis_hits': 0,
+                       'misses': 0, 'redis_errors': 0}
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        kwargs.update(local_maxsize=config.get('CACHE_LOCAL_MAXSIZE', 1024),
+                      local_ttl=config.get('CACHE_LOCAL_TTL', 5))
+        return super().factory(app, config, args, kwargs)
+
+    def stats(self) -> dict:
+        '''Hit and miss counters of this worker, with the size of its local tier'''
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['local_size'] = len(self._local)
+        return stats
+
+    def get(self, key):
+        value = self._local.get(key, _MISSING)
+        if value is not _MISSING:
+            self._count('local_hits')
+            return value
+
+        redis_key = self._get_prefix() + key
+        try:
+            pipeline = self._read_client.pipeline(transaction=False)
+            pipeline.get(redis_key)
+            pipeline.pttl(redis_key)
+            dump, pttl = pipeline.execute()
+        except RedisError as e:
+            logging.error(f'Cache unavailable: {e}')
+            self._count('redis_errors')
+            return None
+
+        if dump is None:
+            self._count('misses')
+            return None
+
+        self._count('redis_hits')
+        value = self.serializer.loads(dump)
+        self._set_local(key, value, pttl / 1000 if pttl > 0 else 0)
+        return value
+
+    def get_many(self, *keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value, timeout=None):
+        timeout = self.default_timeout if timeout is None else timeout
+        self._set_local(key, value, timeout)
+        return super().set(key, value, timeout)
+
+    def add(self, key, value, timeout=None):
+        added = super().add(key, value, timeout)
+        if added:
+            self._set_local(key, value, self.default_timeout if timeout is None else timeout)
+        return added
+
+    def set_many(self, mapping, timeout=None):
+        timeout = self.default_timeout if timeout is None else timeout
+        for key, value in mapping.items():
+            self._set_local(key, value, timeout)
+        return super().set_many(mapping, timeout)
+
+    def delete(self, key):
+        self._local.delete(key)
+        return super().delete(key)
+
+    def delete_many(self, *keys):
+        for key in keys:
+            self._local.delete(key)
+        return super().delete_many(*keys)
+
+    def has(self, key):
+        return self._local.get(key, _MISSING) is not _MISSING or super().has(key)
+
+    def clear(self):
+        self._local.clear()
+        return super().clear()
+
+    def inc(self, key, delta=1):
+        self._local.delete(key)
+        return super().inc(key, delta)
+
+    def dec(self, key, delta=1):
+        self._local.delete(key)
+        return super().dec(key, delta)
+
+    def _set_local(self, key, value, timeout: float) -> None:
+        # A timeout of 0 means no expiration in Redis
+        ttl = self._local.ttl if timeout <= 0 else min(self._local.ttl, timeout)
+        self._local.set(key, value, ttl)
+
+    def _count(self, counter: str) -> None:
+        with self._stats_lock:
+            self._stats[counter] += 1
+
+
+_MISSING = object()
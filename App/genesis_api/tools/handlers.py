@@ -41,4 +41,23 @@ class InternalServerError(Exception):
 
 class ElementNotFoundError(Exception):
     '''Custom Exception to handle element not found in DB'''
-    pass
\ No newline at end of file
+    pass
+
+class UploadOffsetMismatchError(Exception):
+    '''Custom Exception raised when a chunk does not start where the upload currently ends'''
+
+    def __init__(self, message=None, offset: int = 0):
+        super().__init__(message)
+        self.offset: int = offset
+
+class TooManyUploadsError(Exception):
+    '''Custom Exception raised when a user has too many uploads in progress to start another one'''
+    pass
+
+class UploadFinalizingError(Exception):
+    '''Custom Exception raised when another request is already finalizing an upload'''
+    pass
+
+class PasswordHashingBusyError(Exception):
+    '''Custom Exception raised when too many password hashes are queued to accept another one'''
+    pass
@@ -0,0 +1,91 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from genesis_api.config import Config
+from genesis_api.tools.handlers import PasswordHashingBusyError
+
+import bcrypt
+import logging
+import multiprocessing
+import threading
+
+
+# bcrypt is CPU-bound on purpose, so it runs in worker processes instead of blocking the
+# request thread (and, under eventlet/gevent, every other connection of the worker).
+# The pool is created on first use so forked servers do not inherit it. Its processes are
+# started by a forkserver (spawned where there is none), never forked from this process:
+# it already runs threads (pub/sub listener, upload executor) whose locks a fork could copy held.
+_context = multiprocessing.get_context(
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+if _context.get_start_method() == 'forkserver':
+    # The server itself only needs this module, not the default __main__ (the app's entry point)
+    _context.set_forkserver_preload([__name__])
+_pool = None
+_pool_lock = threading.Lock()
+# Hashes waiting or running at once, past this requests fail fast instead of piling up
+_slots = threading.BoundedSemaphore(Config.PASSWORD_HASH_QUEUE_DEPTH)
+
+
+def hash_password(password: str, rounds: int = None) -> str:
+    '''Hash a password with bcrypt using the configured work factor'''
+    try:
+        return _run(_hash, password, rounds or Config.BCRYPT_LOG_ROUNDS)
+    except BrokenProcessPool as e:
+        logging.error(f'Could not hash a password: {e}')
+        raise PasswordHashingBusyError(
+            'Password hashing is unavailable. Please try again later.')
+
+
+def verify_password(password_hash: str, password: str) -> bool:
+    '''Check a password against a bcrypt hash, a password that cannot be checked does not match'''
+    try:
+        return _run(_verify, password_hash, password)
+    except BrokenProcessPool as e:
+        logging.error(f'Could not verify a password: {e}')
+        return False
+
+
+def _hash(password: str, rounds: int) -> str:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _verify(password_hash: str, password: str) -> bool:
+    if not password_hash or not isinstance(password, str):
+        return False
+    try:
+        return bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
+    except (ValueError, TypeError):
+        # Malformed hash
+        return False
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                Config.PASSWORD_HASH_WORKERS, mp_context=_context)
+        return _pool
+
+
+def _reset_pool(broken_pool: ProcessPoolExecutor) -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is broken_pool:
+            _pool = None
+
+
+def _run(function, *args):
+    if not _slots.acquire(blocking=False):
+        raise PasswordHashingBusyError(
+            'Too many password operations in progress. Please try again later.')
+    try:
+        pool = _get_pool()
+        try:
+            return pool.submit(function, *args).result()
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for memory), start a fresh pool and retry once
+            _reset_pool(pool)
+            return _get_pool().submit(function, *args).result()
+    finally:
+        _slots.release()
@@ -0,0 +1,128 @@
+from enum import Enum
+from functools import wraps
+
+from flask import request, make_response
+from flask.json.provider import DefaultJSONProvider
+
+from genesis_api.config import Config
+
+import gzip
+
+try:
+    import orjson
+except ImportError:  # optional, the stdlib encoder is used without it
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # optional, responses are only gzipped without it
+    brotli = None
+
+
+def _json_default(value):
+    '''Types json cannot encode: enums as their value like to_dict, the rest as Flask does'''
+    if isinstance(value, Enum):
+        return value.value
+    return DefaultJSONProvider.default(value)
+
+
+class GenesisJSONProvider(DefaultJSONProvider):
+    '''
+    JSON provider encoding with orjson when it is installed and Config.JSON_USE_ORJSON is set.
+    The output matches the stdlib provider: sorted keys, enums as their value and dates in
+    the HTTP format Flask uses (models already send their DateTime columns as YYYY-MM-DD).
+    Anything orjson refuses (e.g. integers over 64 bits) is encoded by the stdlib.
+    '''
+    default = staticmethod(_json_default)
+
+    # Dates are passed to _json_default so they keep Flask's format instead of orjson's ISO one
+    _orjson_options = (orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME |
+                       orjson.OPT_PASSTHROUGH_DATACLASS) if orjson else 0
+
+    def dumps(self, obj, **kwargs) -> str:
+        if self._use_orjson(kwargs):
+            try:
+                return orjson.dumps(obj, default=self.default, option=self._orjson_options).decode('utf-8')
+            except TypeError:
+                pass
+        return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if self._use_orjson(kwargs):
+            return orjson.loads(s)
+        return super().loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        if not self._use_orjson({}) or (self.compact is None and self._app.debug) or self.compact is False:
+            # Indented output for debugging
+            return super().response(*args, **kwargs)
+
+        obj = self._prepare_response_obj(args, kwargs)
+        try:
+            # Bytes straight into the response, skipping the str round trip
+            data = orjson.dumps(obj, default=self.default,
+                                option=self._orjson_options | orjson.OPT_APPEND_NEWLINE)
+        except TypeError:
+            return super().response(*args, **kwargs)
+        return self._app.response_class(data, mimetype=self.mimetype)
+
+    @staticmethod
+    def _use_orjson(kwargs: dict) -> bool:
+        # Calls with stdlib json arguments (indent, cls, ...) keep using the stdlib
+        return orjson is not None and Config.JSON_USE_ORJSON and not kwargs
+
+
+def skip_compression(func):
+    '''
+    Decorator for endpoints whose bodies are mostly base64 encoded images: those are already
+    compressed, so compressing them again costs a lot of CPU to save little more than base64's overhead
+    '''
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        response = make_response(func(*args, **kwargs))
+        response.compressible = False
+        return response
+    return wrapper
+
+
+def compress_response(response):
+    '''
+    after_request handler compressing responses with brotli or gzip, as negotiated from
+    Accept-Encoding. Small bodies, streams, files, endpoints decorated with skip_compression
+    and types outside Config.COMPRESSION_MIMETYPES are sent as they are.
+    '''
+    if (request.method == 'HEAD'
+            or not getattr(response, 'compressible', True)
+            or response.direct_passthrough
+            or response.is_streamed
+            or not 200 <= response.status_code < 300
+            or response.status_code == 206
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in Config.COMPRESSION_MIMETYPES):
+        return response
+
+    # Sent whenever the body could have been compressed, so caches keep one copy per encoding
+    response.vary.add('Accept-Encoding')
+    if response.content_length is None or response.content_length < Config.COMPRESSION_MIN_SIZE:
+        return response
+
+    encoding = request.accept_encodings.best_match(
+        ['br', 'gzip'] if brotli else ['gzip'])
+    if encoding is None:
+        return response
+
+    data = response.get_data()
+    if encoding == 'br':
+        response.set_data(brotli.compress(
+            data, quality=Config.COMPRESSION_BROTLI_QUALITY))
+    else:
+        response.set_data(gzip.compress(
+            data, compresslevel=Config.COMPRESSION_GZIP_LEVEL, mtime=0))
+    response.headers['Content-Encoding'] = encoding
+
+    # The compressed body is a different representation of the same data, so a strong
+    # ETag becomes weak; If-None-Match is compared weakly so 304s keep working
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
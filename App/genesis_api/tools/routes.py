@@ -2,6 +2,7 @@ from flask import Blueprint, jsonify, session
 from uptime import uptime
 from genesis_api.tools.utils import *
 from genesis_api.config import Config
+from genesis_api import cache
 import psutil
 import datetime
 
@@ -17,6 +18,8 @@ def health():
     memory_usage: percentage of memory usage
     cpu_usage: percentage of cpu usage
     port: port where the server is running
+    database_pool: connections of the SQLAlchemy pool (size, checkedin, checkedout, overflow)
+    cache: hit and miss counters of the response cache of this worker
     message: Server is up and running
     '''
     cpu = psutil.cpu_percent()
@@ -27,6 +30,8 @@ def health():
         "port": 5555,
         "date": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
         "uptime": f"{uptime() / 60 / 60 / 24:.2f} days",
+        "database_pool": database_pool_status(),
+        "cache": cache.cache.stats() if hasattr(cache.cache, 'stats') else None,
         "message": "Server is up and running",
     })
 
@@ -0,0 +1,155 @@
+from functools import wraps
+from itertools import count
+
+from flask import g, has_request_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from redis.exceptions import RedisError
+
+from genesis_api.config import Config
+from genesis_api.tools.cache import TTLCache
+
+import logging
+import threading
+import time
+
+# Engines of the read replicas are registered as binds named replica_<n> (see Config)
+REPLICA_BIND_PREFIX = 'replica_'
+
+_round_robin = count()
+# Bind key -> monotonic time until which the replica is skipped after a connection error
+_replicas_down = {}
+_replicas_down_lock = threading.Lock()
+# Users who wrote recently, whose reads stay on the primary until their writes replicated
+_sticky_users = TTLCache(4096, Config.REPLICA_STICKY_SECONDS)
+
+
+class RoutingSession(Session):
+    '''
+    Session sending the queries of read_only endpoints to a read replica.
+    Everything else, flushes included, goes to the primary, as does every query while no
+    replica is healthy or the user wrote in the last REPLICA_STICKY_SECONDS seconds.
+    '''
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing:
+            replica = _request_replica(self._db.engines)
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def read_only(func):
+    '''Decorator to serve the queries of an endpoint from a read replica'''
+    @wraps(func)
+    def decorator(*args, **kwargs):
+        g.read_only = True
+        try:
+            return func(*args, **kwargs)
+        finally:
+            g.pop('read_only', None)
+            g.pop('_replica_key', None)
+    return decorator
+
+
+def primary(func):
+    '''
+    Decorator sending the queries of func to the primary inside a read_only endpoint, for
+    responses that must not be built from a lagging replica (e.g. those stored in a cache)
+    '''
+    @wraps(func)
+    def decorator(*args, **kwargs):
+        was_read_only = g.pop('read_only', None)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if was_read_only is not None:
+                g.read_only = was_read_only
+    return decorator
+
+
+def init_replicas(app, db) -> None:
+    '''Watch the replica engines for connection errors and record the writes of each request'''
+    with app.app_context():
+        for key, engine in db.engines.items():
+            if key and key.startswith(REPLICA_BIND_PREFIX):
+                event.listen(engine, 'handle_error',
+                             _replica_error_handler(key))
+
+    event.listen(RoutingSession, 'after_flush', _record_write)
+    event.listen(RoutingSession, 'after_commit', _stick_writer)
+    event.listen(RoutingSession, 'after_rollback', _forget_write)
+
+
+def _request_replica(engines: dict):
+    '''Engine of the replica serving the current request, chosen once per request'''
+    if not has_request_context() or not g.get('read_only'):
+        return None
+
+    if '_replica_key' not in g:
+        # Stickiness costs a Redis round trip, only worth it when there is a replica to use
+        g._replica_key = _next_replica(engines)
+        if g._replica_key is not None and _is_sticky(g.get('current_user_id')):
+            g._replica_key = None
+
+    return engines.get(g._replica_key) if g._replica_key else None
+
+
+def _next_replica(engines: dict):
+    now = time.monotonic()
+    with _replicas_down_lock:
+        healthy = sorted(key for key in engines
+                         if key and key.startswith(REPLICA_BIND_PREFIX) and _replicas_down.get(key, 0) <= now)
+    if not healthy:
+        return None
+    return healthy[next(_round_robin) % len(healthy)]
+
+
+def _replica_error_handler(key: str):
+    def handle_error(context) -> None:
+        if context.is_disconnect or context.connection is None:
+            logging.error(
+                f'Read replica {key} is unavailable, using the primary for {Config.REPLICA_RETRY_SECONDS}s')
+            with _replicas_down_lock:
+                _replicas_down[key] = time.monotonic() + \
+                    Config.REPLICA_RETRY_SECONDS
+    return handle_error
+
+
+def _sticky_key(user_id: int) -> str:
+    return f'replica_sticky:{user_id}'
+
+
+def _is_sticky(user_id: int) -> bool:
+    if user_id is None:
+        return False
+    if user_id in _sticky_users:
+        return True
+    try:
+        # The write may have been made by another worker
+        return bool(Config.REDIS_CLIENT.exists(_sticky_key(user_id)))
+    except RedisError:
+        return True
+
+
+def _record_write(session, flush_context) -> None:
+    session.info['wrote'] = True
+
+
+def _forget_write(session) -> None:
+    session.info.pop('wrote', None)
+
+
+def _stick_writer(session) -> None:
+    if not session.info.pop('wrote', False):
+        return
+    if not has_request_context() or g.get('current_user_id') is None:
+        return
+
+    user_id = g.current_user_id
+    _sticky_users.set(user_id, True)
+    try:
+        Config.REDIS_CLIENT.set(_sticky_key(user_id), 1,
+                                ex=Config.REPLICA_STICKY_SECONDS)
+    except RedisError as e:
+        logging.error(f'Could not record the write of user {user_id}: {e}')
@@ -1,16 +1,30 @@
 from genesis_api.models import User
 from genesis_api.tools.handlers import InvalidRequestParameters
-from flask import session, jsonify
+from flask import session, jsonify, request, make_response
 from contextlib import contextmanager
 from datetime import datetime
-from genesis_api import db
+from functools import wraps
+from genesis_api import db, cache
+from genesis_api.config import Config
+from redis.exceptions import RedisError, WatchError
+from sqlalchemy import event
 from flask_restful import reqparse
 from werkzeug.exceptions import BadRequest
 from werkzeug.datastructures import FileStorage
 from email_validator import validate_email, EmailNotValidError
-from PIL import Image as PILImage
+from PIL import Image as PILImage, ImageOps
 
+import base64
+import binascii
+import json
+import logging
+import math
 import psutil
+import random
+import threading
+import time
+import uuid
+import zipfile
 
 
 def server_status() -> str:
@@ -34,6 +48,50 @@ def server_status() -> str:
 
 
 
+class QueryCounter:
+    '''Number and text of the SQL statements executed inside a count_queries block'''
+
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+
+
+def database_pool_status() -> dict:
+    '''Usage of the SQLAlchemy connection pool of this worker'''
+    pool = db.engine.pool
+    status = {'status': pool.status()}
+    # Only queue based pools (the MySQL one) report their usage
+    for stat in ('size', 'checkedin', 'checkedout', 'overflow'):
+        if hasattr(pool, stat):
+            status[stat] = getattr(pool, stat)()
+    return status
+
+
+@contextmanager
+def count_queries(engine=None):
+    '''
+    Count the SQL statements the current thread executes inside the block.
+
+        with count_queries() as counter:
+            get_user_images_data(user)
+        assert counter.count <= 2
+    '''
+    engine = engine if engine is not None else db.engine
+    counter = QueryCounter()
+    thread_id = threading.get_ident()
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() == thread_id:
+            counter.count += 1
+            counter.statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
 def color(color: int, text: str) -> str:
     '''
     1: Red
@@ -107,6 +165,245 @@ def generate_response(success: bool, message: str, data: dict, status: int, erro
     return response
 
 
+def etag_conditional(compute_etag, cache_control: str = 'private, no-cache'):
+    '''
+    Decorator for GET endpoints that answers 304 Not Modified when the client already has the data.
+    It goes below token_required: compute_etag is called with the same arguments as the endpoint
+    and returns a strong ETag, or None to skip conditional handling.
+    '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            etag = compute_etag(*args, **kwargs)
+            if etag is not None and request.if_none_match.contains_weak(etag):
+                # The endpoint is not called at all so nothing is queried or serialized
+                response = make_response('', 304)
+            else:
+                response = make_response(func(*args, **kwargs))
+                if etag is None or response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = cache_control
+            return response
+        return wrapper
+    return decorator
+
+
+# Cache key -> [lock, number of threads using it], so one thread per worker computes a missing entry
+_flight_locks = {}
+_flight_locks_lock = threading.Lock()
+
+
+@contextmanager
+def single_flight(key: str, wait: bool = True):
+    '''
+    Let a single request at a time, in all the workers, compute the value of a cache key.
+    Holds a lock for the key in this process, then a Redis SET NX lock shared by the workers.
+    Yields whether the locks were acquired: when wait is True it waits for them up to
+    Config.CACHE_LOCK_TIMEOUT seconds, after which the caller should compute the value anyway,
+    otherwise it gives up right away. Callers check the cache again once inside, since the
+    request that held the locks most likely filled it.
+    '''
+    with _flight_locks_lock:
+        entry = _flight_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    local_lock = entry[0]
+
+    redis_key = f'single_flight:{key}'
+    token = uuid.uuid4().hex
+    timeout = Config.CACHE_LOCK_TIMEOUT
+    deadline = time.monotonic() + timeout
+    locked = local_lock.acquire(timeout=timeout if wait else 0)
+    acquired = False
+    try:
+        while locked:
+            try:
+                acquired = bool(Config.REDIS_CLIENT.set(
+                    redis_key, token, nx=True, px=int(timeout * 1000)))
+            except RedisError as e:
+                logging.error(f'Could not lock {key}: {e}')
+                break
+            if acquired or not wait or time.monotonic() >= deadline:
+                break
+            time.sleep(0.05)
+
+        yield acquired
+    finally:
+        if acquired:
+            release_redis_lock(redis_key, token)
+        if locked:
+            local_lock.release()
+        with _flight_locks_lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _flight_locks[key]
+
+
+def release_redis_lock(redis_key: str, token: str) -> None:
+    '''Delete a Redis SET NX lock holding token, unless it expired and was taken by another worker'''
+    try:
+        with Config.REDIS_CLIENT.pipeline() as pipeline:
+            pipeline.watch(redis_key)
+            if pipeline.get(redis_key) == token:
+                pipeline.multi()
+                pipeline.delete(redis_key)
+                pipeline.execute()
+    except (RedisError, WatchError) as e:
+        logging.error(f'Could not unlock {redis_key}: {e}')
+
+
+def coalesced_cached(timeout: int, make_cache_key, response_filter=None, beta: float = None):
+    '''
+    Decorator caching an endpoint like cache.cached, protected against cache stampedes:
+    - on a miss a single request computes the response (single_flight), the others wait for it;
+    - entries are refreshed early with a probability growing as they get close to expiring
+      (XFetch: beta times the time the response took to compute), by one request while the others
+      keep getting the cached response, so hot entries never expire under load.
+    It goes below token_required, make_cache_key and response_filter work as with cache.cached;
+    make_cache_key may return None to skip the cache for the request.
+    '''
+    beta = Config.CACHE_EARLY_REFRESH_BETA if beta is None else beta
+
+    def should_refresh(entry: dict) -> bool:
+        return time.time() - entry['delta'] * beta * math.log(1 - random.random()) >= entry['expires_at']
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                key = make_cache_key(*args, **kwargs)
+                if key is None:
+                    return func(*args, **kwargs)
+                entry = cache.get(key)
+            except Exception as e:
+                logging.error(f'Cache unavailable: {e}')
+                return func(*args, **kwargs)
+
+            if entry is not None and not should_refresh(entry):
+                return entry['value']
+
+            # Early refreshes do not wait: if another request is refreshing, serve the cached value
+            with single_flight(key, wait=entry is None) as acquired:
+                if entry is not None and not acquired:
+                    return entry['value']
+                if entry is None:
+                    entry = cache.get(key)
+                    if entry is not None:
+                        return entry['value']
+
+                start = time.monotonic()
+                response = func(*args, **kwargs)
+                if response_filter is None or response_filter(response):
+                    cache.set(key, {'value': response, 'delta': time.monotonic() - start,
+                                    'expires_at': time.time() + timeout}, timeout=timeout)
+                return response
+        return wrapper
+    return decorator
+
+
+def encode_cursor(values: dict) -> str:
+    '''Build an opaque pagination cursor from the keyset values of the last row of a page'''
+    payload = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(payload).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> dict:
+    '''Get back the keyset values of a cursor built by encode_cursor'''
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(cursor + padding))
+    except (ValueError, binascii.Error):
+        raise InvalidRequestParameters('Invalid cursor')
+
+    if not isinstance(values, dict):
+        raise InvalidRequestParameters('Invalid cursor')
+    return values
+
+
+def get_page_size(default: int, maximum: int) -> int:
+    '''Read the ?limit= query parameter, falling back to default and capped at maximum'''
+    limit = request.args.get('limit', default)
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise InvalidRequestParameters('limit must be an integer')
+
+    if limit < 1:
+        raise InvalidRequestParameters('limit must be greater than 0')
+    return min(limit, maximum)
+
+
+def get_fields(allowed: set) -> list[str]:
+    '''
+    Read the ?fields= query parameter (comma separated names) of endpoints returning model dicts.
+    Names must be in allowed, id is always included, and the list is sorted so it can be used in
+    cache keys. Returns None when the parameter is missing, meaning every field.
+    '''
+    fields = request.args.get('fields')
+    if not fields:
+        return None
+
+    requested = {field.strip() for field in fields.split(',') if field.strip()}
+    unknown = requested - allowed
+    if unknown:
+        raise InvalidRequestParameters(
+            f'Unknown fields: {", ".join(sorted(unknown))}')
+    return sorted(requested | {'id'})
+
+
+class _ZipBuffer:
+    '''Unseekable file object zipfile writes into, emptied by stream_zip after every write'''
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_zip(entries):
+    '''
+    Generator of the bytes of a zip archive, produced as its entries are written so the archive
+    is never held in memory. entries yields (name, chunks, compress) tuples where chunks is an
+    iterable of bytes; compress is False for data that is already compressed (e.g. images).
+    '''
+    buffer = _ZipBuffer()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for name, chunks, compress in entries:
+            info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+            # Sizes are unknown before the end of the entry, zip64 keeps large entries valid
+            with archive.open(info, 'w', force_zip64=True) as entry:
+                for chunk in chunks:
+                    entry.write(chunk)
+                    data = buffer.drain()
+                    if data:
+                        yield data
+            yield buffer.drain()
+    # Central directory
+    yield buffer.drain()
+
+
+def file_chunks(path: str, chunk_size: int = None):
+    '''Generator of the content of a file in chunks of Config.UPLOAD_CHUNK_SIZE bytes'''
+    with open(path, 'rb') as file:
+        while True:
+            chunk = file.read(chunk_size or Config.UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
 def split_names(nombre: str) -> list[str]:
     tokens = nombre.split(" ")
     names = []
@@ -184,7 +481,15 @@ def is_username_valid(username):
     return True
 
 
-def resize_image(image_path, max_size):
+def resize_image(image_path, max_size, destination=None, image_format=None):
+    '''
+    Shrink an image to fit in max_size, keeping its aspect ratio.
+    The result is written to destination, or over the original if no destination is given.
+    '''
     with PILImage.open(image_path) as img:
+        # Apply the EXIF orientation so phone pictures are not rotated
+        img = ImageOps.exif_transpose(img)
         img.thumbnail(max_size)
-        img.save(image_path)
+        if image_format == 'JPEG' and img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        img.save(destination or image_path, format=image_format)
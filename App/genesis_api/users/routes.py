@@ -2,8 +2,9 @@
 from flask import Blueprint
 from genesis_api.tools.handlers import *
 from genesis_api.users.utils import *
-from genesis_api.tools.utils import parse_request, generate_response
+from genesis_api.tools.utils import parse_request, generate_response, get_fields
 from genesis_api.security import *
+from genesis_api.tools.routing import read_only
 from genesis_api import db, limiter, cache
 
 
@@ -31,6 +32,8 @@ def sign_up_endpoint() -> dict[str:str]:
         return generate_response(True, 'User was successfully created', user, 201), 201
     except InvalidRequestParameters as e:
         return generate_response(False, 'Invalid request parameters', None, 400, str(e)), 400
+    except PasswordHashingBusyError as e:
+        return generate_response(False, 'Server busy, please try again later', None, 503, str(e)), 503
     except Exception as e:
         return generate_response(False, 'Could not create user', None, 500, str(e)), 500
 
@@ -78,6 +81,8 @@ def sign_in_endpoint() -> dict[str:str]:
         return generate_response(False, 'Invalid request parameters', None, 400, str(e)), 400
     except IncorrectCredentialsError as e:
         return generate_response(False, 'Incorrect credentials', None, 401, str(e)), 401
+    except PasswordHashingBusyError as e:
+        return generate_response(False, 'Server busy, please try again later', None, 503, str(e)), 503
     except Exception as e:
         return generate_response(False, 'Could not authenticate user', None, 500, str(e)), 500
 
@@ -127,6 +132,8 @@ def update_user_endpoint(current_user: User) -> dict[str:str]:
     try:
         user = update_user(current_user.id, **args)
         return generate_response(True, 'User data updated', get_user(user.id).to_dict(), 200), 200
+    except PasswordHashingBusyError as e:
+        return generate_response(False, 'Server busy, please try again later', None, 503, str(e)), 503
     except Exception as e:
         return generate_response(False, 'Could not update user', None, 500, str(e)), 500
 
@@ -150,10 +157,13 @@ def delete_user() -> dict[str:str]:
 
 @user.route('/get_patients', methods=['GET'])
 @token_required
-def get_patients_endpoint() -> dict[str:str]:
+@read_only
+def get_patients_endpoint(current_user: User) -> dict[str:str]:
     try:
-        patients = get_users_by_profile(1)
+        patients = get_users_by_profile(1, get_fields(USER_FIELDS))
         return generate_response(True, 'Patients retrieved', patients, 200), 200
+    except InvalidRequestParameters as e:
+        return generate_response(False, 'Invalid request parameters', None, 400, str(e)), 400
     except Exception as e:
         return generate_response(False, 'Could not get patients', None, 500, str(e)), 500
 
@@ -199,15 +209,20 @@ def new_password_endpoint(current_user: User) -> dict[str:str]:
         return generate_response(True, 'Password was successfully changed', None, 200), 200
     except InvalidRequestParameters as e:
         return generate_response(False, 'Invalid request parameters', None, 400, str(e)), 400
+    except PasswordHashingBusyError as e:
+        return generate_response(False, 'Server busy, please try again later', None, 503, str(e)), 503
     except Exception as e:
         return generate_response(False, 'Could not change password', None, 500, str(e)), 500
 
 
 @user.route('/get_users', methods=['GET'])
 @token_required
+@read_only
 def get_users_endpoint(current_user: User) -> dict[str:str]:
     try:
-        users = get_users()
+        users = get_all_users(get_fields(USER_FIELDS))
         return generate_response(True, 'Users retrieved', users, 200), 200
+    except InvalidRequestParameters as e:
+        return generate_response(False, 'Invalid request parameters', None, 400, str(e)), 400
     except Exception as e:
         return generate_response(False, 'Could not get users', None, 500, str(e)), 500
@@ -1,12 +1,12 @@
 from genesis_api import db
 from genesis_api.models import User, Profile, VerificationCode, DoctorPatientAssociation, UserImage, Image
-from genesis_api.security import encodeJwtToken, expire_token
+from genesis_api.security import encodeJwtToken, expire_token, invalidate_user_cache, revoke_token
 from genesis_api.tools.handlers import *
 from genesis_api.tools.utils import *
 from genesis_api.config import Config
 
 
-from flask_bcrypt import generate_password_hash
+from genesis_api.tools.passwords import hash_password
 from datetime import datetime
 from smtplib import SMTPException
 from email.message import EmailMessage
@@ -21,6 +21,11 @@ import ssl
 import smtplib
 
 
+# Fields that can be requested with ?fields=, never the password hash
+USER_FIELDS = {column.name for column in User.__table__.columns} - \
+    {'password_hash'}
+
+
 def create_user(name: str, username: str, email: str, password: str, birth_date: datetime, profile_id: int, cedula: str = None) -> User:
     '''Create a user and return a User object type'''
 
@@ -34,8 +39,8 @@ def create_user(name: str, username: str, email: str, password: str, birth_date:
                 'You could not be registered as a doctor because your identity could not be validated. Please try again with a different cedula.')
 
     try:
-        user = User(name=name, username=username, email=email, password_hash=generate_password_hash(
-            password).decode('utf-8'), birth_date=birth_date, profile_id=profile_id, cedula=cedula, status=0)
+        user = User(name=name, username=username, email=email, password_hash=hash_password(
+            password), birth_date=birth_date, profile_id=profile_id, cedula=cedula, status=0)
         db.session.add(user)
         db.session.commit()
 
@@ -77,9 +82,9 @@ def sign_in(username: str, password: str) -> User:
 
 
 def sign_out(jwt_token: str) -> User:
-    '''Sign out function in order to sign out user by adding jwt token to redis'''
+    '''Sign out function in order to sign out user by revoking the jwt token in redis'''
     try:
-        Config.REDIS_CLIENT.set(jwt_token, 'expired')
+        revoke_token(jwt_token)
     except Exception as e:
         db.session.rollback()
         logging.error(e)
@@ -122,8 +127,8 @@ def validate_user_data(user_data: User, profile_id: int, cedula: str) -> dict:
             user_data['email']) else None
 
     if 'password' in user_data:
-        validated_data['password_hash'] = generate_password_hash(
-            user_data['password']).decode('utf-8')
+        validated_data['password_hash'] = hash_password(
+            user_data['password'])
 
     if 'birth_date' in user_data:
         validated_data['birth_date'] = user_data['birth_date']
@@ -148,6 +153,7 @@ def update_user(current_user_id: int, **user_data: User) -> User:
                 setattr(user, field, value)
 
         db.session.commit()
+        invalidate_user_cache(user.id)
         return user
 
     else:
@@ -164,6 +170,7 @@ def delete_user(id: int) -> User:
         if user:
             user.status = False
             db.session.commit()
+            invalidate_user_cache(user.id)
             return user
         else:
             raise ValueError(
@@ -379,6 +386,7 @@ def verify_code(user_id: int, code: str) -> User:
             verification_code.expire()
             db.session.flush()  # Add this line to synchronize session's state with DB
             db.session.commit()  # Ensure this is being called
+            invalidate_user_cache(user.id)
             return user
     except Exception as e:
         logging.error(e)
@@ -428,16 +436,17 @@ def create_doctor_patient_association(doctor_id: int, patient_username: int) ->
     db.session.commit()
 
 
-def get_users_by_profile(profile_id: int) -> list[User]:
+def get_users_by_profile(profile_id: int, fields: list = None) -> list[User]:
     """ Get all the users with a given profile_id
     Params:
         profile_id: int -> 1: patient; 2: doctor
+        fields: list -> the only columns to select and return, all of them if None
     Returns:
         list[User]
       """
     try:
-        users = [user.to_dict() for user in db.session.query(
-            User).filter_by(profile_id=profile_id).all()]
+        users = User.to_dicts(db.session.execute(
+            User.select_columns(fields).where(User.profile_id == profile_id)), fields)
         return users
     except Exception as e:
         logging.error(e)
@@ -497,9 +506,10 @@ def get_user_to_user_relation(user_id: int) -> list[User]:
 def new_password(user_id: int, current_password: str, new_password: str) -> User:
     user = db.session.query(User).filter(User.id == user_id).first()
     if user and user.check_password(current_password):
-        user.password_hash = generate_password_hash(
-            new_password).decode('utf-8')
+        user.password_hash = hash_password(
+            new_password)
         db.session.commit()
+        invalidate_user_cache(user.id)
         return user
 
     else:
@@ -507,11 +517,12 @@ def new_password(user_id: int, current_password: str, new_password: str) -> User
             f'Invalid credentials for user with id: {user_id}'
         )
 
-def get_all_users() -> list[User]:
-    """Get all the users"""
+def get_all_users(fields: list = None) -> list[User]:
+    """Get all the users, with only the given fields if any"""
 
     try:
-        users = [user.to_dict() for user in User.query.all()]
+        users = User.to_dicts(db.session.execute(
+            User.select_columns(fields)), fields)
         return users
     except Exception as e:
         logging.error(e)
@@ -0,0 +1,42 @@
+'''
+Environment shared by the tests, imported by every test module before genesis_api: Config
+reads it once, at the first import. The application runs on a SQLite file in a temporary folder.
+
+Redis is replaced by fakeredis in the tests that need it, they are skipped if it is not installed.
+'''
+import atexit
+import os
+import shutil
+import tempfile
+
+FOLDER = tempfile.mkdtemp()
+UPLOAD_FOLDER = os.path.join(FOLDER, 'uploads')
+os.environ.setdefault('SECRET_KEY', 'test')
+# A file, the pool options of Config do not apply to in-memory SQLite
+os.environ['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.join(FOLDER, "genesis.db")}'
+os.environ['SQLALCHEMY_REPLICA_URIS'] = ''
+os.environ['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+os.environ['MEDIA_FOLDER'] = os.path.join(FOLDER, 'media')
+atexit.register(shutil.rmtree, FOLDER, ignore_errors=True)
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+_app = None
+
+
+def get_app():
+    '''The application of the tests, created once as its extensions can only be set up once'''
+    global _app
+    if _app is None:
+        from genesis_api import create_app
+        _app = create_app()
+        _app.config['TESTING'] = True
+    return _app
+
+
+def fake_redis():
+    '''An empty in-memory Redis with the options of Config.REDIS_CLIENT'''
+    return fakeredis.FakeStrictRedis(decode_responses=True)
@@ -0,0 +1,175 @@
+'''
+Resumable uploads: chunks must start at the current offset, an interrupted upload resumes
+where it stopped and finalizing it stores the file like a regular upload. Redis is replaced by fakeredis.
+
+Usage (from the App folder):
+    python -m unittest discover tests
+'''
+import hashlib
+import io
+import os
+import time
+import unittest
+from unittest import mock
+
+from PIL import Image as PILImage
+
+# Before genesis_api, which reads the environment when imported
+from support import fake_redis, fakeredis, get_app
+
+from genesis_api import db
+from genesis_api.config import Config
+from genesis_api.image_classifier import utils
+from genesis_api.image_classifier.utils import append_upload_chunk, create_chunked_upload, \
+    finalize_chunked_upload, get_chunked_upload, image_file_path, sweep_upload_files
+from genesis_api.models import Profile, User
+from genesis_api.tools.handlers import ElementNotFoundError, InvalidRequestParameters, \
+    TooManyUploadsError, UploadFinalizingError, UploadOffsetMismatchError
+
+
+@unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+class ChunkedUploadTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = get_app()
+        db.create_all()
+
+        db.session.add(Profile(id=1, profile='user'))
+        owner = User(name='owner', username='owner', email='owner@genesis.test',
+                     password_hash='x', profile_id=1)
+        other = User(name='other', username='other', email='other@genesis.test',
+                     password_hash='x', profile_id=1)
+        db.session.add_all([owner, other])
+        db.session.commit()
+        cls.owner_id, cls.other_id = owner.id, other.id
+
+        buffer = io.BytesIO()
+        PILImage.effect_noise((64, 64), 50).convert('RGB').save(buffer, 'JPEG')
+        cls.data = buffer.getvalue()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.remove()
+        db.drop_all()
+
+    def setUp(self):
+        patcher = mock.patch.object(Config, 'REDIS_CLIENT', fake_redis())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.owner = db.session.get(User, self.owner_id)
+        self.other = db.session.get(User, self.other_id)
+
+    def send(self, upload_id: str, start: int, end: int) -> dict:
+        return append_upload_chunk(self.owner, upload_id, start, io.BytesIO(self.data[start:end]))
+
+    def test_chunks_in_order(self):
+        upload = create_chunked_upload(self.owner, 'photo.jpg', len(self.data))
+        self.assertEqual(upload['offset'], 0)
+
+        middle = len(self.data) // 2
+        self.assertEqual(self.send(upload['id'], 0, middle)['offset'], middle)
+        self.assertEqual(self.send(upload['id'], middle, len(self.data))['offset'], len(self.data))
+
+    def test_offset_mismatch(self):
+        upload = create_chunked_upload(self.owner, 'photo.jpg', len(self.data))
+        self.send(upload['id'], 0, 100)
+
+        # A chunk sent again, or one skipping ahead, is refused with the current offset
+        for offset in (0, 200):
+            with self.assertRaises(UploadOffsetMismatchError) as context:
+                self.send(upload['id'], offset, offset + 100)
+            self.assertEqual(context.exception.offset, 100)
+        self.assertEqual(get_chunked_upload(self.owner, upload['id'])['offset'], 100)
+
+    def test_larger_than_announced(self):
+        upload = create_chunked_upload(self.owner, 'photo.jpg', 100)
+
+        with self.assertRaises(InvalidRequestParameters):
+            self.send(upload['id'], 0, 150)
+        # The chunk is dropped entirely, the client can send it again
+        self.assertEqual(get_chunked_upload(self.owner, upload['id'])['offset'], 0)
+
+    def test_resume_and_finalize(self):
+        upload = create_chunked_upload(self.owner, 'photo.jpg', len(self.data))
+        self.send(upload['id'], 0, 1000)
+
+        # The rest is sent to another worker, which has no running hash of the upload
+        utils._chunked_upload_digests.pop(upload['id'], None)
+        offset = get_chunked_upload(self.owner, upload['id'])['offset']
+        self.assertEqual(offset, 1000)
+        self.send(upload['id'], offset, len(self.data))
+
+        user_image = finalize_chunked_upload(self.owner, upload['id'])
+
+        image = user_image.image
+        self.assertEqual(user_image.user_id, self.owner_id)
+        self.assertEqual(image.content_hash, hashlib.sha256(self.data).hexdigest())
+        self.assertEqual(image.name, 'photo.jpg')
+        with open(image_file_path(image), 'rb') as image_file:
+            self.assertEqual(image_file.read(), self.data)
+        # The upload is gone once finalized
+        with self.assertRaises(ElementNotFoundError):
+            get_chunked_upload(self.owner, upload['id'])
+        self.assertFalse(os.path.exists(utils._chunked_upload_path(upload['id'])))
+
+    def test_finalize_incomplete(self):
+        upload = create_chunked_upload(self.owner, 'photo.jpg', len(self.data))
+        self.send(upload['id'], 0, 1000)
+
+        with self.assertRaises(UploadOffsetMismatchError) as context:
+            finalize_chunked_upload(self.owner, upload['id'])
+        self.assertEqual(context.exception.offset, 1000)
+        # The upload can still be completed
+        self.send(upload['id'], 1000, len(self.data))
+        self.assertIsNotNone(finalize_chunked_upload(self.owner, upload['id']))
+
+    def test_finalize_once(self):
+        upload = create_chunked_upload(self.owner, 'photo.jpg', len(self.data))
+        self.send(upload['id'], 0, len(self.data))
+
+        Config.REDIS_CLIENT.set(utils._chunked_upload_finalize_key(upload['id']), 'other request')
+        with self.assertRaises(UploadFinalizingError):
+            finalize_chunked_upload(self.owner, upload['id'])
+
+    def test_other_user(self):
+        upload = create_chunked_upload(self.owner, 'photo.jpg', len(self.data))
+
+        with self.assertRaises(ElementNotFoundError):
+            get_chunked_upload(self.other, upload['id'])
+        with self.assertRaises(ElementNotFoundError):
+            append_upload_chunk(self.other, upload['id'], 0, io.BytesIO(self.data))
+
+    def test_open_uploads_limit(self):
+        uploads = [create_chunked_upload(self.owner, 'photo.jpg', len(self.data))
+                   for _ in range(Config.CHUNKED_UPLOAD_MAX_OPEN)]
+        with self.assertRaises(TooManyUploadsError):
+            create_chunked_upload(self.owner, 'photo.jpg', len(self.data))
+        # The limit is per user
+        create_chunked_upload(self.other, 'photo.jpg', len(self.data))
+
+        # Finalizing an upload frees its slot
+        self.send(uploads[0]['id'], 0, len(self.data))
+        finalize_chunked_upload(self.owner, uploads[0]['id'])
+        create_chunked_upload(self.owner, 'photo.jpg', len(self.data))
+
+    def test_sweep(self):
+        live = create_chunked_upload(self.owner, 'photo.jpg', len(self.data))
+        expired = create_chunked_upload(self.owner, 'photo.jpg', len(self.data))
+        recent = create_chunked_upload(self.owner, 'photo.jpg', len(self.data))
+        Config.REDIS_CLIENT.delete(utils._chunked_upload_key(expired['id']),
+                                   utils._chunked_upload_key(recent['id']))
+        old = time.time() - Config.UPLOAD_TMP_MAX_AGE - 1
+        for upload in (live, expired):
+            os.utime(utils._chunked_upload_path(upload['id']), (old, old))
+
+        sweep_upload_files(force=True)
+
+        # Only the old file of an expired upload is deleted
+        self.assertTrue(os.path.exists(utils._chunked_upload_path(live['id'])))
+        self.assertFalse(os.path.exists(utils._chunked_upload_path(expired['id'])))
+        self.assertTrue(os.path.exists(utils._chunked_upload_path(recent['id'])))
+
+
+if __name__ == '__main__':
+    unittest.main()
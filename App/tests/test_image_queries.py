@@ -0,0 +1,96 @@
+'''
+Number of SQL queries of the image listing endpoints, so N+1 regressions fail here instead of
+slowing production down. Runs on SQLite, no MySQL or Redis is needed.
+
+Usage (from the App folder):
+    python -m unittest discover tests
+'''
+import os
+import unittest
+
+from PIL import Image as PILImage
+
+# Before genesis_api, which reads the environment when imported
+from support import UPLOAD_FOLDER, get_app
+
+from genesis_api import db
+from genesis_api.image_classifier.utils import get_image_metadata, get_user_images_data
+from genesis_api.models import DoctorPatientAssociation, Image, MlDiagnostic, Profile, User, UserImage
+from genesis_api.tools.utils import count_queries
+
+IMAGES = 5
+DIAGNOSTICS_PER_IMAGE = 3
+
+
+class ImageQueriesTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = get_app()
+        db.create_all()
+
+        PILImage.new('RGB', (8, 8)).save(os.path.join(UPLOAD_FOLDER, 'image.jpg'))
+        db.session.add(Profile(id=1, profile='user'))
+        patient = User(name='patient', username='patient', email='patient@genesis.test',
+                       password_hash='x', profile_id=1)
+        doctor = User(name='doctor', username='doctor', email='doctor@genesis.test',
+                      password_hash='x', profile_id=1)
+        db.session.add_all([patient, doctor])
+        db.session.flush()
+        db.session.add(DoctorPatientAssociation(doctor_id=doctor.id, patient_id=patient.id))
+        cls.patient_id, cls.doctor_id = patient.id, doctor.id
+
+        cls.image_ids = []
+        for _ in range(IMAGES):
+            image = Image(path=UPLOAD_FOLDER, name='image.jpg')
+            db.session.add(image)
+            db.session.flush()
+            user_image = UserImage(user_id=patient.id, image_id=image.id)
+            user_image.ml_diagnostics = [MlDiagnostic(sickness='sickness', description='description',
+                                                      precision=0.5) for _ in range(DIAGNOSTICS_PER_IMAGE)]
+            db.session.add(user_image)
+            cls.image_ids.append(image.id)
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.remove()
+        db.drop_all()
+
+    def setUp(self):
+        # Nothing loaded by a previous test may spare a query, the users are loaded like
+        # token_required does before the endpoints run
+        db.session.expire_all()
+        self.patient = db.session.get(User, self.patient_id)
+        self.doctor = db.session.get(User, self.doctor_id)
+
+    def test_user_images_data(self):
+        with count_queries() as counter:
+            images, next_cursor = get_user_images_data(self.patient)
+
+        self.assertEqual(len(images), IMAGES)
+        self.assertIsNone(next_cursor)
+        self.assertTrue(all(len(image['ml_diagnostic']) == DIAGNOSTICS_PER_IMAGE for image in images))
+        # The user images with their image, then the diagnostics of all of them
+        self.assertLessEqual(counter.count, 2, counter.statements)
+
+    def test_user_images_data_page(self):
+        with count_queries() as counter:
+            images, next_cursor = get_user_images_data(self.patient, limit=2)
+
+        self.assertEqual(len(images), 2)
+        self.assertIsNotNone(next_cursor)
+        self.assertLessEqual(counter.count, 2, counter.statements)
+
+    def test_image_metadata(self):
+        with count_queries() as counter:
+            metadata = get_image_metadata(self.doctor, self.image_ids[0])
+
+        self.assertEqual(metadata['id'], self.image_ids[0])
+        self.assertNotIn('image', metadata)
+        self.assertEqual(len(metadata['ml_diagnostic']), DIAGNOSTICS_PER_IMAGE)
+        self.assertLessEqual(counter.count, 2, counter.statements)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+'''
+Keyset pagination of the medicines catalog and of the user images: following next_cursor
+returns every row once, in order, and malformed cursors are rejected. Redis is replaced by fakeredis.
+
+Usage (from the App folder):
+    python -m unittest discover tests
+'''
+import os
+import unittest
+from unittest import mock
+
+from PIL import Image as PILImage
+
+# Before genesis_api, which reads the environment when imported
+from support import UPLOAD_FOLDER, fake_redis, fakeredis, get_app
+
+from genesis_api import db
+from genesis_api.config import Config
+from genesis_api.image_classifier.utils import get_user_images_data
+from genesis_api.medicines.utils import list_medicines
+from genesis_api.models import Image, Medicines, Profile, User, UserImage
+from genesis_api.tools.handlers import InvalidRequestParameters
+from genesis_api.tools.utils import decode_cursor, encode_cursor
+
+# Repeated names, so pages sorted by name also depend on the id tiebreak
+MEDICINE_NAMES = ['abacavir', 'abacavir', 'acarbose', 'abacavir', 'zinc', 'abiraterone', 'acarbose']
+
+
+def collect_pages(get_page) -> list:
+    '''Follow next_cursor from the first page to the last one, returning every row'''
+    rows, cursor = [], None
+    while True:
+        page, cursor = get_page(cursor)
+        rows.extend(page)
+        if cursor is None:
+            return rows
+
+
+class CursorTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        values = {'key': 'abacavir', 'id': 12}
+        cursor = encode_cursor(values)
+
+        self.assertNotIn('=', cursor)
+        self.assertEqual(decode_cursor(cursor), values)
+
+    def test_invalid(self):
+        # Not base64, truncated, not JSON, and JSON but not an object
+        for cursor in ('not a cursor!', encode_cursor({'id': 1})[:-2], 'bm90IGpzb24', encode_cursor([1, 2])):
+            with self.subTest(cursor=cursor), self.assertRaises(InvalidRequestParameters):
+                decode_cursor(cursor)
+
+
+@unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+class MedicinesPaginationTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = get_app()
+        db.create_all()
+        db.session.add_all([Medicines(name=name, price=1.0, is_discontinued=False,
+                                      manufacturer_name='manufacturer', type='allopathy',
+                                      pack_size_label='strip of 10 tablets',
+                                      short_composition1='composition', short_composition2='')
+                            for name in MEDICINE_NAMES])
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.remove()
+        db.drop_all()
+
+    def setUp(self):
+        patcher = mock.patch.object(Config, 'REDIS_CLIENT', fake_redis())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def pages(self, search_term=None, limit=2) -> list:
+        return collect_pages(
+            lambda cursor: list_medicines(search_term, cursor, limit)[:2])
+
+    def test_all_pages(self):
+        medicines = self.pages()
+
+        self.assertEqual([medicine['id'] for medicine in medicines],
+                         sorted(medicine.id for medicine in Medicines.query))
+
+    def test_search_pages(self):
+        # Words shorter than MEDICINES_SEARCH_MIN_TOKEN search name prefixes, sorted by name
+        medicines = self.pages('ab')
+
+        expected = sorted((name, id) for id, name in enumerate(MEDICINE_NAMES, 1) if name.startswith('ab'))
+        self.assertEqual([(medicine['name'], medicine['id']) for medicine in medicines], expected)
+
+    def test_page_size(self):
+        medicines, next_cursor, total = list_medicines(limit=3, with_total=True)
+
+        self.assertEqual(len(medicines), 3)
+        self.assertIsNotNone(next_cursor)
+        self.assertEqual(total, len(MEDICINE_NAMES))
+
+    def test_invalid_cursor(self):
+        for values in ({'id': 'one', 'key': 1}, {'id': 1}):
+            with self.subTest(values=values), self.assertRaises(InvalidRequestParameters):
+                list_medicines('ab', encode_cursor(values))
+
+
+class UserImagesPaginationTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = get_app()
+        db.create_all()
+
+        PILImage.new('RGB', (8, 8)).save(os.path.join(UPLOAD_FOLDER, 'image.jpg'))
+        db.session.add(Profile(id=1, profile='user'))
+        user = User(name='patient', username='patient', email='patient@genesis.test',
+                    password_hash='x', profile_id=1)
+        db.session.add(user)
+        db.session.flush()
+        cls.user_id = user.id
+
+        cls.image_ids = []
+        for index in range(7):
+            image = Image(path=UPLOAD_FOLDER, name='image.jpg')
+            db.session.add(image)
+            db.session.flush()
+            # Deleted images are never listed
+            user_image = UserImage(user_id=user.id, image_id=image.id, status=index != 3)
+            db.session.add(user_image)
+            db.session.flush()
+            if user_image.status:
+                cls.image_ids.append(image.id)
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.remove()
+        db.drop_all()
+
+    def setUp(self):
+        self.user = db.session.get(User, self.user_id)
+
+    def test_all_pages(self):
+        for limit in (1, 2, 6, 10):
+            with self.subTest(limit=limit):
+                images = collect_pages(
+                    lambda cursor: get_user_images_data(self.user, cursor=cursor, limit=limit))
+                self.assertEqual([image['id'] for image in images], self.image_ids)
+
+    def test_last_page(self):
+        images, next_cursor = get_user_images_data(self.user, limit=len(self.image_ids))
+
+        self.assertEqual(len(images), len(self.image_ids))
+        self.assertIsNone(next_cursor)
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(InvalidRequestParameters):
+            get_user_images_data(self.user, cursor=encode_cursor({'id': '1'}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+'''
+Incremental sync of the medical history: the token watermark walks the changes in
+(last_update, id) order without skipping rows, starts again a little before the latest
+change once caught up, and tokens that were not built by the server are rejected.
+Runs on SQLite, no MySQL or Redis is needed.
+
+Usage (from the App folder):
+    python -m unittest discover tests
+'''
+import unittest
+from datetime import date, datetime, timedelta
+
+# Before genesis_api, which reads the environment when imported
+from support import get_app
+
+from genesis_api import db
+from genesis_api.config import Config
+from genesis_api.medical_history.utils import sync_medical_history
+from genesis_api.models import DoctorPatientAssociation, FrequencyUnit, MedicalHistory, Prescription, \
+    Profile, User
+from genesis_api.tools.handlers import ElementNotFoundError, InvalidRequestParameters
+from genesis_api.tools.utils import decode_cursor, encode_cursor
+
+START = datetime(2024, 1, 1, 12, 0)
+# Minutes after START of the last update of each record: three of them share the same one
+RECORD_UPDATES = [0, 1, 2, 2, 2, 3, 4]
+
+
+class MedicalHistorySyncTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = get_app()
+        db.create_all()
+
+        db.session.add(Profile(id=1, profile='user'))
+        users = [User(name=name, username=name, email=f'{name}@genesis.test', password_hash='x', profile_id=1)
+                 for name in ('patient', 'doctor', 'stranger')]
+        db.session.add_all(users)
+        db.session.flush()
+        cls.patient_id, cls.doctor_id, cls.stranger_id = [user.id for user in users]
+        association = DoctorPatientAssociation(doctor_id=cls.doctor_id, patient_id=cls.patient_id)
+        db.session.add(association)
+        db.session.flush()
+
+        cls.record_ids = []
+        for minutes in RECORD_UPDATES:
+            record = MedicalHistory(association_id=association.id, next_appointment_date=date(2024, 2, 1),
+                                    last_update=START + timedelta(minutes=minutes))
+            db.session.add(record)
+            db.session.flush()
+            cls.record_ids.append(record.id)
+        record.prescriptions.append(Prescription(
+            treatment='paracetamol', dosage='500 mg', frequency_value=8, frequency_unit=FrequencyUnit.hour,
+            start_date=START, last_update=START + timedelta(minutes=4)))
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.remove()
+        db.drop_all()
+
+    def setUp(self):
+        db.session.expire_all()
+        self.patient = db.session.get(User, self.patient_id)
+        self.doctor = db.session.get(User, self.doctor_id)
+
+    def sync_all(self, limit: int, token: str = None) -> tuple[list, str]:
+        '''Sync from a token until has_more is False, returning the ids of the records received'''
+        ids = []
+        while True:
+            changes = sync_medical_history(self.doctor, self.patient_id, token, limit)
+            ids.extend(record['id'] for record in changes['medical_history'])
+            token = changes['token']
+            if not changes['has_more']:
+                return ids, token
+
+    def test_full_sync(self):
+        for limit in (1, 2, 3, len(RECORD_UPDATES)):
+            with self.subTest(limit=limit):
+                ids, _ = self.sync_all(limit)
+                # Records updated at the same time are not skipped between pages
+                self.assertEqual(ids, self.record_ids)
+
+    def test_patient_sync(self):
+        changes = sync_medical_history(self.patient, self.patient_id)
+
+        self.assertEqual([record['id'] for record in changes['medical_history']], self.record_ids)
+        self.assertEqual([prescription['treatment'] for prescription in changes['prescriptions']],
+                         ['paracetamol'])
+        self.assertEqual(changes['medical_history'][-1]['prescription_ids'],
+                         [changes['prescriptions'][0]['id']])
+        self.assertFalse(changes['has_more'])
+
+    def test_page_watermark(self):
+        changes = sync_medical_history(self.doctor, self.patient_id, limit=3)
+
+        self.assertTrue(changes['has_more'])
+        # The next page starts after the last row received
+        last = START + timedelta(minutes=RECORD_UPDATES[2])
+        self.assertEqual(decode_cursor(changes['token'])['medical_history'],
+                         [last.isoformat(), self.record_ids[2]])
+
+    def test_caught_up_overlap(self):
+        _, token = self.sync_all(2)
+
+        # Caught up, the token starts MEDICAL_HISTORY_SYNC_OVERLAP seconds before the latest change
+        latest = START + timedelta(minutes=RECORD_UPDATES[-1])
+        overlap = latest - timedelta(seconds=Config.MEDICAL_HISTORY_SYNC_OVERLAP)
+        self.assertEqual(decode_cursor(token)['medical_history'], [overlap.isoformat(), 0])
+
+        # So the next sync receives the latest record again, and nothing older
+        changes = sync_medical_history(self.doctor, self.patient_id, token)
+        self.assertEqual([record['id'] for record in changes['medical_history']], self.record_ids[-1:])
+        self.assertEqual(changes['prescriptions'][0]['treatment'], 'paracetamol')
+
+    def test_changes_since_token(self):
+        _, token = self.sync_all(2)
+
+        record = db.session.get(MedicalHistory, self.record_ids[0])
+        record.status = False
+        record.last_update = START + timedelta(minutes=10)
+        db.session.commit()
+        self.addCleanup(self.restore_record, self.record_ids[0])
+
+        changes = sync_medical_history(self.doctor, self.patient_id, token)
+        self.assertEqual([record['id'] for record in changes['medical_history']], self.record_ids[-1:])
+        # Deleted records are sent as tombstones
+        self.assertEqual(changes['deleted_medical_history'], self.record_ids[:1])
+
+    def restore_record(self, record_id: int) -> None:
+        record = db.session.get(MedicalHistory, record_id)
+        record.status = True
+        record.last_update = START + timedelta(minutes=RECORD_UPDATES[0])
+        db.session.commit()
+
+    def test_invalid_token(self):
+        tokens = [
+            'not a token!',
+            encode_cursor({'medical_history': 'yesterday'}),
+            encode_cursor({'medical_history': [START.isoformat()]}),
+            encode_cursor({'medical_history': ['yesterday', 1]}),
+            encode_cursor({'medical_history': [START.isoformat(), 'one']}),
+            encode_cursor({'prescriptions': [None, 1]}),
+        ]
+        for token in tokens:
+            with self.subTest(token=token), self.assertRaises(InvalidRequestParameters):
+                sync_medical_history(self.doctor, self.patient_id, token)
+
+    def test_other_doctor(self):
+        stranger = db.session.get(User, self.stranger_id)
+
+        with self.assertRaises(ElementNotFoundError):
+            sync_medical_history(stranger, self.patient_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+'''
+Metadata stripping of uploaded images: EXIF, comments and text chunks are removed, the
+pixels are left untouched and only the orientation is kept. No database or Redis is needed.
+
+Usage (from the App folder):
+    python -m unittest discover tests
+'''
+import io
+import unittest
+
+from PIL import Image as PILImage, PngImagePlugin
+
+# Before genesis_api, which reads the environment when imported
+import support  # noqa: F401
+
+from genesis_api.image_classifier.pipeline import _strip_jpeg_metadata, _strip_png_metadata
+
+ORIENTATION = 0x0112
+MAKE = 0x010F
+GPS_INFO = 0x8825
+
+
+def image_exif(orientation: int):
+    exif = PILImage.Exif()
+    exif[ORIENTATION] = orientation
+    exif[MAKE] = 'Phone maker'
+    exif[GPS_INFO] = {1: 'N'}
+    return exif
+
+
+class JpegMetadataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.image = PILImage.effect_noise((64, 48), 50).convert('RGB')
+        buffer = io.BytesIO()
+        self.image.save(buffer, 'JPEG', exif=image_exif(6), comment=b'secret comment')
+        self.data = buffer.getvalue()
+
+    def test_metadata_removed(self):
+        stripped = PILImage.open(io.BytesIO(_strip_jpeg_metadata(self.data, 6)))
+
+        self.assertEqual(dict(stripped.getexif()), {ORIENTATION: 6})
+        self.assertNotIn('comment', stripped.info)
+
+    def test_pixels_unchanged(self):
+        original = PILImage.open(io.BytesIO(self.data))
+        stripped = PILImage.open(io.BytesIO(_strip_jpeg_metadata(self.data, 6)))
+
+        self.assertEqual(stripped.size, original.size)
+        # The compressed data is copied, the image is not encoded again
+        self.assertEqual(stripped.tobytes(), original.tobytes())
+
+    def test_default_orientation_has_no_exif(self):
+        stripped = _strip_jpeg_metadata(self.data, 1)
+
+        self.assertNotIn(b'Exif', stripped)
+        self.assertNotIn(b'Phone maker', stripped)
+
+    def test_exif_after_jfif_header(self):
+        buffer = io.BytesIO()
+        self.image.save(buffer, 'JPEG')
+        stripped = _strip_jpeg_metadata(buffer.getvalue(), 3)
+
+        self.assertEqual(stripped[2:4], b'\xff\xe0')
+        self.assertEqual(PILImage.open(io.BytesIO(stripped)).getexif()[ORIENTATION], 3)
+
+    def test_not_a_jpeg(self):
+        with self.assertRaises(ValueError):
+            _strip_jpeg_metadata(b'\x89PNG\r\n\x1a\n', 1)
+
+
+class PngMetadataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.image = PILImage.effect_noise((64, 48), 50).convert('RGB')
+        info = PngImagePlugin.PngInfo()
+        info.add_text('Author', 'someone')
+        info.add_itxt('Comment', 'secret comment')
+        buffer = io.BytesIO()
+        self.image.save(buffer, 'PNG', pnginfo=info, exif=image_exif(6))
+        self.data = buffer.getvalue()
+
+    def test_metadata_removed(self):
+        stripped = PILImage.open(io.BytesIO(_strip_png_metadata(self.data, 6)))
+        stripped.load()
+
+        self.assertEqual(dict(stripped.getexif()), {ORIENTATION: 6})
+        self.assertEqual(stripped.text, {})
+
+    def test_pixels_unchanged(self):
+        original = PILImage.open(io.BytesIO(self.data))
+        stripped = PILImage.open(io.BytesIO(_strip_png_metadata(self.data, 6)))
+
+        self.assertEqual(stripped.tobytes(), original.tobytes())
+
+    def test_text_only_png(self):
+        # Files without EXIF can still hold text chunks, they are stripped too
+        info = PngImagePlugin.PngInfo()
+        info.add_text('Author', 'someone')
+        buffer = io.BytesIO()
+        self.image.save(buffer, 'PNG', pnginfo=info)
+        stripped = _strip_png_metadata(buffer.getvalue(), 1)
+
+        self.assertNotIn(b'someone', stripped)
+        self.assertNotIn(b'eXIf', stripped)
+        self.assertEqual(PILImage.open(io.BytesIO(stripped)).tobytes(), self.image.tobytes())
+
+    def test_not_a_png(self):
+        with self.assertRaises(ValueError):
+            _strip_png_metadata(b'\xff\xd8\xff\xe0', 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+'''
+Revocation of signed out tokens: the in-process set of revoked jtis, its pruning once the
+tokens would have expired anyway, and the Redis checks used while the pub/sub listener is
+not running and for tokens issued before jti. Redis is replaced by fakeredis.
+
+Usage (from the App folder):
+    python -m unittest discover tests
+'''
+import json
+import time
+import unittest
+from unittest import mock
+
+import jwt
+
+# Before genesis_api, which reads the environment when imported
+from support import fake_redis, fakeredis, get_app
+
+from genesis_api import security
+from genesis_api.config import Config
+from genesis_api.security import encodeJwtToken, is_token_revoked, revoke_token
+
+USER = {'id': 1, 'name': 'patient', 'username': 'patient', 'email': 'patient@genesis.test', 'profile_id': 1}
+
+
+def decode(token: str) -> dict:
+    return jwt.decode(token, Config.SECRET_KEY, algorithms=['HS256'])
+
+
+@unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+class TokenRevocationTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = get_app()
+
+    def setUp(self):
+        redis_client = fake_redis()
+        for patcher in (mock.patch.object(Config, 'REDIS_CLIENT', redis_client),
+                        mock.patch.object(Config, 'REDIS_JWT_CLIENT', redis_client),
+                        # The listener is driven by the tests, through _handle_revocation_message
+                        mock.patch.object(security, '_start_revocation_listener'),
+                        mock.patch.object(security, '_revocation_listener_ready', True),
+                        mock.patch.object(security, '_revoked_jtis', {}),
+                        mock.patch.object(security, '_revoked_jtis_expirations', [])):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.redis = redis_client
+
+    def test_revoke(self):
+        token = encodeJwtToken(USER)
+        data = decode(token)
+        self.assertFalse(is_token_revoked(token, data))
+
+        revoke_token(token)
+
+        self.assertTrue(is_token_revoked(token, data))
+        # Kept in Redis until the token expires, for the workers starting later
+        self.assertEqual(self.redis.get(f'revoked:{data["jti"]}'), str(data['exp']))
+        self.assertAlmostEqual(self.redis.ttl(f'revoked:{data["jti"]}'), data['exp'] - time.time(), delta=5)
+
+    def test_other_tokens_of_the_user(self):
+        token, other = encodeJwtToken(USER), encodeJwtToken(USER)
+
+        revoke_token(token)
+
+        self.assertFalse(is_token_revoked(other, decode(other)))
+
+    def test_revocation_message(self):
+        # Revocations published by another worker
+        security._handle_revocation_message(
+            {'data': json.dumps({'jti': 'revoked', 'exp': int(time.time()) + 60})})
+
+        self.assertTrue(is_token_revoked('token', {'jti': 'revoked'}))
+        self.assertFalse(is_token_revoked('token', {'jti': 'valid'}))
+
+    def test_listener_not_running(self):
+        token = encodeJwtToken(USER)
+        data = decode(token)
+        revoke_token(token)
+        security._revoked_jtis.clear()
+
+        # Without the listener the set may be stale, Redis is asked
+        with mock.patch.object(security, '_revocation_listener_ready', False):
+            self.assertTrue(is_token_revoked(token, data))
+            self.assertFalse(is_token_revoked('other', {'jti': 'other'}))
+
+    def test_expired_entries_pruned(self):
+        now = int(time.time())
+        security._remember_revoked_jti('expired', now - 10)
+        security._remember_revoked_jti('expiring', now - 1)
+        security._remember_revoked_jti('valid', now + 60)
+
+        self.assertEqual(set(security._revoked_jtis), {'valid'})
+        self.assertEqual(security._revoked_jtis_expirations, [(now + 60, 'valid')])
+
+    def test_revoked_again(self):
+        # A jti remembered again with a later expiration is not dropped at the earlier one
+        now = int(time.time())
+        security._remember_revoked_jti('token', now - 5)
+        security._remember_revoked_jti('token', now + 60)
+        security._remember_revoked_jti('other', now + 30)
+
+        self.assertEqual(security._revoked_jtis, {'token': now + 60, 'other': now + 30})
+
+    def test_legacy_token(self):
+        # Tokens issued before jti are revoked as a whole, and always checked in Redis
+        token = jwt.encode({'public_id': 1}, Config.SECRET_KEY, algorithm='HS256')
+        data = decode(token)
+        self.assertFalse(is_token_revoked(token, data))
+
+        revoke_token(token)
+
+        self.assertTrue(is_token_revoked(token, data))
+        self.assertEqual(security._revoked_jtis, {})
+        self.assertEqual(self.redis.get(token), 'expired')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,8 @@
+SET NAMES utf8mb4;
+
+-- Content-addressed image storage: identical uploads share one IMAGE row and one file
+
+ALTER TABLE `IMAGE`
+    ADD COLUMN `CONTENT_HASH` char(64) DEFAULT NULL COMMENT 'SHA-256 of the image file, NULL for images stored before content addressing',
+    ADD COLUMN `REF_COUNT` int NOT NULL DEFAULT '1' COMMENT 'Number of USER_IMAGE rows sharing the image file',
+    ADD UNIQUE KEY `IDX_CONTENT_HASH` (`CONTENT_HASH`);
@@ -0,0 +1,8 @@
+SET NAMES utf8mb4;
+
+-- Ranked medicine search: FULLTEXT index over the searchable columns, and a plain index
+-- for the prefix search used with terms too short for the FULLTEXT index
+
+ALTER TABLE `medicines`
+    ADD FULLTEXT KEY `IDX_MEDICINES_SEARCH` (`NAME`, `MANUFACTURER_NAME`, `SHORT_COMPOSITION1`, `SHORT_COMPOSITION2`),
+    ADD KEY `IDX_MEDICINES_NAME` (`NAME`);
@@ -0,0 +1,9 @@
+SET NAMES utf8mb4;
+
+-- Incremental sync of the medical history: the changes of a patient's records are read
+-- per association in (LAST_UPDATE, ID) order, ID being part of every InnoDB secondary index.
+-- The new key starts with ASSOCIATION_ID, so it replaces the single column one for the foreign key
+
+ALTER TABLE `MEDICAL_HISTORY`
+    ADD KEY `IDX_MEDICAL_HISTORY_SYNC` (`ASSOCIATION_ID`, `LAST_UPDATE`),
+    DROP KEY `ASSOCIATION_ID`;